@@ -8,11 +8,10 @@
 #
 
 import json
-import time
-import subprocess
 from cspbaseclass import CSPBaseClass
 from cspbaseclass import Which
-from cspbaseclass import error, trace, trace_do, debug, debug_stop
+from cspbaseclass import error, trace
+from cspbaseclass import clock_get
 
 ##############################################################################
 # some Alibaba defaults values that will vary based on users 
@@ -35,10 +34,10 @@ default_user            = "my-user-name"
 # default_image_name:    Name of OS template that instance will be created with
 # default_instance_type: The default name that defines the memory and cpu sizes
 #                        and the gpu types for the instance. Changes
-# default_choices:       Avaliable instance types that user can select with
-#                        This will probably be different per region, and will
-#                        continue to change over time. Used as a pre-check in  
-#                        command parser to verify choice before sending to csp
+#
+# Which instance types there are changes per region, and over time. They're 
+# queried and cached, see 'ncsp ali types'. createVM checks --instance_type 
+# against the cached ones for the region
 ##############################################################################
 
 default_image_name_international      = "NVIDIA GPU Cloud Virtual Machine Image 18.03.0"
@@ -49,18 +48,39 @@ default_image_name_china              = "NVIDIA GPU Cloud VM Image 18.03.0"
 default_image_name      = default_image_name_international
 if (False):   # non GPU choices for script testing..
     default_instance_type   = "ecs.sn1.medium"
-    default_choices         = ['ecs.sn1.small', 'ecs.sn1.large', 'ecs.sn1.xlarge',   # compute optimized
-                               'ecs.sn2.small', 'ecs.sn2.large', 'ecs.sn2.xlarge'],  # general purpose
 else:         # GPU instances - normal usage
-    default_instance_type   = "ecs.gn5-c4g1.xlarge"
-    default_choices         = ['ecs.gn5-c4g1.xlarge', 'ecs.gn5-c8g1.2xlarge',        # gn6 are nvidia P100
-                               'ecs.gn5-c4g1.2xlarge', 'ecs.gn5-c8g1.4xlarge'
-                               'ecs.gn5-c28g1.7xlarge', 'ecs.gn5-c8g1.8xlarge',
-                               'ecs.gn5-c28g1.14xlarge', 'ecs.gn5-c8g1.14xlarge'],
+    default_instance_type   = "ecs.gn5-c4g1.xlarge"                                # gn5 are nvidia P100
                                
 TIMEOUT_1 = (60 * 4) # create, start, terminate
 TIMEOUT_2 = (60 * 4) # stop, ping
 
+##############################################################################
+# How long (in seconds) the output of the read-only Alibaba query commands 
+# can be reused before asking again. See CSPBaseClass.CacheTTL()
+##############################################################################
+
+default_cache_ttl = { "ecs.DescribeImages":            (60 * 60),
+                      "ecs.DescribeSecurityGroups":    (60 * 10),
+                      "ecs.DescribeRegions":           (60 * 60 * 24),
+                      "ecs.DescribeInstanceTypes":     (60 * 60 * 24) }
+
+##############################################################################
+# Polling policies for the status wait loops (initial, factor, cap, jitter).
+# Each status poll is an Alibaba API call, and these get throttled when many VMs
+# are being waited on. Start slower and back off further than the defaults
+# in cspbaseclass.py. Kinds not listed here use those, see PollSettings()
+##############################################################################
+
+default_poll_policies = { "status":              (1.0, 1.5,  8.0, 0.25),
+                          "status.stopped":      (2.0, 1.5, 10.0, 0.25) }
+
+##############################################################################
+# Most VMs that fleet commands work on at the same time. Alibaba throttles
+# API calls sooner than the others
+##############################################################################
+
+default_max_parallel_vms = 8
+
 ##############################################################################
 # CSPClass
 #
@@ -108,14 +128,11 @@ class CSPClass(CSPBaseClass):
         ''' Alibaba specific option parser '''
        
             # set up Alibaba specific fields of the parser   
-        region_list = self.GetRegionsCached()
         parser.add_argument('--RegionId', dest='region',
                             default=default_region, required=False,
-                            choices=region_list,  # query, keeps changing
                             help='region in which to create the VM')
         parser.add_argument('--instance_type', dest='instance_type',   # 'size' on azure, use 'instance-type' as common name
                             default=default_instance_type, required=False,                
-                            choices=default_choices,                  # should query list if can (region dependent?)
                             help='VM instance (type) to create')
         parser.add_argument('--auto-ngc-login', dest='auto_ngc_login', action='store_true',
                             default=False, required=False,
@@ -174,12 +191,7 @@ class CSPClass(CSPBaseClass):
     def DoCmdNoError(self, cmd):
         ''' ali specifc Blocking command -- returns command output, doesn't report error'''
         
-        debug(1, cmd)
-        self.Log(cmd)
-        
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output, errval = child.communicate()                # returns data from stdout, stderr
-        debug(3, output)                                    # full output for trace    
+        retcode, output, errval = CSPBaseClass.DoCmdNoError(self, cmd)
        
         # print "cmd:              %s " % cmd
         # print "child.returncode: %d " % child.returncode
@@ -195,16 +207,16 @@ class CSPClass(CSPBaseClass):
             #
             # HTTP Status: 404 Error:InvalidInstanceId.NotFound The specified InstanceId does not exist. RequestID: C66FB5EA-FA09-41B2-AD69-9A68BCCE0B4A
 
-        if child.returncode != 0 and errval == "":                
+        if retcode != 0 and errval == "":                
             pos = output.find('}')
             if (pos == -1):
-                return(child.returncode, "", errval) 
+                return(retcode, "", errval) 
             
             jsonbuf = output[:pos+1]    # only the stuff before the first '}'
             decoded_output = json.loads(jsonbuf)
             errval = decoded_output['Message']
             
-        return (child.returncode, output, errval)           # pass back retcode, stdout, stderr
+        return (retcode, output, errval)                    # pass back retcode, stdout, stderr
     
     ###########################################################################
     # GetRunStatus
@@ -257,7 +269,7 @@ class CSPClass(CSPBaseClass):
         cmd += " --ImageName \"%s\"" % args.image_name
         cmd += " --ImageOwnerAlias %s" % args.image_owner_alias
 
-        retcode, output, errval = self.DoCmd(cmd)
+        retcode, output, errval = self.DoCmdCached(cmd)
        
         if (retcode != 0):
             error(errval)
@@ -384,7 +396,7 @@ class CSPClass(CSPBaseClass):
         cmd += " --output json"
         cmd += " --filter SecurityGroups.SecurityGroup[].SecurityGroupName"
 
-        retcode, output, errval = self.DoCmd(cmd)                   # call the Alibaba command
+        retcode, output, errval = self.DoCmdCached(cmd)             # call the Alibaba command
         if (retcode != 0):                                          # check for return code
             error ("Problems describing security groups")
             return 1
@@ -422,7 +434,7 @@ class CSPClass(CSPBaseClass):
                     cmd += str(idx)                                             # index to string
                     cmd += "].SecurityGroupId"
                         
-                    retcode, output, errval = self.DoCmd(cmd)                   # call the Alibaba command
+                    retcode, output, errval = self.DoCmdCached(cmd)             # call the Alibaba command
                     if (retcode != 0):                                          # check for return code
                         error ("Problems describing security groups")
                         return False       
@@ -495,27 +507,32 @@ class CSPClass(CSPBaseClass):
             # A new security group will not have any rules in it.  
             # The following commands will open inbound ports 22 (for SSH), 
             # 443 (for HTTPS), and 5000 (for DIGITS6):
+            #
+            # None of the rules depend on each other, so build all the commands
+            # and send them to Alibaba at the same time
+
+        cmds = []
 
         cmd  = 'aliyuncli ecs AuthorizeSecurityGroup' 
         cmd += ' --RegionId %s' % args.region                       # us-west-1
         cmd += ' --SecurityGroupId %s' % security_group_id          # "sg-rj999tz2kpxehy7obsjn" 
         cmd += ' --IpProtocol tcp --PortRange 22/22 --SourceCidrIp 0.0.0.0/0'
         cmd += ' --Policy accept --Description SSH'
-        self.DoCmd(cmd)
+        cmds.append(cmd)
         
         cmd  = 'aliyuncli ecs AuthorizeSecurityGroup' 
         cmd += ' --RegionId %s' % args.region                       # us-west-1
         cmd += ' --SecurityGroupId %s' % security_group_id          # "sg-rj999tz2kpxehy7obsjn" 
         cmd += ' --IpProtocol tcp --PortRange 443/443 --SourceCidrIp 0.0.0.0/0'
         cmd += ' --Policy accept --Description HTTPS'
-        self.DoCmd(cmd)
+        cmds.append(cmd)
         
         cmd  = 'aliyuncli ecs AuthorizeSecurityGroup' 
         cmd += ' --RegionId %s' % args.region                       # us-west-1
         cmd += ' --SecurityGroupId %s' % security_group_id          # "sg-rj999tz2kpxehy7obsjn" 
         cmd += ' --IpProtocol tcp --PortRange 5000/5000 --SourceCidrIp 0.0.0.0/0'
         cmd += ' --Policy accept --Description DIGITS6'
-        self.DoCmd(cmd)        
+        cmds.append(cmd)
 
         cmd  = 'aliyuncli ecs AuthorizeSecurityGroup' 
         cmd += ' --RegionId %s' % args.region                       # us-west-1
@@ -523,7 +540,7 @@ class CSPClass(CSPBaseClass):
         cmd += ' --IpProtocol icmp --PortRange -1/-1'               # Is value Ok? (-1/8 for Alibaba?)
         cmd += ' --SourceCidrIp 0.0.0.0/0'
         cmd += ' --Policy accept --Description \"Support for ping\"'
-        self.DoCmd(cmd)        
+        cmds.append(cmd)
 
              # The following command will open all outbound ports:
 
@@ -532,7 +549,10 @@ class CSPClass(CSPBaseClass):
         cmd += ' --SecurityGroupId %s' % security_group_id          # "sg-rj999tz2kpxehy7obsjn" 
         cmd += ' --IpProtocol all --PortRange -1/-1 --DestCidrIp 0.0.0.0/0'
         cmd += ' --Policy accept --Description \"All open!\"'
-        retcode, output, errval = self.DoCmd(cmd)                   # call the Alibaba command
+        cmds.append(cmd)
+        
+        results = self.DoCmdParallel(cmds, len(cmds))               # call the Alibaba commands
+        retcode, output, errval = results[-1]                       # egress rule is the one that matters
             
         if (retcode != 0):                                          # check for return code
             error ("Problems setting up security group rules")
@@ -566,7 +586,7 @@ class CSPClass(CSPBaseClass):
                 args.nsg_id = ""                            # clear out the id
                 break
             trace(3-retrycnt, "Problems deleting security group \"%s\" retry:%d" % (args.nsg_name, retrycnt))
-            time.sleep(retrycnt)            
+            clock_get().Sleep(retrycnt)            
         return retcode
     
 ##############################################################################
@@ -641,14 +661,15 @@ class CSPClass(CSPBaseClass):
         cmd  = 'aliyuncli ecs CreateInstance'
         cmd += " --RegionId %s" % args.region                       # us-west-1
         cmd += " --ImageId %s"  % args.image_id                     # m-rj9gjqbdwtwlhtgqjeov" 
-        cmd += " --SecurityGroupId %s" % args.nsg_id                # sg-rj999tz2kpxehy7obsjn"
         cmd += " --InstanceType %s" % args.instance_type            # ecs.gn5-c4g1.xlarge
         cmd += " --InstanceName %s" % args.vm_name                  # Name to create VM: "newton-gn5-1gpu" 
         cmd += " --InternetMaxBandwidthOut %d" % args.bandwidth_out # 10
         cmd += " --InstanceChargeType %s" % args.charge_type        # PostPaid 
         cmd += " --KeyPairName %s" % args.key_name                  # baseos-alibaba-siliconvalley
         
-        retcode, output, errval = self.DoCmd(cmd)                   # call the Alibaba command
+        retcode, output, errval = self.DoCmd(cmd + " --SecurityGroupId %s" % args.nsg_id)
+        if (retcode != 0 and self.NSGGone(args)):                   # recorded security group was deleted
+            retcode, output, errval = self.DoCmd(cmd + " --SecurityGroupId %s" % args.nsg_id)
         if (retcode != 0):                                          # check for return code
             error ("Problems creating VM \"%s\"" % args.vm_name)
             return 1
@@ -659,6 +680,7 @@ class CSPClass(CSPBaseClass):
         
         trace(3, json.dumps(decoded_output, indent=4, sort_keys=True))
         args.vm_id = decoded_output['InstanceId']
+        self.Accepted(args, "create")
                        
             # with Alibaba, Instances created via CLI are not automatically given a public IP address.  
             # To assign a public IP address to the instance you just created
@@ -680,7 +702,7 @@ class CSPClass(CSPBaseClass):
                 break                                       # got IP we think -- done now
             
             trace(3-retrycnt, "Problems allocating IP address for %s, retry:%d" % (args.vm_id, retrycnt))
-            time.sleep(retrycnt)            
+            clock_get().Sleep(retrycnt)            
           
         if (args.vm_ip == ""):
             error ("Unable to allocating IP address for \"%s\"" % args.vm_name)
@@ -742,6 +764,7 @@ class CSPClass(CSPBaseClass):
         retcode, output, errval = self.DoCmd(cmd)
         
         if (retcode == 0):
+            self.Accepted(args, "start")
             retcode = self.WaitTillRunning(args, "Running", TIMEOUT_1) 
         
         return retcode                                  # 0: succcess, 1: failure
@@ -825,10 +848,11 @@ class CSPClass(CSPBaseClass):
                 # again - pingable and ssh-able to know it's running
               
         if (retcode == 0):
+            self.Accepted(args, "reboot")
             if (args.pingable == 1):
                 retcode = self.WaitForPing(args, False, TIMEOUT_2)
             else:
-                time.sleep(5)           # let VM go down enough so SSH stops (we hope)
+                clock_get().Sleep(5)    # let VM go down enough so SSH stops (we hope)
                 retcode = 0             # fake success, since ping isn't supported
                 
             if (retcode != 0):
@@ -867,14 +891,17 @@ class CSPClass(CSPBaseClass):
             
         if (retcode == 0):
             self.Clean(args)            # remove file with the persistent id, ip address, ..
-            self.m_args_fname = ""      # clear name, so won't write back args when done
+            args.vm_deleted = True      # so won't write back args when done
         return retcode
     
 ##############################################################################
 # CSP specific utility functions
 #
 #    ShowRunning             Shows all the account's running VM's
+#    GetRunning              Running VM's in a region
 #    GetRegions              Returns proper list of regions
+#    GetTypes                Instance types in a region, and what they have
+#    MaxParallelVMs          Most VMs to work on at the same time
 ##############################################################################
 
     ##############################################################################
@@ -891,8 +918,41 @@ class CSPClass(CSPBaseClass):
         
         lines_printed = 0
          
+        retcode, instances = self.GetRunning(args, None)
+        if (retcode == 0):
+            if (instances.__len__() == 0):
+                print("# %s: No running instances found" % self.m_class_name )
+                return 1
+            for instance in instances:
+                if (lines_printed == 0):
+                    print("# %s:" % self.m_class_name )
+                print(" %-36s %-16s %10s \"%s\"" % 
+                    (instance["id"],   
+                                                # TODO - add in the region here !
+                    instance["type"],
+                    instance["launched"][0:10],
+                    instance["name"]))
+                lines_printed += 1
+            
+        return 0        # 0 have a list of running instances, 1 fail or empty list
+    
+    ##############################################################################
+    # GetRunning
+    #
+    # Gets the running instances in a region, see CSPBaseClass.ShowRunningAllRegions
+    #
+    # Returns:    (retcode, list of { "region", "id", "type", "launched", "name" })
+    #
+    # region of None is the aliyuncli's configured region
+    #
+    def GetRunning(self, args, region):
+        ''' returns (retcode, list of running instances in region) '''
+        
+        running = []
         cmd =  "aliyuncli ecs DescribeInstances"
-        # cmd += " --RegionId %s" % args.region                     # us-west-1
+        if (region != None):
+            cmd += " --RegionId %s" % region                        # us-west-1
+        cmd += " --Status Running"
         cmd += " --PageSize 50"                                     # default is 10, max is 50
         retcode, output, errval = self.DoCmd(cmd)
         if (retcode == 0):
@@ -909,24 +969,15 @@ class CSPClass(CSPBaseClass):
             #       }
             #    }
 
-            count = decoded_output["TotalCount"]
-            if (count == 0):
-                print("# %s: No running instances found" % self.m_class_name )
-                return 1
-            for idx in range(0, count):
-                instance = decoded_output["Instances"]["Instance"][idx]
+            for instance in decoded_output["Instances"]["Instance"]:
                 if (instance["Status"] == "Running"):
-                    if (lines_printed == 0):
-                        print("# %s:" % self.m_class_name )
-                    print(" %-36s %-16s %10s \"%s\"" % 
-                        (instance["InstanceId"],   
-                                                    # TODO - add in the region here !
-                        instance["InstanceType"],
-                        instance["CreationTime"][0:10],
-                        instance["InstanceName"]))
-                    lines_printed += 1
+                    running.append({ "region":   instance.get("RegionId", region),
+                                     "id":       instance["InstanceId"],
+                                     "type":     instance["InstanceType"],
+                                     "launched": instance["CreationTime"],
+                                     "name":     instance["InstanceName"] })
             
-        return 0        # 0 have a list of running instances, 1 fail or empty list
+        return retcode, running
     
     ##############################################################################
     # GetRegions
@@ -937,8 +988,8 @@ class CSPClass(CSPBaseClass):
     # may offer different resoures. Don't care about that here. Just need the
     # name.
     #
-    # Used in a choice-list in the arg parser when user gives a non-default
-    # region name to catch invalid names before any real processing is done
+    # Used to check --region, by the commands that use it, to catch invalid
+    # names before any real processing is done. See CSPBaseClass.CheckRegion
     #
     # Returns:    list of names
     def GetRegions(self):
@@ -947,13 +998,70 @@ class CSPClass(CSPBaseClass):
         mylist = []
         cmd =  "aliyuncli ecs DescribeRegions"
         
-        retcode, output, errval = self.DoCmd(cmd)
+        retcode, output, errval = self.DoCmdCached(cmd)
         if ( retcode == 0 ):
             decoded_output = json.loads(output)
             items = len(decoded_output["Regions"]["Region"])           # number of regions 
             for idx in range(0, items):
                 name = decoded_output["Regions"]["Region"][idx]["RegionId"]
                 mylist.append(str(name))
-        return mylist 
+        return mylist
+
+    ##############################################################################
+    # GetTypes
+    #
+    # Gets the instance types available in a region, see CSPBaseClass.ShowTypes.
+    # What each type has is the same in every region, that list is cached. 
+    # Which ones a region has are in its zones' available resources
+    #
+    # Returns:    (retcode, list of { "type", "vcpus", "memory", "gpus", "gpu", "network" })
+    #
+    def GetTypes(self, args, region):
+        ''' returns (retcode, list of instance types in region) '''
+        
+        types = []
+        cmd =  "aliyuncli ecs DescribeInstanceTypes"
+        retcode, output, errval = self.DoCmdCached(cmd)
+        if (retcode != 0):
+            return retcode, types
+        specs = {}
+        for item in json.loads(output)["InstanceTypes"]["InstanceType"]:
+            specs[item["InstanceTypeId"]] = item
+            
+        cmd =  "aliyuncli ecs DescribeAvailableResource"
+        cmd += " --RegionId %s" % region
+        cmd += " --DestinationResource InstanceType"
+        retcode, output, errval = self.DoCmd(cmd)
+        if (retcode != 0):
+            return retcode, types
+        available = set()
+        for zone in json.loads(output)["AvailableZones"]["AvailableZone"]:
+            for resource in zone["AvailableResources"]["AvailableResource"]:
+                for supported in resource["SupportedResources"]["SupportedResource"]:
+                    if (supported["Status"] == "Available"):
+                        available.add(supported["Value"])       # "ecs.gn5-c8g1.2xlarge"
+                        
+        for name in sorted(available):
+            if (name not in specs):
+                continue
+            item = specs[name]
+            types.append({ "type":    name,
+                           "vcpus":   item.get("CpuCoreCount", 0),
+                           "memory":  float(item.get("MemorySize", 0)),     # GiB
+                           "gpus":    item.get("GPUAmount", 0),
+                           "gpu":     item.get("GPUSpec", ""),             # "NVIDIA P100"
+                           "network": item.get("InstanceBandwidthRx", 0) / 1000000.0 })  # Kbps
+        return 0, types
 
-     
+    ##############################################################################
+    # MaxParallelVMs
+    #
+    # Most VMs that a fleet command (--count/--parallel) will create, start, 
+    # stop or delete at the same time. Keeps bursts under the Alibaba API limits
+    #
+    # Returns:    number of VMs
+    #
+    def MaxParallelVMs(self):
+        ''' most VMs to create/start/stop/delete at the same time '''
+        
+        return default_max_parallel_vms
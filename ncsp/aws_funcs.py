@@ -7,11 +7,12 @@
 # HELPTEXT: "Amazon Cloud Service Provider"
 #
 import json
-import time
 import sys
+import re
 from cspbaseclass import CSPBaseClass
 from cspbaseclass import Which
 from cspbaseclass import error, trace, trace_do, debug, debug_stop
+from cspbaseclass import clock_get
 import cmd
 
 ##############################################################################
@@ -35,24 +36,58 @@ default_user                = "my-user-name"
 # default_image_name:    Name of OS template that instance will be created with
 # default_instance_type: The default name that defines the memory and cpu sizes
 #                        and the gpu types for the instance. Changes
-# default_choices:       Avaliable instance types that user can select with
-#                        This will probably be different per region, and will
-#                        continue to change over time. Used as a pre-check in  
-#                        command parser to verify choice before sending to csp
+#
+# Which instance types there are changes per region, and over time. They're 
+# queried and cached, see 'ncsp aws types'. createVM checks --instance_type 
+# against the cached ones for the region
 ##############################################################################
 
 if (False):   # non gpu version - quick non-gpu testing
     default_image_name      = "ubuntu/images/hvm-ssd/ubuntu-xenial-16.04-amd64-server*"
     default_instance_type   = "t2.micro"
-    default_choices         = ['t2.micro']
 else:        # aws marketplace has nvidia volta image locked to only running on aws p3 type boxes
     default_image_name      = "NVIDIA Volta Deep Learning AMI*"
     default_instance_type   = "p3.2xlarge"   # 1gpu, 4gpu and 8gpu instances
-    default_choices         = ['p3.2xlarge', 'p3.8xlarge', 'p3.16xlarge'] 
 
 TIMEOUT_1 = (60 * 4) # create, start, terminate
 TIMEOUT_2 = (60 * 4) # stop, ping
+
+##############################################################################
+# How long (in seconds) the output of the read-only aws query commands can
+# be reused before asking aws again. See CSPBaseClass.CacheTTL()
+##############################################################################
+
+default_cache_ttl = { "ec2.describe-images":           (60 * 60),
+                      "ec2.describe-vpcs":             (60 * 60),
+                      "ec2.describe-security-groups":  (60 * 10),
+                      "ec2.describe-regions":          (60 * 60 * 24) }
     
+##############################################################################
+# Polling policies for the status wait loops (initial, factor, cap, jitter).
+# Each status poll is an aws API call, and these get throttled when many VMs
+# are being waited on. Start slower and back off further than the defaults
+# in cspbaseclass.py. Kinds not listed here use those, see PollSettings()
+##############################################################################
+
+default_poll_policies = { "status.running":      (2.0, 1.5, 10.0, 0.25),
+                          "status.stopped":      (5.0, 1.5, 15.0, 0.25),
+                          "status.terminated":   (5.0, 1.5, 15.0, 0.25) }
+
+##############################################################################
+# Most VMs that fleet commands work on at the same time. RunInstances and the
+# other ec2 calls are rate limited per account, per region
+##############################################################################
+
+default_max_parallel_vms = 16
+
+##############################################################################
+# Most items asked for in one describe call, see DoCmdPaged. The aws cli 
+# hands back a NextToken when there are more, and that's used to ask for 
+# the next page
+##############################################################################
+
+default_page_items = 1000
+
 ##############################################################################
 # CSPClass
 #
@@ -97,14 +132,11 @@ class CSPClass(CSPBaseClass):
     #
     def ArgOptions(self, parser):  
         ''' Aws specific option parser '''
-        region_list = self.GetRegionsCached()
         parser.add_argument('--region', dest='region',
                             default=default_region, required=False,
-                            choices=region_list,                        # regions change, queried outpu
                             help='region in which to create the VM')
         parser.add_argument('--instance_type', dest='instance_type',    # 'size' on azure, use 'instance-type' as common name
                             default=default_instance_type, required=False,
-                            choices=default_choices,
                             help='VM instance (type) to create')
  
         parser.add_argument('--vpcid', dest='vpcid', 
@@ -198,7 +230,7 @@ class CSPClass(CSPBaseClass):
         cmd  = "aws ec2 describe-images" 
         cmd += " --region %s" % args.region
         cmd += " --filters Name=name,Values=\"%s\"" % args.image_name
-        retcode, output, errval = self.DoCmd(cmd)
+        retcode, output, errval = self.DoCmdCached(cmd)
 
         if (retcode != 0):
             error(errval)
@@ -345,30 +377,23 @@ class CSPClass(CSPBaseClass):
             error("NetworkSecurityGroup name is \"%s\"" % args.nsg_name)
             return 1
 
-            # Is there a better way to do this than to pull in the entire dictionary
-            # and iterate through the keys? 
+            # have aws look for the name, and send back just the id and name 
+            # of what it finds, rather than every group in the region 
             
         cmd  = "aws ec2 describe-security-groups "          # build the AWS command to create an instance
         cmd += " --region %s" % args.region                 # us-west-2
+        cmd += " --filters Name=group-name,Values=%s" % args.nsg_name
+        cmd += " --query \"{SecurityGroups: SecurityGroups[].{GroupId: GroupId, GroupName: GroupName}, NextToken: NextToken}\""
         
-        retcode, output, errval = self.DoCmd(cmd)           # call the AWS command
+        retcode, groups = self.DoCmdPaged(cmd, "SecurityGroups", True)
         if (retcode != 0):                                  # check for return code
             error ("Problems describing security groups")
             return 1
-        decoded_output = json.loads(output)
-        
-            # number of security groups
-            
-        items = len(decoded_output["SecurityGroups"])       # number of security groups
         
-            # slow search for name 
-            
-        for idx in range(0, items):
-            if (decoded_output["SecurityGroups"][idx]["GroupName"] == args.nsg_name): 
-                args.nsg_id = decoded_output["SecurityGroups"][idx]["GroupId"]
-                debug(2, "%2d %-12s \"%s\"" % (idx,
-                                              decoded_output["SecurityGroups"][idx]["GroupId"], 
-                                              decoded_output["SecurityGroups"][idx]["GroupName"]))
+        for idx in range(0, len(groups)):
+            if (groups[idx]["GroupName"] == args.nsg_name): 
+                args.nsg_id = groups[idx]["GroupId"]
+                debug(2, "%2d %-12s \"%s\"" % (idx, groups[idx]["GroupId"], groups[idx]["GroupName"]))
                 return 0        # found it
             
             # returns 1 if did not find security group
@@ -404,7 +429,7 @@ class CSPClass(CSPBaseClass):
         if (args.vpcid == "" or args.vpcid == None or args.vpcid == "None"):
             cmd  = "aws ec2 describe-vpcs"
             cmd += " --region %s" % args.region
-            retcode, output, errval = self.DoCmd(cmd)       # call the AWS command
+            retcode, output, errval = self.DoCmdCached(cmd) # call the AWS command
             if (retcode != 0):
                 return retcode
             decoded_output = json.loads(output)
@@ -454,10 +479,11 @@ class CSPClass(CSPBaseClass):
 
         egress = {}
         
-        outer_retcode = 0
+            # each rule is independent of the others, so build all the commands
+            # first and then send them to aws at the same time
+            
+        cmds = []
         for idx in range(0, len(ingress)):
-            self.Inform("CreateNSG rule %s.%s" % (args.nsg_name, ingress[idx]["Description"]))
-
             cmd =  "aws ec2 authorize-security-group-ingress"
             cmd += " --group-id %s" % args.nsg_id
             cmd += " --ip-permissions '[{"                                    # mini-embedded json like
@@ -469,8 +495,11 @@ class CSPClass(CSPBaseClass):
             cmd +=      " \"Description\":\"%s\""   % ingress[idx]["Description"]
             cmd +=   " }]"
             cmd += " }]'"
+            cmds.append(cmd)
 
-            retcode, output, errval = self.DoCmd(cmd)       # call the AWS command
+        self.Inform("CreateNSG rules %s" % args.nsg_name)
+        outer_retcode = 0
+        for retcode, output, errval in self.DoCmdParallel(cmds):   # call the AWS commands
             if (retcode != 0):
                 outer_retcode = retcode                     # keep any non-zero return code
         
@@ -575,9 +604,10 @@ class CSPClass(CSPBaseClass):
         cmd += " --instance-type %s" % args.instance_type   # t2.micro
         cmd += " --region %s" % args.region                 # us-west-2
         cmd += " --key-name %s" % args.key_name             # my-security-key
-        cmd += " --security-group-ids %s" % args.nsg_id     # Security Group
 
-        retcode, output, errval = self.DoCmd(cmd)           # call the AWS command
+        retcode, output, errval = self.DoCmd(cmd + " --security-group-ids %s" % args.nsg_id)
+        if (retcode != 0 and self.NSGGone(args)):           # recorded security group was deleted
+            retcode, output, errval = self.DoCmd(cmd + " --security-group-ids %s" % args.nsg_id)
         if (retcode != 0):                                  # check for return code
             error ("Problems creating VM \"%s\"" % args.vm_name)
             return 1                                        # nothing to delete, can return
@@ -590,6 +620,7 @@ class CSPClass(CSPBaseClass):
         
         args.vm_id = decoded_output['Instances'][0]['InstanceId']
         args.vm_ip = ""                             # don't have IP we see it running
+        self.Accepted(args, "create")
                        
             # Name your instance! . Done here instead of in run-instances call 
             # it's tricky in bash to get space/qoutes right, at least in original bash code where
@@ -657,6 +688,7 @@ class CSPClass(CSPBaseClass):
         cmd += " --region %s" % args.region             # us-west-2
         retcode, output, errval = self.DoCmd(cmd)
         if (retcode == 0):
+            self.Accepted(args, "start")
             rc = self.WaitTillRunning(args, "running", TIMEOUT_1) 
         
         return rc                                        # 0: succcess, 1: failure
@@ -742,10 +774,11 @@ class CSPClass(CSPBaseClass):
             # running
                 
         if (retcode == 0):
+            self.Accepted(args, "reboot")
             if (args.pingable == 1):
                 retcode = self.WaitForPing(args, False, TIMEOUT_2)
             else:
-                time.sleep(5)           # let VM go down enough so SSH stops (we hope)
+                clock_get().Sleep(5)    # let VM go down enough so SSH stops (we hope)
                 retcode = 0             # fake success, since ping isn't supported
                 
             if (retcode != 0):
@@ -781,7 +814,7 @@ class CSPClass(CSPBaseClass):
             
         if (retcode == 0):              # successful so far?
             self.Clean(args)            # remove file with the persistent id, ip address, ..
-            self.m_args_fname = ""      # clear name, so won't write back args when done
+            args.vm_deleted = True      # so won't write back args when done
         return retcode                  # 0: succcess, 1: failure
 
         
@@ -789,7 +822,11 @@ class CSPClass(CSPBaseClass):
 # CSP specific utility functions
 #
 #    ShowRunning             Shows all the account's running VM's
+#    GetRunning              Running VM's in a region
+#    DoCmdPaged              Runs describe command, a page at a time
 #    GetRegions              Returns proper list of regions
+#    GetTypes                Instance types in a region, and what they have
+#    MaxParallelVMs          Most VMs to work on at the same time
 ##############################################################################
 
     ##############################################################################
@@ -806,39 +843,91 @@ class CSPClass(CSPBaseClass):
         
         lines_printed = 0
         
-        cmd =  "aws ec2 describe-instances"
-        # cmd += " --region %s" % args.region                 # us-west-2
-        retcode, output, errval = self.DoCmd(cmd)
+        retcode, instances = self.GetRunning(args, args.region)
         if ( retcode == 0 ):
-            decoded_output = json.loads(output)
-            items = len(decoded_output["Reservations"])       # number of security groups
-            for idx in range(0, items):
-                tagname = "No 'Name' tag provided to identify instance"  # expect the worse
-                state   = decoded_output["Reservations"][idx]["Instances"][0]["State"]["Name"]
-                if (state == "running"):
-                    try:    # may not exist, and may be multiple tags...
-                        tags = decoded_output["Reservations"][idx]["Instances"][0]["Tags"]
-                        tlen = len(tags)
-                        for tidx in range(0, tlen):
-                            if (tags[0]["Key"] == "Name"):
-                                tagname = tags[0]["Value"]
-                                break;
-                    except:
-                        dummy = 1
-                    if (lines_printed == 0):
-                        print("# %s:" % self.m_class_name )
-                    print(" %-36s %-16s %10s \"%s\"" % 
-                          (decoded_output["Reservations"][idx]["Instances"][0]["InstanceId"],
-                           decoded_output["Reservations"][idx]["Instances"][0]["InstanceType"],
-                           decoded_output["Reservations"][idx]["Instances"][0]["LaunchTime"][0:10],
-                           tagname))
-                    lines_printed += 1
+            for instance in instances:
+                if (lines_printed == 0):
+                    print("# %s:" % self.m_class_name )
+                print(" %-36s %-16s %10s \"%s\"" % 
+                      (instance["id"],
+                       instance["type"],
+                       instance["launched"][0:10],
+                       instance["name"]))
+                lines_printed += 1
                     
             if (lines_printed == 0):
-                print("# %s: No running instances found" % self.m_class_name )
+                print("# %s: No running instances found in %s" % (self.m_class_name, args.region))
         
         return retcode      # 0 success, !0 failure
     
+    ##############################################################################
+    # GetRunning
+    #
+    # Gets the running instances in a region, see CSPBaseClass.ShowRunningAllRegions
+    #
+    # Returns:    (retcode, list of { "region", "id", "type", "launched", "name" })
+    #
+    def GetRunning(self, args, region):
+        ''' returns (retcode, list of running instances in region) '''
+        
+            # aws picks out the running instances, and sends back only the 
+            # fields shown here -- not the 50 or so values of every instance 
+            # in the account
+            
+        cmd =  "aws ec2 describe-instances"
+        cmd += " --region %s" % region                      # us-west-2
+        cmd += " --filters Name=instance-state-name,Values=running"
+        cmd += " --query \"{Instances: Reservations[].Instances[].{InstanceId: InstanceId, InstanceType: InstanceType,"
+        cmd +=               " LaunchTime: LaunchTime, Name: Tags[?Key=='Name'] | [0].Value}, NextToken: NextToken}\""
+        retcode, instances = self.DoCmdPaged(cmd, "Instances", False)
+        
+        running = []
+        for instance in instances:
+            tagname = instance["Name"]
+            if (tagname == None):
+                tagname = "No 'Name' tag provided to identify instance"
+            running.append({ "region":   region,
+                             "id":       instance["InstanceId"],
+                             "type":     instance["InstanceType"],
+                             "launched": instance["LaunchTime"],
+                             "name":     tagname })
+        return retcode, running
+    
+    ##############################################################################
+    # DoCmdPaged
+    #
+    # Runs an aws describe command, asking for default_page_items at a time,
+    # and following the NextToken till there are no more. 'cmd' must keep the
+    # NextToken in its output if it has a --query, like
+    #
+    #     --query "{Items: Reservations[].Instances[], NextToken: NextToken}"
+    #
+    # 'key' is the list to gather from each page's output, 'cached' is to
+    # use DoCmdCached rather than DoCmd
+    #
+    # Returns:    (retcode, list of all the items)
+    #
+    def DoCmdPaged(self, cmd, key, cached):
+        ''' runs a describe command one page at a time, returns (retcode, items from all pages) '''
+        
+        items = []
+        token = None
+        while (True):
+            page_cmd = cmd + " --max-items %d" % default_page_items
+            if (token != None):
+                page_cmd += " --starting-token %s" % token
+            if (cached):
+                retcode, output, errval = self.DoCmdCached(page_cmd)
+            else:
+                retcode, output, errval = self.DoCmd(page_cmd)
+            if (retcode != 0):
+                return retcode, items
+            decoded_output = json.loads(output)
+            items += decoded_output.get(key) or []           # null if filtered down to nothing
+            token  = decoded_output.get("NextToken")
+            if (token == None):
+                return 0, items
+    
     ##############################################################################
     # GetRegions
     #
@@ -848,8 +937,8 @@ class CSPClass(CSPBaseClass):
     # may offer different resoures. Don't care about that here. Just need the
     # name.
     #
-    # Used in a choice-list in the arg parser when user gives a non-default
-    # region name to catch invalid names before any real processing is done
+    # Used to check --region, by the commands that use it, to catch invalid
+    # names before any real processing is done. See CSPBaseClass.CheckRegion
     #
     # Returns:    list of names
     def GetRegions(self):
@@ -857,14 +946,56 @@ class CSPClass(CSPBaseClass):
                 
         mylist = []
         cmd =  "aws ec2 describe-regions"
-        retcode, output, errval = self.DoCmd(cmd)
+        retcode, output, errval = self.DoCmdCached(cmd)
         if ( retcode == 0 ):
             decoded_output = json.loads(output)
             items = len(decoded_output["Regions"])       # number of regions
             for idx in range(0, items):
                 name = decoded_output["Regions"][idx]["RegionName"]
                 mylist.append(str(name))
-        return mylist 
-    
+        return mylist
+
+    ##############################################################################
+    # GetTypes
+    #
+    # Gets the instance types offered in a region, see CSPBaseClass.ShowTypes.
+    # Network performance is text, "25 Gigabit", "Up to 10 Gigabit" or 
+    # "4x 100 Gigabit" -- or "Moderate" for older types, which is left as 0
+    #
+    # Returns:    (retcode, list of { "type", "vcpus", "memory", "gpus", "gpu", "network" })
+    #
+    def GetTypes(self, args, region):
+        ''' returns (retcode, list of instance types in region) '''
+        
+        cmd  = "aws ec2 describe-instance-types"
+        cmd += " --region %s" % region
+        cmd += " --query \"{Items: InstanceTypes[], NextToken: NextToken}\""
+        retcode, items = self.DoCmdPaged(cmd, "Items", False)
+        types = []
+        if (retcode == 0):
+            for item in items:
+                gpus = item.get("GpuInfo", {}).get("Gpus", [])      # [{"Name": "V100", "Count": 8, ..}]
+                match = re.search(r"(?:(\d+)x )?([\d.]+) Gigabit", item["NetworkInfo"]["NetworkPerformance"])
+                network = 0.0
+                if (match != None):
+                    network = float(match.group(2)) * int(match.group(1) or 1)
+                types.append({ "type":    item["InstanceType"],
+                               "vcpus":   item["VCpuInfo"]["DefaultVCpus"],
+                               "memory":  item["MemoryInfo"]["SizeInMiB"] / 1024.0,
+                               "gpus":    sum([ gpu["Count"] for gpu in gpus ]),
+                               "gpu":     ",".join([ gpu["Name"] for gpu in gpus ]),
+                               "network": network })
+        return retcode, types
 
+    ##############################################################################
+    # MaxParallelVMs
+    #
+    # Most VMs that a fleet command (--count/--parallel) will create, start, 
+    # stop or delete at the same time. Keeps bursts under the aws API limits
+    #
+    # Returns:    number of VMs
+    #
+    def MaxParallelVMs(self):
+        ''' most VMs to create/start/stop/delete at the same time '''
         
+        return default_max_parallel_vms
@@ -10,9 +10,54 @@ import sys
 import time
 import subprocess
 import json
+import threading
+import Queue
+import hashlib
+import random
+import socket
+import select
+import errno
+import sqlite3
+import ctypes
+import ctypes.util
 
 g_trace_level = 0          # global trace level, see trace_do and debug funcs
 
+    # command types, used to decide what output can be cached, see CmdReadOnly
+    
+local_cmds      = ["ssh", "ping", "ssh-keygen", "scp"]   # not CSP commands
+readonly_verbs  = ["describe", "list", "get", "show"]
+mutating_verbs  = ["create", "delete", "authorize", "revoke", "run", "terminate", "start", 
+                   "stop", "reboot", "allocate", "release", "modify", "import"]
+
+    # Polling policies for the Wait... functions. (initial, factor, cap, jitter) 
+    # first delay is 'initial' seconds, each next one is 'factor' times longer
+    # up to 'cap' seconds, and each is randomly moved +/- 'jitter' (fraction) so
+    # many ncsp's waiting at same time don't all poll at once. Key is the kind
+    # of wait, "status.<value>" falls back to "status". See PollSettings()
+    
+default_poll_policies = { "status":     (0.5, 1.5, 5.0, 0.2),
+                          "ping":       (0.5, 1.5, 4.0, 0.2),
+                          "ssh.banner": (0.25, 1.5, 2.0, 0.2),
+                          "ssh":        (1.0, 1.5, 5.0, 0.2) }
+
+    # Upper limits (seconds) of the latency histogram buckets for --stats
+    # the last bucket holds everything slower. See ShowCmdStats()
+    
+cmd_stat_buckets = [ 0.1, 0.25, 0.5, 1, 2, 5, 10, 30 ]
+
+    # DoCmdStream passes output on in reads of up to stream_chunk bytes, as
+    # it comes, keeping only the last stream_keep bytes of it to return
+    
+stream_chunk = 65536
+stream_keep  = 65536
+
+    # ssh commands to a VM share one connection (ssh ControlMaster), so only
+    # the first pays for the tcp and crypto handshake. The master connection
+    # exits when it's been idle this many seconds, --ssh_persist 0 turns it off
+    
+default_ssh_persist = 600
+
 ##############################################################################
 # common helper functions used throughout
 
@@ -71,7 +116,836 @@ def Which(program):
                 return exe_file
 
     return None
+
+##############################################################################
+# Clock
+#
+# All of ncsp's timing, deadlines and waiting goes through the clock in 
+# g_clock, rather than time.time() and time.sleep(). Two kinds:
+#
+#    Clock          real time. Now() is monotonic, so timings aren't thrown
+#                   off when the system time is set (ntp, suspend..) 
+#    VirtualClock   simulated time, a Sleep() just moves the clock forward. 
+#                   With the template or sim CSPs, or a --transport replay, 
+#                   a full test of many minutes runs in well under a second
+#
+# Now() values are only good for taking the difference of two of them, use 
+# Epoch() to turn one into a time of day (for logs and saved results)
+##############################################################################
+
+class timespec(ctypes.Structure):
+    _fields_ = [ ("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long) ]
+
+def monotonic_clock_func():
+    ''' returns function giving monotonic seconds, python 2 doesn't have time.monotonic '''
+    
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+        clock_id = 6 if sys.platform == "darwin" else 1       # CLOCK_MONOTONIC
+        ts = timespec()
+        if (clock_gettime(clock_id, ctypes.byref(ts)) != 0):
+            raise OSError(ctypes.get_errno(), "clock_gettime")
+    except (OSError, AttributeError, TypeError):
+        return time.time                                    # best we can do
+    
+    def monotonic():
+        ts = timespec()
+        clock_gettime(clock_id, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic_time = monotonic_clock_func()
+
+class Clock:
+    ''' real time clock '''
+    
+    def Now(self):
+        ''' seconds, for timing and deadlines '''
+        return monotonic_time()
+    
+    def Epoch(self, now):
+        ''' a Now() value as a time.time() time of day '''
+        return time.time() - (monotonic_time() - now)
+    
+    def Time(self):
+        ''' time of day, seconds since 1970 '''
+        return time.time()
+    
+    def Sleep(self, secs):
+        time.sleep(max(0, secs))
+        
+    def Wait(self, event, secs):
+        ''' waits till event is set or secs are up, returns True if it was set '''
+        return event.wait(max(0, secs))
+    
+    def Virtual(self):
+        return False
+    
+    def Started(self, now):
+        ''' a new thread, started at now by another thread, is running '''
+        pass
+    
+    def Joined(self, now):
+        ''' a thread that finished at now has been waited for '''
+        pass
+
+class VirtualClock(Clock):
+    ''' simulated time clock, sleeping takes no real time '''
+    
+        # each thread has its own time -- two threads that each sleep 1 second
+        # at the same time take 1 second, not 2. A BackgroundTask starts at
+        # the time of the thread that made it, and the thread that Wait()s
+        # for it catches up to the time it finished. Starts at time of day
+        
+    def __init__(self):
+        self.m_local    = threading.local()
+        self.m_lock     = threading.Lock()
+        self.m_latest   = time.time()       # furthest on any thread has got
+        
+    def Now(self):
+        if (not hasattr(self.m_local, "now")):
+            with self.m_lock:
+                self.m_local.now = self.m_latest
+        return self.m_local.now
+    
+    def Set(self, now):
+        self.m_local.now = now
+        with self.m_lock:
+            self.m_latest = max(self.m_latest, now)
+    
+    def Epoch(self, now):
+        return now
+    
+    def Time(self):
+        return self.Now()
     
+    def Sleep(self, secs):
+        self.Set(self.Now() + max(0, secs))
+        
+    def Wait(self, event, secs):
+        if (not event.is_set()):
+            self.Sleep(secs)
+        return event.is_set()
+    
+    def Virtual(self):
+        return True
+    
+    def Started(self, now):
+        self.Set(now)
+        
+    def Joined(self, now):
+        self.Set(max(self.Now(), now))
+
+g_clock = Clock()           # global clock, see clock_set
+
+def clock_set(clock):
+    ''' sets the clock everything is timed with, a Clock or VirtualClock '''
+    
+    global g_clock
+    g_clock = clock
+    
+def clock_get():
+    return g_clock
+
+def probe_ssh_banner(host, port, timeout):
+    ''' returns ssh server's banner line if one answers on host:port within timeout, else None '''
+    
+        # non-blocking tcp connect then wait for the "SSH-2.0-..." line that an ssh
+        # server sends as soon as it accepts a connection. No process is forked, 
+        # no keys exchanged, and it gives up as soon as timeout is reached
+        
+    end = monotonic_time() + timeout            # real socket i/o, so always real time
+    sock = None
+    try:
+        family, socktype, proto, name, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        err = sock.connect_ex(addr)
+        if (err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK)):
+            return None                                     # refused, unreachable..
+        rlist, wlist, xlist = select.select([], [sock], [], max(0, end - monotonic_time()))
+        if (wlist.__len__() == 0):
+            return None                                     # connect timed out
+        if (sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0):
+            return None                                     # connect failed
+        rlist, wlist, xlist = select.select([sock], [], [], max(0, end - monotonic_time()))
+        if (rlist.__len__() == 0):
+            return None                                     # port open, but nothing said yet
+        banner = sock.recv(256)
+        if (banner.startswith("SSH-")):
+            return banner.splitlines()[0]
+        return None
+    except (socket.error, socket.gaierror):
+        return None                                         # no dns name yet, reset, ...
+    finally:
+        if (sock != None):
+            sock.close()
+            
+##############################################################################
+# simple thread based concurrency helpers
+#
+# Almost everything ncsp does is wait on an external process (aws, gcloud,
+# aliyuncli, ssh, ping..). A thread that is blocked in communicate() costs
+# next to nothing, so independent commands can simply be run in threads.
+# (python 2.7 has no asyncio, and this keeps the code easy to follow)
+#
+#    BackgroundTask     runs one function in its own thread, Wait() for result
+#    run_parallel       runs a list of functions through a bounded worker pool
+
+class BackgroundTask(threading.Thread):
+    ''' runs func(*args) in a background thread, Wait() returns its result '''
+    
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon      = True         # don't hang the app on exit if user ^C's
+        self.m_func      = func
+        self.m_args      = args
+        self.m_result    = None
+        self.m_exc_info  = None
+        self.m_started   = g_clock.Now()    # virtual clock: thread starts at our time
+        self.m_finished  = None
+        
+    def run(self):
+        g_clock.Started(self.m_started)
+        try:
+            self.m_result = self.m_func(*self.m_args)
+        except:
+            self.m_exc_info = sys.exc_info()    # re-raised in callers thread by Wait()
+        self.m_finished = g_clock.Now()
+            
+    def Wait(self):
+        ''' blocks till function has returned, passes back its return value '''
+        
+        while self.is_alive():          # join() with no timeout can't be ^C'ed in python 2
+            self.join(0.1)
+        g_clock.Joined(self.m_finished)
+        if (self.m_exc_info != None):
+            raise self.m_exc_info[0], self.m_exc_info[1], self.m_exc_info[2]
+        return self.m_result
+    
+def run_parallel(tasks, max_workers):
+    ''' runs list of (func, args) tuples, max_workers at a time, returns list of results in same order '''
+    
+    results  = [None] * len(tasks)
+    errors   = []
+    work     = Queue.Queue()
+    for idx in range(0, len(tasks)):
+        work.put(idx)
+        
+    def worker():
+        while True:
+            try:
+                idx = work.get_nowait()
+            except Queue.Empty:
+                return                              # nothing left to do
+            func, args = tasks[idx]
+            try:
+                results[idx] = func(*args)
+            except:
+                errors.append(sys.exc_info())       # keep going, report after all done
+                
+    workers = []
+    for i in range(0, max(1, min(max_workers, len(tasks)))):
+        workers.append(BackgroundTask(worker))
+        workers[i].start()
+    for task in workers:
+        task.Wait()
+        
+    if (errors.__len__() > 0):                      # pass first exception on to caller
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+    
+##############################################################################
+# PollPolicy
+#
+# How long to sleep between polls in a wait loop. Starts short, as the thing
+# waited for is often quick, then backs off exponentially so that long waits
+# don't make hundreds of (throttled) CSP calls. Counts the polls made. 
+##############################################################################
+
+class PollPolicy:
+    ''' exponential backoff with jitter and a cap, for the Wait... poll loops '''
+    
+    def __init__(self, name, initial, factor, cap, jitter):
+        self.m_name     = name              # kind of wait, for reporting
+        self.m_delay    = initial           # next delay, before jitter
+        self.m_factor   = factor
+        self.m_cap      = cap
+        self.m_jitter   = jitter
+        self.m_polls    = 1                 # first poll is done before any delay
+        self.m_timeline = None              # Timeline, records the sleeps if set
+        
+    def Next(self, remaining):
+        ''' returns seconds to sleep before next poll, never more than 'remaining' '''
+        
+        delay = self.m_delay * random.uniform(1.0 - self.m_jitter, 1.0 + self.m_jitter)
+        self.m_delay = min(self.m_delay * self.m_factor, self.m_cap)
+        self.m_polls += 1
+        return max(0, min(delay, remaining))
+    
+    def Sleep(self, remaining, cancel=None):
+        ''' sleeps till next poll, returns early if the cancel Event gets set '''
+        
+        delay = self.Next(remaining)
+        start = g_clock.Now()
+        if (cancel == None):
+            g_clock.Sleep(delay)
+        else:
+            g_clock.Wait(cancel, delay)
+        if (self.m_timeline != None):
+            self.m_timeline.Span("sleep", "poll", start, g_clock.Now(), { "wait": self.m_name })
+
+##############################################################################
+# Timeline
+#
+# Spans of time for the steps of a lifecycle command -- each CSP command, each
+# wait (status, ping, ssh..), the sleeps between polls, and the VM's own boot
+# times -- so it can be seen where the time goes: the CSP's control plane, 
+# the VM's OS boot, or ncsp's own polling. Enabled with --timeline 1, written
+# as a Chrome trace json file (chrome://tracing, or ui.perfetto.dev) 
+#
+# Each thread gets its own track, so parallel commands show side by side.
+##############################################################################
+
+class Timeline:
+    ''' collects timed spans and marks, writes them as Chrome trace events '''
+    
+    def __init__(self):
+        self.m_enabled  = False
+        self.m_events   = []
+        self.m_threads  = {}                # thread ident -> (tid, thread name)
+        self.m_lock     = threading.Lock()
+        
+    def Enable(self, enabled):
+        self.m_enabled = enabled
+        
+    def Enabled(self):
+        return self.m_enabled
+        
+    def Tid(self):
+        ''' small track number for current thread, must hold m_lock '''
+        
+        ident = threading.current_thread().ident
+        if (ident not in self.m_threads):
+            self.m_threads[ident] = (self.m_threads.__len__() + 1, threading.current_thread().name)
+        return self.m_threads[ident][0]
+        
+    def Span(self, name, cat, start, end, args=None):
+        ''' adds a span of time from start to end (g_clock.Now() values) '''
+        
+        if (not self.m_enabled):
+            return
+        with self.m_lock:
+            self.m_events.append({ "name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": self.Tid(),
+                                   "ts": start * 1000000, "dur": (end - start) * 1000000, "args": args or {} })
+    
+    def Mark(self, name, cat, when=None, args=None):
+        ''' adds a single point in time, now if when isn't given '''
+        
+        if (not self.m_enabled):
+            return
+        if (when == None):
+            when = g_clock.Now()
+        with self.m_lock:
+            self.m_events.append({ "name": name, "cat": cat, "ph": "i", "s": "p", "pid": os.getpid(), 
+                                   "tid": self.Tid(), "ts": when * 1000000, "args": args or {} })
+            
+    def Write(self, fname, process_name):
+        ''' writes out all events as Chrome trace json, returns number of events '''
+        
+        with self.m_lock:
+            events = [ { "name": "process_name", "ph": "M", "pid": os.getpid(), "args": { "name": process_name } } ]
+            for tid, name in self.m_threads.values():
+                events.append({ "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, 
+                                "args": { "name": name } })
+            with open(fname, "w") as f:
+                json.dump({ "traceEvents": events + self.m_events, "displayTimeUnit": "ms" }, f)
+            return self.m_events.__len__()
+        
+##############################################################################
+# Cassette
+#
+# Record/replay transport for the cli commands that DoCmdNoError runs, and
+# the ssh port probes. --transport is one of
+#
+#    live     commands are run, nothing recorded (the default)
+#    record   commands are run, and each one's output, stderr, exit code and 
+#             how long it took is added to the cassette file (json lines)
+#    replay   commands are not run, their results are served back from the 
+#             cassette. ncsp's own logic (wait loops, retries, fleets) can be
+#             run with no CSP account, as fast as it will go or, with 
+#             --replay_scale, taking the recorded time multiplied by it
+#
+# Each record is tagged with the ncsp command (createVM, status..) it was run
+# under, and a replay uses the records for the same ncsp command. A command 
+# run several times (like a status poll) gets its results back in the same
+# order, the last one repeating once they are used up. VM names with time 
+# stamps differ from run to run, so a command that isn't in the cassette 
+# gets the next unused result of the same family (ec2.run-instances) instead.
+##############################################################################
+
+transport_modes = [ "live", "record", "replay" ]
+
+class Cassette:
+    ''' records cli commands and their results to a file, or plays them back '''
+    
+    def __init__(self, fname, mode, scale):
+        self.m_fname    = fname
+        self.m_mode     = mode
+        self.m_scale    = scale             # replay: sleep recorded secs * scale
+        self.m_ncsp_cmd = ""                # ncsp command the cli commands are run for
+        self.m_records  = []                # replay: everything in the cassette
+        self.m_by_cmd   = {}                # replay: cmd -> records not played yet
+        self.m_by_family= {}                # replay: family -> records not played yet
+        self.m_last     = {}                # replay: cmd -> last record played
+        self.m_lock     = threading.Lock()
+        if (mode == "replay"):
+            with open(fname, "r") as f:
+                for line in f:
+                    try:
+                        self.m_records.append(json.loads(line))
+                    except ValueError:
+                        pass                # partly written line
+            self.Rewind()
+            
+    def Key(self, cmd):
+        ''' normalized command, so spacing differences don't matter '''
+        
+        return " ".join(cmd.split())
+    
+    def Replaying(self):
+        return self.m_mode == "replay"
+        
+    def SetCommand(self, ncsp_cmd):
+        ''' tags records with, or plays back the records of, the ncsp command '''
+        
+        self.m_ncsp_cmd = ncsp_cmd
+        if (self.Replaying()):
+            self.Rewind()
+            
+    def Rewind(self):
+        ''' replay: start again with the records for the current ncsp command '''
+        
+        with self.m_lock:
+            records = [ record for record in self.m_records if record["ncsp"] == self.m_ncsp_cmd ]
+            if (records.__len__() == 0):
+                records = self.m_records    # none for it, so take any of them
+            self.m_by_cmd    = {}
+            self.m_by_family = {}
+            self.m_last      = {}
+            for record in records:
+                self.m_by_cmd.setdefault(record["cmd"], []).append(record)
+                self.m_by_family.setdefault(record["family"], []).append(record)
+    
+    def Record(self, cmd, family, start, secs, rc, output, errval):
+        ''' adds a command and its results to the cassette '''
+        
+        record = { "ncsp": self.m_ncsp_cmd, "cmd": self.Key(cmd), "family": family, "start": start, 
+                   "secs": secs, "rc": rc, "stdout": output, "stderr": errval }
+        with self.m_lock:
+            with open(self.m_fname, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                
+    def Play(self, cmd, family):
+        ''' returns recorded (rc, stdout, stderr) for the command, after recorded secs * scale '''
+        
+        key = self.Key(cmd)
+        with self.m_lock:
+            record = None
+            if (self.m_by_cmd.get(key)):
+                record = self.m_by_cmd[key].pop(0)
+            elif (key in self.m_last):
+                record = self.m_last[key]                   # used up, keep repeating last
+            elif (self.m_by_family.get(family)):
+                record = self.m_by_family[family][0]        # same type, different names
+                self.m_by_cmd[record["cmd"]].remove(record)
+            if (record != None):
+                if (record in self.m_by_family[record["family"]]):
+                    self.m_by_family[record["family"]].remove(record)
+                self.m_last[key] = record
+        if (record == None):
+            debug(1, "replay: not in cassette: %s" % cmd)
+            return (1, "", "not in cassette %s" % self.m_fname)
+        if (self.m_scale > 0):
+            g_clock.Sleep(record["secs"] * self.m_scale)
+        return (record["rc"], record["stdout"].encode("utf-8"), None)   # stderr was never passed back live
+        
+##############################################################################
+# CmdCache
+#
+# Output cache for the read-only CSP query commands (describe, list..), so
+# things like the image name-to-id lookup don't go out to the CSP on every
+# createVM. Entries are keyed by the normalized command line, and have a
+# time-to-live set by the type of command. They are kept both in memory and
+# in files under ~/ncsp/<csp>/data/cache/ so they are reused across runs. 
+#
+# Any command that changes a resource (create, delete, authorize, ...) throws
+# away all the cached entries for that same type of resource.
+##############################################################################
+
+class CmdCache:
+    ''' two level (memory and disk) time-to-live cache of command output '''
+    
+    def __init__(self, path):
+        self.m_path     = path                  # directory where disk entries live
+        self.m_entries  = {}                    # in memory copies, by key
+        self.m_hits     = 0
+        self.m_misses   = 0
+        self.m_lock     = threading.Lock()      # may be used from DoCmdParallel threads
+        
+    def Key(self, cmd):
+        ''' normalized command string, extra white space removed '''
+        
+        return ' '.join(cmd.split())
+    
+    def FileName(self, key):
+        ''' disk file name for key '''
+        
+        return self.m_path + hashlib.sha1(key).hexdigest()
+    
+    def ReadEntry(self, key):
+        ''' returns entry from disk, or None if it doesn't exist or can't be read '''
+        
+        try:
+            with open(self.FileName(key), "r") as f:
+                entry = json.load(f)
+            if (entry["key"] == key):
+                return entry
+        except:
+            pass
+        return None
+    
+    def Get(self, cmd):
+        ''' returns cached (retcode, output, errval) for cmd, None if not cached or expired '''
+        
+        key = self.Key(cmd)
+        with self.m_lock:
+            entry = self.m_entries.get(key)
+            if (entry == None):
+                entry = self.ReadEntry(key)                 # 2nd level, on disk
+            if (entry != None and entry["expires"] > time.time()):
+                self.m_entries[key] = entry
+                self.m_hits += 1
+                return (entry["retcode"], entry["output"], entry["errval"])
+            self.m_misses += 1
+            return None
+        
+    def Put(self, cmd, resource, ttl, result):
+        ''' saves result of cmd, good for ttl seconds '''
+        
+        key   = self.Key(cmd)
+        entry = { "key":      key,
+                  "resource": resource,
+                  "expires":  time.time() + ttl,
+                  "retcode":  result[0],
+                  "output":   result[1],
+                  "errval":   result[2] }
+        with self.m_lock:
+            self.m_entries[key] = entry
+            if (os.path.isdir(self.m_path) == False):
+                os.mkdir(self.m_path)
+            fname = self.FileName(key)
+            with open(fname + ".tmp", "w") as f:        # write, then rename so other
+                json.dump(entry, f)                     # ncsp's never see partial file
+            os.rename(fname + ".tmp", fname)
+            
+    def Entries(self):
+        ''' returns list of all the entries on disk '''
+        
+        entries = []
+        if (os.path.isdir(self.m_path)):
+            for name in os.listdir(self.m_path):
+                try:
+                    with open(self.m_path + name, "r") as f:
+                        entries.append(json.load(f))
+                except:
+                    pass                                # partial/tmp file, skip it
+        return entries
+        
+    def Invalidate(self, resource):
+        ''' removes all entries for given resource type '''
+        
+        if (resource == ""):
+            return
+        with self.m_lock:
+            for key in self.m_entries.keys():
+                if (self.m_entries[key]["resource"] == resource):
+                    del self.m_entries[key]
+            for entry in self.Entries():
+                if (entry["resource"] == resource):
+                    trace(2, "invalidate: %s" % entry["key"])
+                    try:
+                        os.remove(self.FileName(entry["key"]))
+                    except OSError:
+                        pass                            # someone else removed it
+        
+    def Clear(self):
+        ''' removes all entries '''
+        
+        with self.m_lock:
+            self.m_entries = {}
+            if (os.path.isdir(self.m_path)):
+                for name in os.listdir(self.m_path):
+                    os.remove(self.m_path + name)
+        
+##############################################################################
+# StateStore
+#
+# All the persistent state for a CSP -- the args, the fleet VMs and the network
+# security groups -- is kept in a SQLite database in WAL mode, in
+# ~/ncsp/<csp>/data/state.db. This allows many ncsp processes to be run against
+# the same CSP at the same time: readers never block, writers take turns, and
+# every update is one transaction, so it's either all there or not at all.
+#
+#    args   key, value                  persistent command line option values
+#    vms    region, name, id, ip, ..    fleet VMs, see FleetRegistry
+#    nsgs   region, name, id            network security groups 
+#
+# Only the args a command actually changed get written back, so two commands
+# run at the same time don't overwrite each other's values. 
+#
+# The json "args" file from older versions is moved into the database the
+# first time it's opened.
+##############################################################################
+
+state_schema = '''
+    CREATE TABLE IF NOT EXISTS args (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS vms  (region TEXT, name TEXT, vm_id TEXT, vm_ip TEXT, 
+                                     tags TEXT, args TEXT, updated REAL, 
+                                     PRIMARY KEY (region, name));
+    CREATE TABLE IF NOT EXISTS nsgs (region TEXT, name TEXT, nsg_id TEXT, updated REAL,
+                                     PRIMARY KEY (region, name));
+'''
+
+class StateStore:
+    ''' transactional store of a CSP's persistent state, safe across processes '''
+    
+    def __init__(self, fname, old_args_fname):
+        self.m_fname            = fname
+        self.m_old_args_fname   = old_args_fname    # json args file to migrate
+        self.m_db               = None              # opened on first use
+        self.m_lock             = threading.Lock()  # connection is shared by threads
+        
+    def Connect(self):
+        ''' opens the database, creating it and migrating old args file if needed '''
+        
+        if (self.m_db == None):
+            db = sqlite3.connect(self.m_fname, timeout=30,      # wait for other writers
+                                 isolation_level=None,          # transactions done below
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")             # WAL keeps it consistent
+            self.m_db = db
+            self.Migrate()
+        return self.m_db
+    
+    def Read(self, sql, params=()):
+        ''' returns all the rows from a query '''
+        
+        with self.m_lock:
+            return self.Connect().execute(sql, params).fetchall()
+        
+    def Write(self, func, *args):
+        ''' runs func(db, *args) as a single transaction, returns what it returns '''
+        
+        with self.m_lock:
+            db = self.Connect()
+            db.execute("BEGIN IMMEDIATE")       # take the write lock now, not half way through
+            try:
+                result = func(db, *args)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+            return result
+        
+    def Migrate(self):
+        ''' creates the tables, and moves the values from an old json args file into args '''
+        
+            # another ncsp starting at the same time may be doing this too.
+            # Whichever gets the write lock first does it, and renames the old
+            # file before letting go, so the other finds it has been done
+            
+        self.m_db.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in state_schema.split(";"):
+                self.m_db.execute(sql)
+            if (self.m_old_args_fname != None and os.path.exists(self.m_old_args_fname)):
+                with open(self.m_old_args_fname, "r") as f:
+                    vargs = json.load(f)
+                if (self.m_db.execute("SELECT COUNT(*) FROM args").fetchone()[0] == 0):
+                    for key, value in vargs.items():
+                        self.m_db.execute("INSERT INTO args VALUES (?, ?)", (key, json.dumps(value)))
+                os.rename(self.m_old_args_fname, self.m_old_args_fname + ".migrated")
+            self.m_db.execute("COMMIT")
+        except:
+            self.m_db.execute("ROLLBACK")
+            raise
+        
+    ##########################################################################
+    # args 
+    
+    def ArgsGet(self):
+        ''' returns dictionary of all the saved args '''
+        
+        return dict([ (key, json.loads(value)) for key, value in self.Read("SELECT key, value FROM args") ])
+    
+    def ArgsPut(self, vargs):
+        ''' saves the key,values in vargs, leaves the other saved args as they are '''
+        
+        def put(db, vargs):
+            for key, value in vargs.items():
+                db.execute("INSERT OR REPLACE INTO args VALUES (?, ?)", (key, json.dumps(value)))
+        self.Write(put, vargs)
+        
+    def ArgsClear(self, vm_id=None):
+        ''' removes all the saved args, if vm_id is given only if they are for that VM '''
+        
+        def clear(db, vm_id):
+            if (vm_id != None):
+                row = db.execute("SELECT value FROM args WHERE key = 'vm_id'").fetchone()
+                if (row == None or json.loads(row[0]) != vm_id):
+                    return
+            db.execute("DELETE FROM args")
+        self.Write(clear, vm_id)
+        
+    ##########################################################################
+    # vms
+    
+    def VMPut(self, region, name, vargs, tags):
+        ''' adds or updates a VM, keeps its existing tags unless new ones are given '''
+        
+        def put(db, region, name, vargs, tags):
+            row = db.execute("SELECT tags FROM vms WHERE region = ? AND name = ?", (region, name)).fetchone()
+            old = []
+            if (row != None):
+                old = json.loads(row[0])
+            if (tags == None):
+                tags = old
+            else:
+                tags = sorted(set(old + tags))
+            db.execute("INSERT OR REPLACE INTO vms VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (region, name, vargs.get("vm_id"), vargs.get("vm_ip"), 
+                        json.dumps(tags), json.dumps(vargs), time.time()))
+        self.Write(put, region, name, vargs, tags)
+        
+    def VMRemove(self, region, name, vm_id=None):
+        ''' removes a VM, if vm_id is given only when it's the same VM '''
+        
+        if (vm_id == None):
+            self.Write(lambda db: db.execute("DELETE FROM vms WHERE region = ? AND name = ?", (region, name)))
+        else:
+            self.Write(lambda db: db.execute("DELETE FROM vms WHERE region = ? AND name = ? AND vm_id = ?", 
+                                             (region, name, vm_id)))
+            
+    def VMs(self):
+        ''' returns list of (region, name, tags, args) of all the VMs '''
+        
+        rows = self.Read("SELECT region, name, tags, args FROM vms ORDER BY region, name")
+        return [ (region, name, json.loads(tags), json.loads(vargs)) for region, name, tags, vargs in rows ]
+    
+    ##########################################################################
+    # nsgs
+    
+    def NSGPut(self, region, name, nsg_id):
+        ''' records the id of a network security group, None or "" removes it '''
+        
+        if (nsg_id == None or nsg_id == "" or nsg_id == "None"):
+            self.Write(lambda db: db.execute("DELETE FROM nsgs WHERE region = ? AND name = ?", (region, name)))
+        else:
+            self.Write(lambda db: db.execute("INSERT OR REPLACE INTO nsgs VALUES (?, ?, ?, ?)", 
+                                             (region, name, nsg_id, time.time())))
+            
+    def NSGGet(self, region, name):
+        ''' returns the recorded id of a network security group, None if there isn't one '''
+        
+        rows = self.Read("SELECT nsg_id FROM nsgs WHERE region = ? AND name = ?", (region, name))
+        if (rows.__len__() == 0):
+            return None
+        return rows[0][0]
+        
+##############################################################################
+# FleetRegistry
+#
+# The args only hold the one "current" VM for a CSP. The fleet registry holds
+# any number of named VMs, per region, each with the args it was last run 
+# with and a list of user tags. They are rows in the StateStore's vms table.
+#
+# Every VM created gets added, and removed again when it's deleted. Commands 
+# act on a set of registered VMs when given any of the selectors
+#
+#    --vm NAME[,NAME..]    the named VMs, createVM will create them
+#    --all                 every VM in the registry
+#    --tag TAG             VMs with the tag, createVM tags new VMs with it
+#    --count N             VMs NAME-1 .. NAME-N for each --vm NAME
+#
+# and --parallel K works on K of them at the same time (see MaxParallelVMs)
+##############################################################################
+
+unsaved_arg_keys = [ "vm_select", "all_vms", "tags",     # never saved with the args
+                     "vm_count", "parallel", "all_regions",
+                     "transport", "cassette", "replay_scale", "clock",
+                     "ssh_persist", "stream", "tee" ]
+
+default_max_parallel_vms = 4        # VMs worked on at once, CSPs override MaxParallelVMs
+default_max_parallel_regions = 8    # regions queried at once by --all-regions running
+default_max_parallel_ssh = 32       # VMs sshall runs on at once, local ssh's not CSP calls
+default_regions_ttl = 7 * 24 * 3600 # secs regions file is used before it's refreshed in background
+default_regions_refresh = 300       # secs a background regions refresh is given before another
+default_types_ttl = 24 * 3600       # secs a region's instance types are used before queried again
+
+class FleetRegistry:
+    ''' named VMs per region, and the saved args to run commands on each '''
+    
+    def __init__(self, state):
+        self.m_state    = state             # StateStore
+        
+    def Put(self, region, name, vargs, tags=None):
+        ''' adds or updates a VM, keeps its existing tags unless new ones are given '''
+        
+        self.m_state.VMPut(region, name, vargs, tags)
+            
+    def Remove(self, region, name, vm_id=None):
+        ''' removes a VM, if vm_id is given only when it's the same VM '''
+        
+        self.m_state.VMRemove(region, name, vm_id)
+            
+    def Entries(self):
+        ''' returns list of (region, name, entry) for every VM, sorted '''
+        
+        return [ (region, name, { "tags": tags, "args": vargs }) for region, name, tags, vargs in self.m_state.VMs() ]
+    
+    def Select(self, names, all_vms, tags):
+        ''' returns (region, name, entry) for the selected VMs, entry is None if name is unknown '''
+        
+            # names may be given as "--vm a --vm b" or "--vm a,b" 
+            
+        wanted = []
+        for item in (names or []):
+            for name in item.split(","):
+                if (name != "" and name not in wanted):
+                    wanted.append(name)
+                    
+        entries  = self.Entries()
+        selected = []
+        if (all_vms or (wanted.__len__() == 0 and tags)):
+            selected = entries
+        for name in wanted:
+            found = [ item for item in entries if item[1] == name ]
+            if (found.__len__() == 0):
+                found = [ (None, name, None) ]
+            for item in found:
+                if (item not in selected):
+                    selected.append(item)
+        
+            # must have every one of the tags asked for
+            
+        for tag in (tags or []):
+            selected = [ item for item in selected if item[2] == None or tag in item[2]["tags"] ]
+        return selected
+        
 ##############################################################################
 # CSPBaseClass
 #
@@ -111,16 +985,40 @@ class CSPBaseClass:
             # full path names to various files we create and use
             
         self.m_cmd_fname        = self.m_log_path  + "cmds"
-        self.m_args_fname       = self.m_save_path + "args"
+        self.m_args_fname       = self.m_save_path + "state.db"
         self.m_regions_fname    = self.m_save_path + "regions"
+        self.m_types_fname      = self.m_save_path + "types"
+        self.m_cache            = CmdCache(self.m_save_path + "cache/")
+        self.m_state            = StateStore(self.m_args_fname, self.m_save_path + "args")
+        self.m_args_saved       = {}                # args as last read/written to m_state
+        self.m_fleet            = FleetRegistry(self.m_state)
         self.m_module_path      = module_path       # path where the modules are 
         self.m_inform_pos       = 0                 # used for spinner
+        self.m_inform_lock      = threading.Lock()  # WaitForReady's probes both spin it
+        self.m_max_parallel_cmds= 4                 # DoCmdParallel, max commands at once
+        self.m_wait_log         = []                # polls done by each Wait.. function
+        self.m_timeline         = Timeline()        # spans, if --timeline 1
+        self.m_cmd_stats        = []                # every cli command run, see DoCmdNoError
+        self.m_cassette         = None              # record/replay transport, see SetTransport
+        self.m_setup_ok         = False             # CSPSetupOK passed, no need to check again
         
             # append to the logfile header
     
         thetime = time.strftime("%c", time.localtime())
         self.Log("\n#\n# %s\n#\n" % thetime)
         
+    def NewCommand(self):
+        ''' resets what's kept for one command, before running the next one on this class '''
+        
+        self.m_args_saved       = {}
+        self.m_wait_log         = []
+        self.m_timeline         = Timeline()
+        self.m_cmd_stats        = []
+        self.m_cassette         = None
+        self.m_cache.m_hits     = 0
+        self.m_cache.m_misses   = 0
+        self.m_cache.m_entries  = {}    # other ncsp's may have invalidated the disk entries
+        
     def CheckSSHKeyFilePath(self, args, extension):
         ''' Builds ssh key file from options, verifies existance '''
         
@@ -144,53 +1042,94 @@ class CSPBaseClass:
     def Log(self, string):
         ''' simple time stamping log function '''
         
+        line = time.strftime("%Y%m%d.%I%M%S: ", time.localtime()) + string + "\n"
         with open(self.m_cmd_fname, "a") as f:
-            f.write(time.strftime("%Y%m%d.%I%M%S: ", time.localtime()))
-            f.write(string)
-            f.write("\n")
+            f.write(line)           # one write, so lines from threads don't get mixed
         f.close()
 
     def ArgSaveToFile(self, args):
-        ''' save all the parser default arguments to a file '''
+        ''' save all the parser default arguments to the state store '''
         
-        if (self.m_args_fname == "" ):
-            return 0                # no file name, used in deleteVM to say don't write back
+        if (getattr(args, "vm_deleted", False)):
+            return 0                # set by deleteVM, this VM's args are gone with it
         
-        vargs = vars(args)          # get whatever "namespace(..)" off args
+        vargs = dict(vars(args))    # get whatever "namespace(..)" off args
+        for key in unsaved_arg_keys:
+            vargs.pop(key, None)    # selectors are for this one command only
         trace(2, vargs)
-
-        with open(self.m_args_fname, "w") as f:
-            json.dump(vargs, f)     # save dictionary as a json file
+        
+            # any VM that exists is kept in the fleet registry too. When one 
+            # was picked with a fleet selector, that's the only place it goes
+            
+        self.FleetSave(args, vargs)
+        if (self.FleetMode(args)):
+            return 0
+        
+            # only write the values this command changed, so that another ncsp
+            # running at the same time doesn't get its changes overwritten
+            
+        changed = {}
+        for key, value in vargs.items():
+            if (key not in self.m_args_saved or self.m_args_saved[key] != value):
+                changed[key] = value
+        if (changed.__len__() > 0):
+            self.m_state.ArgsPut(changed)
+            self.m_args_saved.update(changed)
+        return 0
+    
+    def FleetSave(self, args, vargs=None):
+        ''' adds/updates the VM in the fleet registry if the VM exists, and its NSG '''
+        
+        if (vargs == None):
+            vargs = dict(vars(args))
+            for key in unsaved_arg_keys:
+                vargs.pop(key, None)
+        if (args.nsg_name != None and args.nsg_name != ""):
+            self.m_state.NSGPut(args.region, args.nsg_name, args.nsg_id)
+        if (args.vm_id != None and args.vm_id != "None" and args.vm_id != ""):
+            if (args.command == "createVM"):
+                tags = getattr(args, "tags", None) or []
+            else:
+                tags = None
+            self.m_fleet.Put(args.region, args.vm_name, vargs, tags)
         return 0
+    
+    def FleetMode(self, args):
+        ''' True if fleet VMs were picked with selectors: --vm, --all, --tag '''
+        
+            # with createVM, --tag just tags the new VM, it doesn't select any
+            
+        if (getattr(args, "vm_select", None) or getattr(args, "all_vms", None)):
+            return True
+        if (getattr(args, "vm_count", 0) > 0):
+            return True
+        if (getattr(args, "tags", None) and args.command != "createVM"):
+            return True
+        return False
 
     def ArgRestoreFromFile(self, parser):
-        ''' restores default args in parser if file containing them exists '''
+        ''' restores default args in parser if they were saved in the state store '''
         
-        if (self.m_args_fname == "" ):
-            return 
-         
-        # pull in saved key,values from file, append to provided vargs
-        if os.path.exists(self.m_args_fname):
-            mydict = []   
-            with open(self.m_args_fname, "r") as f:
-                mydict = json.load(f);
-                debug(2, json.dumps(mydict, indent=4, sort_keys=True))
-                
-                for item in mydict.items():
-                    kv = {item[0] : item[1]}        # convert key,value to single item dictionary
-                    parser.set_defaults(**kv)       # update default value for key 
+        # pull in saved key,values from store, append to provided vargs
+        mydict = self.m_state.ArgsGet()
+        self.m_args_saved = mydict
+        if (mydict.__len__() > 0):
+            debug(2, json.dumps(mydict, indent=4, sort_keys=True))
+            
+            for item in mydict.items():
+                kv = {item[0] : item[1]}        # convert key,value to single item dictionary
+                parser.set_defaults(**kv)       # update default value for key 
             return 0
         return 1
  
     
     def ArgShowFile(self):
-        ''' displays peristent args file '''
+        ''' displays peristent args '''
         
         print ("# %s" % self.m_args_fname)
-        if os.path.exists(self.m_args_fname):
-            with open(self.m_args_fname, "r") as f:
-                mydict = json.load(f);
-                print json.dumps(mydict, indent=4, sort_keys=True)
+        mydict = self.m_state.ArgsGet()
+        if (mydict.__len__() > 0):
+            print json.dumps(mydict, indent=4, sort_keys=True)
         else:
             print ("# does not exist")
         
@@ -201,19 +1140,33 @@ class CSPBaseClass:
         
             # prevent problem if host reuses the IP address in a later VM
             
+        self.SshMuxClose(args)
         self.DeleteIPFromSSHKnownHostsFile(args)
+        
+            # VM is gone, or its args are stale -- either way drop it from fleet
+            
+        if (args.vm_id != None and args.vm_id != "None" and args.vm_id != ""):
+            self.m_fleet.Remove(args.region, args.vm_name, args.vm_id)
 
-            # remove the persistent args
+            # remove the persistent args, if acting on fleet VM(s), only
+            # when it's the same VM that's in the args
             
-        if (self.m_args_fname != "" ):
-            if (os.path.exists(self.m_args_fname)):
-                os.remove(self.m_args_fname);  
+        if (self.FleetMode(args)):
+            self.m_state.ArgsClear(args.vm_id)
+        else:
+            self.m_state.ArgsClear()
+        self.m_args_saved = {}      # may be gone from the store now, either way
                 
-            # remove cached list of CSP's regions
+            # remove cached list of CSP's regions, and of its instance types.
+            # Fleet VMs are deleted on several threads at once, any of them
+            # may have removed them already
             
-        if (self.m_regions_fname != "" ):
-            if (os.path.exists(self.m_regions_fname)):
-                os.remove(self.m_regions_fname); 
+        for fname in (self.m_regions_fname, self.m_types_fname):
+            try:
+                os.remove(fname)
+            except OSError, err:
+                if (err.errno != errno.ENOENT):
+                    raise
         
         return 0
                          
@@ -223,17 +1176,16 @@ class CSPBaseClass:
         if (True):     # depends on trace level?
             myclock = [ "|", "/", "-", "\\" ] 
             
-            if (self.m_inform_pos > 3):
-                self.m_inform_pos = 0       # restart back at beginning of 'clock' array
+            with self.m_inform_lock:
+                self.m_inform_pos = (self.m_inform_pos + 1) % myclock.__len__()
                 
-                # azure has a space char before the clock char for the prompt to sit on
-                # emulate that look here
+                    # azure has a space char before the clock char for the prompt to sit on
+                    # emulate that look here
                 
-            sys.stdout.write(" %s %s ..                        \r" % (myclock[self.m_inform_pos], info))
-            if (trace_do(1)):
-                sys.stdout.write("\n")      # if tracing, go to new line
-            sys.stdout.flush()
-            self.m_inform_pos += 1
+                sys.stdout.write(" %s %s ..                        \r" % (myclock[self.m_inform_pos], info))
+                if (trace_do(1)):
+                    sys.stdout.write("\n")  # if tracing, go to new line
+                sys.stdout.flush()
         else:
             print info    
             
@@ -259,24 +1211,275 @@ class CSPBaseClass:
 
         debug(1, cmd)
         
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output, errval = child.communicate()                # returns data from stdout, stderr
+        start  = g_clock.Now()
+        family = self.CmdFamily(cmd)
+        if (self.Replaying()):
+            retcode, output, errval = self.m_cassette.Play(cmd, family)
+        elif (self.m_cassette != None):
+                # recording, grab stderr for the cassette, but pass it on to
+                # the user and not back to the caller -- same as when live
+            child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, stderr = child.communicate()
+            sys.stderr.write(stderr)
+            retcode, errval = child.returncode, None
+            self.m_cassette.Record(cmd, family, g_clock.Epoch(start), g_clock.Now() - start, retcode, output, stderr)
+        elif (sys.stderr is sys.__stderr__):
+            child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            output, errval = child.communicate()            # returns data from stdout, stderr
+            retcode = child.returncode
+        else:
+                # sys.stderr isn't our fd 2 (ncspd sends it to the client), the
+                # cli's stderr has to be passed on to it, else it's lost
+            child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, stderr = child.communicate()
+            sys.stderr.write(stderr)
+            retcode, errval = child.returncode, None
+        
+        debug(3, output)
+        
+            # anything that changes a resource makes our cached queries
+            # about that type of resource out of date
+            
+        self.m_timeline.Span(family, "cmd", start, g_clock.Now(), { "cmd": cmd, "rc": retcode })
+        if (self.CmdReadOnly(family) == False):
+            self.m_cache.Invalidate(self.CmdResource(family))
+            
+            # account for every cli command that is run, for --stats and the cmds log
+            
+        self.CmdStat(cmd, family, start, retcode, output, False)
+        
+        return (retcode, output, errval)                    # pass back retcode, stdout, stderr
+    
+    def SetTransport(self, mode, fname, scale):
+        ''' how cli commands are run: "live", or "record"/"replay" to/from a cassette file '''
+        
+            # replayed VMs aren't real, their args and fleet are kept apart
+            # from the live ones, in their own throwaway state store
+            
+        if (mode == "replay"):
+            self.UseStateStore(self.m_save_path + "replay.db", None)
+        else:
+            self.UseStateStore(self.m_args_fname, self.m_save_path + "args")
+            
+        if (mode == "live"):
+            self.m_cassette = None
+            return 0
+        if (fname == None or fname == ""):
+            fname = self.m_log_path + "cassette.jsonl"
+        if (mode == "replay" and not os.path.exists(fname)):
+            error("No cassette \"%s\" to replay" % fname)
+            return 1
+        self.m_cassette = Cassette(os.path.expanduser(fname), mode, scale)
+        return 0
+    
+    def UseStateStore(self, fname, old_args_fname):
+        ''' points args, fleet and nsgs at the state database fname '''
+        
+        if (self.m_state.m_fname == fname):
+            return
+        self.m_state        = StateStore(fname, old_args_fname)
+        self.m_fleet        = FleetRegistry(self.m_state)
+        self.m_args_saved   = {}
+    
+    def Replaying(self):
+        ''' True if cli commands are played back from a cassette, and not run '''
+        
+        return self.m_cassette != None and self.m_cassette.Replaying()
+  
+    def DoCmd(self, cmd):
+        ''' Blocking command -- returns command output'''
+ 
+        retcode, output, errval = self.DoCmdNoError(cmd)    # Do the work
+        
+        if retcode != 0:                                    # report any error
+            if (trace_do(1) == False):                      # if we have tracing on >=1, already printed cmd
+                print("cmd:  %s" % cmd)
+            print("errval: \"%s\" child.returncode %d" % (errval, retcode))  # debug
+
+        return (retcode, output, errval)                    # pass back retcode, stdout, stderr
+    
+    ##############################################################################
+    # DoCmdStream
+    #
+    # Runs the command, writing its stdout and stderr to ours as they come, and
+    # both to the tee file if given. Only the last stream_keep bytes of each are
+    # held, so hours of output (or a big log dump) don't pile up in memory
+    #
+    # A cassette holds whole outputs, so while recording or replaying the 
+    # output is written after the command is done, see DoCmdNoError
+    #
+    # Returns: retcode, last part of stdout, last part of stderr
+    #
+    def DoCmdStream(self, cmd, tee_fname=None):
+        ''' Blocking command -- passes on output as it comes, returns the tail end of it '''
+        
+        tee = None
+        if (tee_fname != None and tee_fname != ""):
+            tee = open(os.path.expanduser(tee_fname), "a")
+        
+        if (self.m_cassette != None):
+            retcode, output, errval = self.DoCmdNoError(cmd)
+            for f in [ sys.stdout, tee ]:
+                if (f != None):
+                    f.write(output)
+            if (tee != None):
+                tee.close()
+            return retcode, output[-stream_keep:], errval
+        
+        debug(1, cmd)
+        
+        start  = g_clock.Now()
+        family = self.CmdFamily(cmd)
+        child  = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        outs   = { child.stdout.fileno(): sys.stdout, child.stderr.fileno(): sys.stderr }
+        kept   = { child.stdout.fileno(): "",         child.stderr.fileno(): "" }
+        nbytes = 0
+        while (outs.__len__() > 0):
+            ready, unused, unused = select.select(outs.keys(), [], [])
+            for fd in ready:
+                data = os.read(fd, stream_chunk)
+                if (data == ""):
+                    del outs[fd]                                # closed, the end of it
+                    continue
+                for f in [ outs[fd], tee ]:
+                    if (f != None):
+                        f.write(data)
+                        f.flush()
+                kept[fd] = (kept[fd] + data)[-stream_keep:]
+                if (fd == child.stdout.fileno()):
+                    nbytes += data.__len__()
+        child.wait()
+        if (tee != None):
+            tee.close()
+        
+        self.m_timeline.Span(family, "cmd", start, g_clock.Now(), { "cmd": cmd, "rc": child.returncode })
+        self.CmdStat(cmd, family, start, child.returncode, None, False, nbytes)
+        return child.returncode, kept[child.stdout.fileno()], kept[child.stderr.fileno()]
+    
+    def DoCmdCached(self, cmd):
+        ''' Blocking read-only query command -- returns cached output if it's still fresh '''
+        
+            # how long output can be reused depends on the type of command, 
+            # see CacheTTL(). Only successful output is saved
+            
+        family = self.CmdFamily(cmd)
+        ttl    = self.CacheTTL(family)
+        if (self.m_cassette != None):
+            ttl = 0                 # recording or replaying, every command goes to the cassette
+        if (ttl > 0):
+            result = self.m_cache.Get(cmd)
+            if (result != None):
+                debug(1, "cached: %s" % cmd)
+                self.CmdStat(cmd, family, g_clock.Now(), result[0], result[1], True)
+                return result
+        
+        retcode, output, errval = self.DoCmd(cmd)
+        if (retcode == 0 and ttl > 0):
+            self.m_cache.Put(cmd, self.CmdResource(family), ttl, (retcode, output, errval))
+        return (retcode, output, errval)                    # pass back retcode, stdout, stderr
+        
+    def CmdStat(self, cmd, family, start, rc, output, cached, nbytes=0):
+        ''' records a command's family, start time, duration, rc, and size of its output '''
+        
+        secs   = g_clock.Now() - start
+        if (output != None):
+            nbytes = output.__len__()
+        self.m_cmd_stats.append({ "family": family, "start": start, "secs": secs, 
+                                  "rc": rc, "bytes": nbytes, "cached": cached })
+        if (not cached):
+            self.Log("%s  # %s start:%s.%03d secs:%.3f rc:%d bytes:%d" % 
+                     (cmd, family, time.strftime("%H:%M:%S", time.localtime(g_clock.Epoch(start))), 
+                      int((g_clock.Epoch(start) % 1) * 1000), secs, rc, nbytes))
+        
+    # CmdFamily
+    #
+    # Short label for the type of command, the CLI's service and operation
+    # names. "aws ec2 describe-images --region.." is "ec2.describe-images" and
+    # "aliyuncli ecs DescribeImages --RegionId.." is "ecs.DescribeImages". Local
+    # tools like ssh and ping are simply their program name
+    #
+    # CSPs whose CLI's don't follow "cli service operation" override this
+    #
+    def CmdFamily(self, cmd):
+        ''' returns command type label, like 'ec2.describe-instances' '''
+        
+        tokens = cmd.split()
+        if (tokens.__len__() == 0):
+            return ""
+        prog = os.path.basename(tokens[0])
+        if (prog in local_cmds):
+            return prog
+        words = []
+        for token in tokens[1:]:
+            if (token[0:1] == '-'):
+                break                                       # options start here
+            words.append(token)
+        if (words.__len__() < 2):
+            return prog                                     # not a "cli service operation" 
+        return '.'.join(words[0:2])
+    
+    def CmdReadOnly(self, family):
+        ''' true if command type only looks at things, doesn't change them '''
+        
+        if (family in local_cmds):
+            return True
+        verb = family[family.rfind('.')+1:].lower().replace('-', '')
+        for prefix in readonly_verbs:
+            if (verb.startswith(prefix)):
+                return True
+        return False
+    
+    def CmdResource(self, family):
+        ''' type of resource a command works on, 'ec2.create-security-group' is 'securitygroup' '''
+        
+        if (family in local_cmds or family == ""):
+            return ""
+        words = family.lower().replace('-', '').split('.')
+        name  = words[-1]
+        for verb in readonly_verbs + mutating_verbs:
+            if (name.startswith(verb)):
+                name = name[len(verb):]                     # remove the verb
+                break
+        if (name == "" and words.__len__() > 1):            # "instances.create" form
+            name = words[-2]
+        for suffix in ["status", "ingress", "egress", "s"]:
+            if (name.endswith(suffix)):
+                name = name[:-len(suffix)]
+        return name
+    
+    def CacheTTL(self, family):
+        ''' returns seconds that output of a type of command can be reused, 0 is never '''
         
-        debug(3, output)
+            # from the CSP module's default_cache_ttl, keyed by CmdFamily
+            
+        return self.CSPDefaults("default_cache_ttl").get(family, 0)
+    
+    def CSPDefaults(self, name):
+        ''' the CSP module's dict called 'name', like default_cache_ttl, {} if it has none '''
         
-        return (child.returncode, output, errval)           # pass back retcode, stdout, stderr
-  
-    def DoCmd(self, cmd):
-        ''' Blocking command -- returns command output'''
- 
-        retcode, output, errval = self.DoCmdNoError(cmd)    # Do the work
+        return getattr(sys.modules[self.__class__.__module__], name, {})
+    
+    def DoCmdStart(self, cmd):
+        ''' Non-blocking command -- starts cmd, returns task. task.Wait() returns DoCmd values '''
         
-        if retcode != 0:                                    # report any error
-            if (trace_do(1) == False):                      # if we have tracing on >=1, already printed cmd
-                print("cmd:  %s" % cmd)
-            print("errval: \"%s\" child.returncode %d" % (errval, retcode))  # debug
-
-        return (retcode, output, errval)                    # pass back retcode, stdout, stderr
+        task = BackgroundTask(self.DoCmd, cmd)
+        task.start()
+        return task
+    
+    def DoCmdParallel(self, cmds, max_workers=0):
+        ''' runs a list of independent commands concurrently, returns list of DoCmd values '''
+        
+            # only for commands that don't depend on each other -- order that 
+            # they get run (and finish) in is not defined. Results come back in
+            # the same order as the commands were given
+            
+        if (max_workers <= 0):
+            max_workers = self.m_max_parallel_cmds
+        tasks = []
+        for cmd in cmds:
+            tasks.append((self.DoCmd, (cmd,)))
+        return run_parallel(tasks, max_workers)
     
         # DeleteIPFromSSHKnownHostsFile
     #
@@ -328,8 +1531,41 @@ class CSPBaseClass:
         if (args.vm_ip == ""):
             return retcode, stdoutstr, stderrstr
         
+        cmd = self.SshCommand(args, argv, "")
+                    
+        llen = argv.__len__()
+        if llen == 0:
+            if (sys.stdout is not sys.__stdout__):      # in ncspd, no terminal to give it
+                error("interactive ssh can't be run by ncspd, only by ncsp itself")
+                return retcode, stdoutstr, stderrstr
+            subprocess.call(cmd, shell=True)
+        elif (doprint and getattr(args, "stream", 0) != 0):
+            
+                # add-hoc cmd from user, pass its output on as it comes, 
+                # rather than all at once when it finishes
+                
+            retcode, stdoutstr, stderrstr = self.DoCmdStream(cmd, getattr(args, "tee", None))
+        else:
+                # common errcode, stdout, stderr return from running the command
+               
+            retcode, stdoutstr, stderrstr = self.DoCmd(cmd)
+            
+                # requested to print it?  (do this for add-hoc cmds from user)
+                
+            if doprint:
+                print stdoutstr
+                
+            # return the values, so parser code can play with it
+            
+        return retcode, stdoutstr, stderrstr
+    
+    def SshCommand(self, args, argv, options):
+        ''' builds ssh command line to run argv on the VM, with any extra ssh options '''
+        
         cmd = "ssh" 
         # cmd += " -oStrictHostKeyChecking=no"  # did when started earler, should not be needed here
+        cmd += self.SshMuxOptions(args)         # reuse VM's ssh connection
+        cmd += options
             
             # ssh keyfile -- which may not be needed in all cases. Only put it here (with -i) 
             # if it's supplied. 
@@ -344,9 +1580,7 @@ class CSPBaseClass:
             # add additional user supplied args to command string
                     
         llen = argv.__len__()
-        if llen == 0:
-            subprocess.call(cmd, shell=True)
-        else:
+        if llen > 0:
             # print "llen=%d" % llen
             
             cmd += " "       # make sure there's space after last token on cmd string
@@ -362,19 +1596,55 @@ class CSPBaseClass:
             for i in range(0, llen):
                 cmd += argv.__getitem__(i)
                 cmd += " "
-           
-                # common errcode, stdout, stderr return from running the command
-               
-            retcode, stdoutstr, stderrstr = self.DoCmd(cmd)
-            
-                # requested to print it?  (do this for add-hoc cmds from user)
-                
-            if doprint:
-                print stdoutstr
-                
-            # return the values, so parser code can play with it
-            
-        return retcode, stdoutstr, stderrstr
+        return cmd
+    
+    ##############################################################################
+    # SshStream
+    #
+    # Runs a command on the VM like Ssh(), but hands each line of its output 
+    # (stdout and stderr together) to online(line) as soon as it comes, rather 
+    # than all of it at the end. Used by sshall to show many VMs at once. ssh
+    # won't ask for a password, and gives up if it can't connect in 10 seconds
+    #
+    # A cassette holds whole outputs, so while recording or replaying the
+    # output is passed on after the command is done, see SshBuffered
+    #
+    # Returns: retcode
+    #
+    def SshStream(self, args, argv, online):
+        ''' runs command on VM, calling online(line) for each output line as it comes '''
+        
+        if (self.CheckID(args) == False or args.vm_ip == ""):
+            return 1
+        if (self.m_cassette != None):
+            return self.SshBuffered(args, argv, online)
+        
+        cmd = self.SshCommand(args, argv, " -o BatchMode=yes -o ConnectTimeout=10")
+        debug(1, cmd)
+        
+        start  = g_clock.Now()
+        family = self.CmdFamily(cmd)
+        child  = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(child.stdout.readline, ""):
+            online(line.rstrip("\r\n"))
+        child.wait()
+        
+        self.m_timeline.Span(family, "cmd", start, g_clock.Now(), { "cmd": cmd, "rc": child.returncode })
+        self.CmdStat(cmd, family, start, child.returncode, None, False)
+        return child.returncode
+    
+    def SshBuffered(self, args, argv, online):
+        ''' SshStream done with Ssh(), output lines given to online(line) when it's finished '''
+        
+        retcode, stdoutstr, stderrstr = self.Ssh(args, False, argv)
+        for line in (stdoutstr or "").splitlines() + (stderrstr or "").splitlines():
+            online(line)
+        return retcode
+    
+    def MaxParallelSsh(self):
+        ''' most VMs sshall runs a command on at the same time '''
+        
+        return default_max_parallel_ssh
     
     def Ping(self, args):
         if (args.pingable == 0):
@@ -415,35 +1685,73 @@ class CSPBaseClass:
         else:
             return 1     # not what we want
     
+    def PollSettings(self, kind):
+        ''' returns (initial, factor, cap, jitter) polling values for the kind of wait '''
+        
+            # the CSP module's default_poll_policies first, then the ones here.
+            # In each, "status.running" falls back to "status"
+            
+        for policies in (self.CSPDefaults("default_poll_policies"), default_poll_policies):
+            if (kind in policies):
+                return policies[kind]
+            if (kind.split('.')[0] in policies):
+                return policies[kind.split('.')[0]]
+        return default_poll_policies["status"]              # a new kind of wait, poll like status
+    
+    def GetPollPolicy(self, kind):
+        ''' returns a new PollPolicy for the kind of wait: "status.<value>", "ping.<up|down>", "ssh" '''
+        
+        initial, factor, cap, jitter = self.PollSettings(kind)
+        policy = PollPolicy(kind, initial, factor, cap, jitter)
+        if (self.m_timeline.Enabled()):
+            policy.m_timeline = self.m_timeline
+        return policy
+    
+    def WaitDone(self, policy, start, rc):
+        ''' records how many polls a wait took, and how long '''
+        
+        end  = g_clock.Now()
+        secs = end - start
+        self.m_wait_log.append({ "wait": policy.m_name, "polls": policy.m_polls, "secs": secs, "rc": rc })
+        self.m_timeline.Span(policy.m_name, "wait", start, end, { "polls": policy.m_polls, "rc": rc })
+        debug(1, "wait %s: %d polls %.2f secs rc:%d" % (policy.m_name, policy.m_polls, secs, rc))
+        
     def WaitForRunStatus(self, args, value, timeout):
         ''' waits for status state to be value '''
         
-        now   = time.time() # floating point number
+        policy = self.GetPollPolicy("status.%s" % value.lower())
+        start = g_clock.Now()
+        now   = start           # floating point number
         end   = now + timeout
         rc    = self.CheckRunStatus(args, value)
         
         while (rc != 0 and now < end): 
-            time.sleep(0.5)                             # Wait time
+            policy.Sleep(end - now)                     # Wait time, backs off
             rc  = self.CheckRunStatus(args, value)      # want to be value, returns 0 if is
-            now = time.time()                           # floating point number for time
+            now = g_clock.Now()                         # floating point number for time
 
         if (rc != 0):
             error ("Timeout " + value)
             
+        self.WaitDone(policy, start, rc)
         return rc       # True for got status=='value' within timeout, False if not
     
 
-    def WaitForPing(self, args, state, timeout):
+    def WaitForPing(self, args, state, timeout, cancel=None):
         ''' Attempts to Ping, or not to Ping VM, waits till get a response '''
         ''' Note: VM's may not support ping see args.pingable flag '''    
+        ''' Gives up early, returning 1, if optional cancel Event gets set '''
         
-        now   = time.time()         # floating point number
+        if (state == True):
+            policy = self.GetPollPolicy("ping.up")
+        else:
+            policy = self.GetPollPolicy("ping.down")
+        start = g_clock.Now()
+        now   = start               # floating point number
         end   = now + timeout
-        ip    = args.vm_ip
-        cmd   = "ping -c 1 -W 1 "
-        cmd  += ip
+        cmd   = "ping -c 1 -W 1 %s" % args.vm_ip
         
-        retcode, output, errval = self.DoCmdNoError(cmd)
+        retcode, output, errval = self.PingOnce(args)
         
         if (retcode == 0):
             pingable = True   # wait till can ping
@@ -454,41 +1762,75 @@ class CSPBaseClass:
        
             # can check here if pingable (state == True) or not-pingable (state == False)
             
-        while (pingable != state and now < end): 
+        while (pingable != state and now < end and not (cancel and cancel.is_set())): 
             self.Inform(info)
-            time.sleep(0.5)                     # Wait time
+            policy.Sleep(end - now, cancel)     # Wait time, backs off
             
-            retcode, output, errval = self.DoCmdNoError(cmd)
+            retcode, output, errval = self.PingOnce(args)
             if (retcode == 0):
                 pingable = True   # wait till can ping
             else:
                 pingable = False            
-            now = time.time() # floating point number
+            now = g_clock.Now() # floating point number
         
         if (pingable == state):     # response from ping-cmd is expected state
             # print "PING SUCCESSFUL: \"%s\"" % cmd
+            self.WaitDone(policy, start, 0)
             return(0)               # 0 returned for success -- is pingable
         else:
-            if (now > end):
+            if (cancel and cancel.is_set()):
+                pass                # caller no longer cares, nothing to report
+            elif (now > end):
                 error ("Ping: Timeout %s" %(cmd))
             else:
-                error ("Ping: Failed \"%s\"\n" %(cmd, errval))
+                error ("Ping: Failed \"%s\"\n%s" %(cmd, errval))
+            self.WaitDone(policy, start, 1)
             return(1)               # 1 returned for failure, not pingable
     
-    def WaitTillCanSSH(self, args, sshcmd, timeout): 
-        ''' Spins till gets a ssh response from the VM '''
+    def PingOnce(self, args):
+        ''' one ping of the VM, returns (retcode, stdout, stderr) of it '''
+        
+        return self.DoCmdNoError("ping -c 1 -W 1 %s" % args.vm_ip)
+    
+    def WaitTillCanSSH(self, args, sshcmd, timeout, cancel=None): 
+        ''' Spins till gets a ssh response from the VM, or cancel Event is set '''
         
-        # Ssh-ability is not really poll-able -- doesn't return till either timeout
-        #        or success, meaning that there is no Inform notifier updates
-        #        occuring if booting, and waiting for OS to come up..
-        # The best solution is to have ping response to VM working, so 
-        # this step really isn't an issue
+        # Ssh-ability itself is not really poll-able -- a ssh doesn't return till 
+        #        either timeout or success, and forks a process each try. So
+        #        first poll (cheaply) for the ssh server's banner on port 22, and
+        #        only once that's answering, confirm with a real ssh command
         
-        now   = time.time()         # floating point number
+        start = g_clock.Now()
+        now   = start               # floating point number
         end   = now + timeout
         
+            # First, in-process, wait till a ssh server answers on the VM. This
+            # is cheap, so can be done often without forking a ssh each time
+            
+        policy = self.GetPollPolicy("ssh.banner")
+        banner = self.ProbeSSH(args, min(2, end - now))
+        while (banner == None and now < end and not (cancel and cancel.is_set())):
+            self.Inform("wait for ssh port %d" % policy.m_polls)
+            policy.Sleep(end - now, cancel)         # Wait time, backs off
+            now    = g_clock.Now()
+            banner = self.ProbeSSH(args, max(0.1, min(2, end - now)))
+            
+        if (banner == None):
+            self.WaitDone(policy, start, 1)
+            if (not (cancel and cancel.is_set())):
+                error ("SSH Timeout: no ssh server answering on %s" % args.vm_ip)
+            return(1)
+        self.WaitDone(policy, start, 0)
+        debug(2, "ssh server: %s" % banner)
+        
+            # Then do a real ssh command to confirm. Server may be answering
+            # before the user or keys are set up, so may still need to wait
+            
+        policy = self.GetPollPolicy("ssh")
+        
         cmd   = "ssh -oStrictHostKeyChecking=no "   # allow to be added to /.ssh/known_hosts
         cmd  += "-o ConnectTimeout=2 "              # quicker timeout, see clock move
+        cmd  += self.SshMuxOptions(args) + " "      # once up, becomes connection for later ssh's
         
             # ssh keyfile -- which may not be needed in all cases. 
             # Only put it here (with -i) if it's supplied. 
@@ -499,30 +1841,140 @@ class CSPBaseClass:
         cmd  += sshcmd                              # the ssh command we want to run
         cmd  += " 2> /dev/null"                     # don't want to see stderr msgs
             
-        retcode, output, errval = self.DoCmdNoError(cmd)
+        retcode, output, errval = self.SshCheck(args, cmd)
        
         cnt = 0
-        while (retcode != 0 and now < end): 
+        while (retcode != 0 and now < end and not (cancel and cancel.is_set())): 
             cnt = cnt + 1
             self.Inform("wait for ssh-able %d" % cnt)
-            time.sleep(1)                     # Wait time
-            retcode, output, errval = self.DoCmdNoError(cmd)
-            now = time.time() # floating point number
+            policy.Sleep(end - now, cancel)         # Wait time, backs off
+            retcode, output, errval = self.SshCheck(args, cmd)
+            now = g_clock.Now() # floating point number
         
+        self.WaitDone(policy, start, retcode)
         if (retcode == 0):      # response from ping-cmd is 0 if able to ping
             # print "SSH  SUCCESSFUL: \"%s\"" % cmd
             return(0)           # 0 returned for success
         else: 
-            if (now > end):
+            if (cancel and cancel.is_set()):
+                pass            # caller no longer cares, nothing to report
+            elif (now > end):
                 error ("SSH Timeout: \"%s\"" %(cmd))
             else:
                 error ("SSH Failed: : \"%s\"\n%s" %(cmd, errval))
             return(1)           # 1 returned for timeout, can't ssh
     
+    def SshCheck(self, args, cmd):
+        ''' runs the ssh command that says the VM can be ssh'ed into, returns (retcode, stdout, stderr) '''
+        
+        return self.DoCmdNoError(cmd)
+    
+    def SSHPort(self, args):
+        ''' port the VM's ssh server is on '''
+        
+        return 22
+    
+    ##############################################################################
+    # SSH connection multiplexing
+    #
+    # The first ssh to a VM starts a master connection (ssh ControlMaster=auto) 
+    # which listens on a unix socket, named for the user, ip and port. Later ssh 
+    # commands to the VM run over it, skipping the tcp connect, key exchange and 
+    # authentication. ssh itself exits the master after --ssh_persist seconds of 
+    # no use, and Clean() (deleteVM, clean) stops it right away
+    #
+    # The socket is kept under ~/ncsp/, where no other user can get at it
+    #
+    def SshControlPath(self, args):
+        ''' unix socket name for VM's master ssh connection, None if ~/ncsp/ path is too long '''
+        
+        name = "%s@%s:%d" % (args.user, args.vm_ip, self.SSHPort(args))
+        path = self.m_save_path + "ssh/"
+        
+            # unix socket names are limited to ~104 characters, and ssh adds 
+            # 17 more while making it. So like ssh's own %C, the socket is
+            # named with a hash of the user, ip and port, which is short
+            
+        name = hashlib.sha1(name).hexdigest()[0:16]
+        if (len(path) + len(name) > 80):
+            debug(1, "no ssh multiplexing, %s is too long for a socket name" % path)
+            return None
+        if os.path.isdir(path) == False:
+            os.makedirs(path, 0700)
+        return path + name
+    
+    def SshMuxOptions(self, args):
+        ''' ssh options to share one connection to the VM, or "" if --ssh_persist 0 '''
+        
+        persist = getattr(args, "ssh_persist", default_ssh_persist)
+        if (persist <= 0 or self.Replaying()):
+            return ""
+        path = self.SshControlPath(args)
+        if (path == None):
+            return ""
+        
+        opts  = " -o ControlMaster=auto"
+        opts += " -o ControlPath=%s" % path
+        opts += " -o ControlPersist=%d" % persist  # idle secs till master exits
+        return opts
+    
+    def SshMuxClose(self, args):
+        ''' stops the VM's master ssh connection, if there is one '''
+        
+        if (args.vm_ip == "" or args.vm_ip == None or args.vm_ip == "None"):
+            return 0
+        
+        path = self.SshControlPath(args)
+        if (path == None or os.path.exists(path) == False):
+            return 0
+        
+        cmd = "ssh -o ControlPath=%s -O exit %s@%s" % (path, args.user, args.vm_ip)
+        retcode, output, errval = self.DoCmdNoError(cmd)
+        if (retcode != 0 and os.path.exists(path)):
+            os.remove(path)                         # master is gone, socket left behind
+        return 0
+    
+    def ProbeSSH(self, args, timeout):
+        ''' returns VM's ssh server banner if it's answering, None if not '''
+        
+        if (args.vm_ip == "" or args.vm_ip == None or args.vm_ip == "None"):
+            return None
+        
+            # the probe isn't a cli command, but it's recorded/replayed as if 
+            # it was one, so that replayed ssh waits go the same way
+            
+        port  = self.SSHPort(args)
+        probe = "probe-ssh %s:%d" % (args.vm_ip, port)
+        if (self.Replaying()):
+            rc, banner, errval = self.m_cassette.Play(probe, "probe-ssh")
+            if (rc != 0):
+                return None
+            return banner
+        start  = g_clock.Now()
+        banner = probe_ssh_banner(args.vm_ip, port, timeout)
+        if (self.m_cassette != None):
+            self.m_cassette.Record(probe, "probe-ssh", g_clock.Epoch(start), g_clock.Now() - start, 
+                                   0 if banner != None else 1, banner or "", None)
+        return banner
+    
+    def Accepted(self, args, request):
+        ''' marks when the CSP accepted a "create", "start" or "reboot", before any polling '''
+        
+            # on the timeline, the request's cmd span up to here is the api 
+            # call, and from here till "running" the CSP provisioning the VM
+            
+        self.m_timeline.Mark("%s accepted" % request, "vm", None, { "vm_id": args.vm_id })
+        
     def WaitTillRunning(self, args, value, timeout):
         ''' called after launch, waits till can get IP from running instance '''
         ''' value is "Running" for alibaba, or "running" for aws -- case dependent '''
         
+            # one overall deadline for all the steps below, rather than each
+            # step getting its own full timeout
+            
+        end = g_clock.Now() + timeout
+        self.m_timeline.Mark("instance id", "vm", None, { "vm_id": args.vm_id })
+        
             # initially right after 'start', status will be 'pending'
             # wait till we get to a status value of 'running'
                
@@ -537,30 +1989,99 @@ class CSPBaseClass:
             # case, don't leave this step till have the IP address to the VM. 
             # NOTE: the VM is not up enough to respond to the IP, it's still booting
             
+        start = g_clock.Now()
         rc = self.GetIPSetupCorrectly(args)     # CSP specific way to get IP address 
+        self.m_timeline.Span("ip", "wait", start, g_clock.Now(), { "vm_ip": args.vm_ip, "rc": rc })
         if (rc != 0):                           # may have been done in Create for some CSPs
             return rc
         
-            # make sure we can ping -- this takes a few seconds after the kernel boots 
-            # for the network to come up to return pings. 
-            # pinging might not be enabled in network config for CSP
+        if (g_clock.Now() >= end):
+            error("Timeout waiting for VM to come up")
+            return 1
+        
+            # ping and ssh are probed at the same time, see WaitForReady 
+            
+        rc = self.WaitForReady(args, end)
+        if (rc == 0 and self.m_timeline.Enabled()):
+            self.BootTimeSpans(args)            # how much of that was the VM booting
+        return rc                               # 0: success, running - 1:fail, not running
+    
+    def BootTimeSpans(self, args):
+        ''' adds the VM's kernel and userspace boot times to the timeline '''
+        
+            # systemd-analyze gives how long the boot took, /proc/uptime when
+            # it started (as seconds ago). Not fatal if either doesn't work 
+            
+        rc, kernel, user, total = self.KernelBootTime(args)
+        if (rc != 0):
+            return rc
+        retcode, stdoutstr, stderrstr = self.Ssh(args, False, ["cat /proc/uptime"])
+        now = g_clock.Now()
+        try:
+            kernel = float(kernel.rstrip("s"))
+            user   = float(user.rstrip("s"))
+            boot   = now - float(stdoutstr.split()[0])
+        except (ValueError, IndexError, AttributeError):
+            error("Could not get boot times from \"%s\" \"%s\"" % (kernel, stdoutstr))
+            return 1
+        self.m_timeline.Span("boot.kernel",    "vm", boot,          boot + kernel)
+        self.m_timeline.Span("boot.userspace", "vm", boot + kernel, boot + kernel + user)
+        return 0
+    
+    def TimedWait(self, func, *args):
+        ''' runs one of the Wait.. functions, returns its rc and the time it finished '''
+        
+        rc = func(*args)
+        return rc, g_clock.Now()
+    
+    def WaitForReady(self, args, end):
+        ''' probes ping and ssh concurrently till ssh works, or deadline 'end' is hit '''
         
+            # A ping response comes a few seconds after the kernel boots, ssh a bit 
+            # after that -- but there is no reason to hold off trying ssh till ping 
+            # works. Start both in the background, ssh success is what says the VM 
+            # is ready. Ping is just informational, and may not even be enabled in 
+            # the network config for the CSP (see args.pingable)
+            #
+            # Note that this might be the first time we ssh with the given IP, so the
+            # known_host files may not have it. WaitTillCanSSH handles that so user 
+            # isn't prompted.
+            
+        start   = g_clock.Now()
+        cancel  = threading.Event()         # tells the ping probe when to give up
+        ssh     = BackgroundTask(self.TimedWait, self.WaitTillCanSSH, args, "uname -a", end - start)
+        ping    = None
+        ssh.name = "wait ssh"               # for the timeline's tracks
+        ssh.start()
         if (args.pingable != 0):
-            rc = self.WaitForPing(args, True, timeout)
-            if (rc != 0):
-                return rc                      # returns 1 - not pingable
+            ping = BackgroundTask(self.TimedWait, self.WaitForPing, args, True, end - start, cancel)
+            ping.name = "wait ping"
+            ping.start()
         
-            # See if we can ssh this beast. Note that this might be the first time
-            # we do so with the given IP, so the known_host files may not have it.
-            # this function handles that so user isn't prompted.
-            #
-            # spins, waiting for SSH to work
-
-        rc = self.WaitTillCanSSH(args, "uname -a", timeout)
-        if (rc != 0):
-            return rc                          # returns 1 - could not ssh
+        rc, ssh_done = ssh.Wait()
+        cancel.set()                        # ssh worked or timed out, ping no longer matters
+        
+        signals = [ ("ssh", rc, ssh_done) ]
+        if (ping != None):
+            ping_rc, ping_done = ping.Wait()
+            signals.append(("ping", ping_rc, ping_done))
+            
+            # which signal got there first?
+            
+        arrived = sorted([ (done, name) for name, src, done in signals if src == 0 ])
+        if (arrived.__len__() > 0):
+            first = arrived[0][1]
+        else:
+            first = "none"
+        secs = g_clock.Now() - start
+        self.m_wait_log.append({ "wait": "ready", "first": first, "secs": secs, "rc": rc,
+                                 "signals": [ { "name": name, "rc": src, "secs": done - start } for name, src, done in signals ] })
+        for done, name in arrived:
+            debug(1, "ready: %-4s after %.2f secs" % (name, done - start))
+            self.m_timeline.Mark("first %s" % name, "vm", done)
+        debug(1, "ready: first signal was %s, rc:%d" % (first, rc))
         
-        return 0                               # 0: success, running - 1:fail, not running
+        return rc                              # 0: success, running - 1:fail, not running
     
     def KernelBootTime(self, args):
         ''' ask VM for kernel boot time '''
@@ -571,7 +2092,7 @@ class CSPBaseClass:
         rc = self.WaitTillCanSSH(args, "uname -a", 10)
         if (rc != 0):
             error("Could not ssh")
-            return rc
+            return rc, kernel, user, total          # always 4 values
         
             # Use "systemd-analyze" to grab the kernel boot time from the VM
             # Greping through syslog is error-prone, especially if it's booted
@@ -589,7 +2110,7 @@ class CSPBaseClass:
             
         if (retcode == 0):      # successfull ssh
             tmpary = stdoutstr.split()   # ['Startup', 'finished', 'in', '3.582s', '(kernel)', '+', '5.972s', '(userspace)', '=', '9.555s']
-            if tmpary[4] != "(kernel)" or  tmpary[7] != "(userspace)":
+            if tmpary.__len__() < 10 or tmpary[4] != "(kernel)" or  tmpary[7] != "(userspace)":
                 error("not expected output from systemd-analyze:" + stdoutstr)
                 retcode = 1
             else:
@@ -619,6 +2140,17 @@ class CSPBaseClass:
         print("\n")
         return 0
     
+    ##############################################################################
+    # GetRegionsCached
+    #
+    # The regions list is only needed by commands that use a region, so it's
+    # not queried till one of them asks for it. The first time it's queried 
+    # and cached in the regions file. After RegionsTTL() seconds the file is 
+    # still used, but a "ncsp <csp> regions refresh" is started in the 
+    # background to update it, so that no command waits on the CSP for it
+    #
+    # Returns:    list of region names, empty if they can't be queried
+    #
     def GetRegionsCached(self):
         ''' returns the regions list for csp, cached to file first time '''
         
@@ -626,21 +2158,350 @@ class CSPBaseClass:
         try:
             with open(self.m_regions_fname, "r") as f:
                 mylist = json.load(f);
+            age = time.time() - os.path.getmtime(self.m_regions_fname)
         except:
+            mylist = None
+            
+        if (mylist == None):
             mylist = self.GetRegions()              # csp dependent query function
-            with open(self.m_regions_fname, "w") as f:
-                json.dump(mylist, f)
+            if (mylist.__len__() > 0):              # don't keep a failed query
+                self.SaveRegions(mylist)
+        elif (age > self.RegionsTTL()):
+            self.RefreshRegionsInBackground()
 
         return mylist                               # return list
+    
+    def RegionsTTL(self):
+        ''' seconds the cached regions are used before they're refreshed '''
+        
+        return default_regions_ttl
+    
+    def SaveRegions(self, mylist):
+        ''' writes regions file, whole or not at all, other ncsp's may be reading it '''
+        
+        tmpname = "%s.%d" % (self.m_regions_fname, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(mylist, f)
+        os.rename(tmpname, self.m_regions_fname)
+    
+    def RefreshRegionsInBackground(self):
+        ''' starts a detached "ncsp <csp> regions refresh", unless one already is '''
+        
+        if (self.m_cassette != None):
+            return                                  # recording or replaying, no extra commands
+        
+            # the lock file is removed by the refresh when it's done, or is
+            # ignored once it's older than it would take
+            
+        lockname = self.m_regions_fname + ".refresh"
+        try:
+            if (time.time() - os.path.getmtime(lockname) < default_regions_refresh):
+                return
+            os.remove(lockname)
+        except OSError:
+            pass                                    # none, or another ncsp just removed it
+        try:
+            os.close(os.open(lockname, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return                                  # another ncsp got there first
+        
+        debug(1, "regions older than %d secs, refreshing in background" % self.RegionsTTL())
+        devnull = open(os.devnull, "r+")
+        subprocess.Popen([sys.executable, sys.argv[0], self.m_class_name, "regions", "refresh"],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)     # outlives this command
+        devnull.close()
+        
+    def RefreshRegions(self, args):
+        ''' queries regions and rewrites the regions file, 'regions refresh' command '''
+        
+        try:
+            self.m_cache.Invalidate("region")       # GetRegions' query may be in cmd cache
+            mylist = self.GetRegions()              # csp dependent query function
+            if (mylist.__len__() == 0):
+                error("Could not get %s regions" % self.m_class_name)
+                return 1
+            self.SaveRegions(mylist)
+        finally:
+            if (os.path.exists(self.m_regions_fname + ".refresh")):
+                os.remove(self.m_regions_fname + ".refresh")
+        print ("# %d regions" % mylist.__len__())
+        return 0
+    
+    ##############################################################################
+    # CheckRegion
+    #
+    # --region isn't checked when the args are parsed, as that would need the 
+    # regions list for every command. Instead it's checked here, for commands
+    # that use the region (query=True, regions are queried if not cached yet),
+    # and for the rest only if the regions are already cached (query=False)
+    #
+    # Returns:    True if region is ok, or can't be checked
+    #
+    def CheckRegion(self, args, query):
+        ''' True if args.region is one of the csp's regions '''
+        
+        if (query == False and os.path.exists(self.m_regions_fname) == False):
+            return True
+        mylist = self.GetRegionsCached()
+        if (mylist.__len__() == 0):
+            return True                             # couldn't query, let the CSP say
+        if (self.RegionOf(args.region) not in mylist):
+            error("--region \"%s\" is not a %s region, see: ncsp %s regions" % 
+                  (args.region, self.m_class_name, self.m_class_name))
+            return False
+        return True
+        
+    def RegionOf(self, region):
+        ''' the region in the regions list that --region is in, CSP's with zones override '''
+        
+        return region
+        
+    def ShowCmdStats(self):
+        ''' per command family: calls, errors, cache hits, latency and histogram of latencies '''
+        
+        families = {}
+        for stat in self.m_cmd_stats:
+            families.setdefault(stat["family"], []).append(stat)
+        if (families.__len__() == 0):
+            print ("# no cli commands run")
+            return 0
+        
+        header = "".join([ " %5s" % ("<%g" % limit) for limit in cmd_stat_buckets ]) + " %5s" % (">=%g" % cmd_stat_buckets[-1])
+        print ("# %-32s %5s %4s %6s %8s %7s %7s %9s %s" % 
+               ("family", "calls", "err", "cached", "total", "mean", "max", "bytes", header))
+        
+            # most called first -- these are the ones to look at for throttling
+            
+        for family in sorted(families.keys(), key=lambda family: -families[family].__len__()):
+            calls  = [ stat for stat in families[family] if not stat["cached"] ]
+            secs   = [ stat["secs"] for stat in calls ]
+            counts = [0] * (cmd_stat_buckets.__len__() + 1)
+            for value in secs:
+                idx = 0
+                while (idx < cmd_stat_buckets.__len__() and value >= cmd_stat_buckets[idx]):
+                    idx += 1
+                counts[idx] += 1
+            total = sum(secs)
+            mean  = 0.0
+            if (calls.__len__() > 0):
+                mean = total / calls.__len__()
+            print ("  %-32s %5d %4d %6d %8.2f %7.2f %7.2f %9d %s" %
+                   (family, calls.__len__(), len([ stat for stat in calls if stat["rc"] != 0 ]),
+                    families[family].__len__() - calls.__len__(), total, mean, max(secs or [0]),
+                    sum([ stat["bytes"] for stat in calls ]), "".join([ " %5d" % count for count in counts ])))
+        return 0
+    
+    def ShowCache(self, args):
+        ''' shows the cached query command outputs, and how much longer they are good for '''
         
+        now     = time.time()
+        entries = self.m_cache.Entries()
+        entries.sort(key=lambda entry: entry["expires"])
+        for entry in entries:
+            left = entry["expires"] - now
+            if (left < 0):
+                left = 0                                    # expired, will be replaced on next use
+            print ("  %8.0f %-16s %s" % (left, entry["resource"], entry["key"]))
+        if (entries.__len__() == 0):
+            print ("# no cached commands")
+        return 0
+    
+    def MaxParallelVMs(self):
+        ''' most VMs to create/start/stop/delete at the same time, CSP's override '''
+        
+        return default_max_parallel_vms
+    
+    def ShowFleet(self, args):
+        ''' shows the VMs in the fleet registry, or just the selected ones '''
+        
+        if (self.FleetMode(args)):
+            entries = [ item for item in self.m_fleet.Select(args.vm_select, args.all_vms, args.tags) if item[2] != None ]
+        else:
+            entries = self.m_fleet.Entries()
+        for region, name, entry in entries:
+            print ("  %-16s %-32s %-24s %-16s %s" % (region, name, entry["args"].get("vm_id"), 
+                                                    entry["args"].get("vm_ip"), ",".join(entry["tags"])))
+        if (entries.__len__() == 0):
+            print ("# no VMs in fleet")
+        return 0
+    
     def ShowRegions(self, args):
         ''' shows the regions supported by csp ''' 
         
+        if ("refresh" in args.arguments):
+            return self.RefreshRegions(args)
         mylist = self.GetRegionsCached()
         for region in mylist:
             print ("  %s" % region)
         return 0
     
+    def MaxParallelRegions(self):
+        ''' most regions to query at the same time, CSP's override to stay under api rate limits '''
+        
+        return default_max_parallel_regions
+    
+    def TimedGetRunning(self, args, region):
+        ''' CSP's GetRunning for one region, returns (retcode, instances, seconds taken) '''
+        
+        start = g_clock.Now()
+        retcode, instances = self.GetRunning(args, region)
+        return retcode, instances, g_clock.Now() - start
+    
+    def ShowRunningAllRegions(self, args):
+        ''' running instances in every region, queried in parallel, merged by launch time '''
+        
+        regions = self.GetRegionsCached()
+        tasks   = [ (self.TimedGetRunning, (args, region)) for region in regions ]
+        start   = g_clock.Now()
+        results = run_parallel(tasks, self.MaxParallelRegions())
+        secs    = g_clock.Now() - start
+        
+        retcode   = 0
+        instances = []
+        for rc, running, took in results:
+            if (rc != 0):
+                retcode = rc                        # keep going, show what other regions have
+            instances.extend(running)
+        instances.sort(key=lambda instance: instance["launched"])
+        
+        print ("# %s: %d running instances in %d regions" % (self.m_class_name, instances.__len__(), regions.__len__()))
+        for instance in instances:
+            print (" %-16s %-36s %-16s %-20s \"%s\"" % 
+                   (instance["region"], instance["id"], instance["type"], instance["launched"][0:19], instance["name"]))
+            
+                    # how long each region took, the total is about the slowest of
+                    # them when there are no more regions than MaxParallelRegions
+                    
+        print ("# %-16s %4s %9s %8s" % ("region", "rc", "instances", "secs"))
+        for idx in range(0, regions.__len__()):
+            rc, running, took = results[idx]
+            print ("  %-16s %4d %9d %8.2f" % (regions[idx], rc, running.__len__(), took))
+        print ("  %-16s %4d %9d %8.2f" % ("total", retcode, instances.__len__(), secs))
+        return retcode
+    
+    ##############################################################################
+    # Instance type catalog
+    #
+    # Each CSP's GetTypes(args, region) queries the instance types in a region,
+    # each one as
+    #
+    #    { "type": "p3.16xlarge", "vcpus": 64, "memory": 488.0,     memory in GiB
+    #      "gpus": 8, "gpu": "V100", "network": 25.0 }              network in Gbps
+    #
+    # with 0 or "" for what the CSP doesn't say. They're cached per region in 
+    # the types file for TypesTTL() seconds. The 'types' command picks from 
+    # them by what they have, in one or every region:
+    #
+    #    ncsp aws types --gpus 8 --gpu V100
+    #    ncsp aws types --gpus 1 --memory 60 --all-regions
+    #
+    ##############################################################################
+    
+    def TypesTTL(self):
+        ''' seconds a region's cached instance types are used before they're queried again '''
+        
+        return default_types_ttl
+    
+    def GetTypesCached(self, args, regions, refresh=False):
+        ''' returns { region: [instance types] }, querying regions not cached, or stale '''
+        
+        try:
+            with open(self.m_types_fname, "r") as f:
+                catalog = json.load(f)
+        except:
+            catalog = {}                            # none yet
+            
+            # the regions to query are queried at the same time, like the
+            # --all-regions running 
+            
+        now   = time.time()
+        stale = [ region for region in regions if refresh or region not in catalog or 
+                  now - catalog[region]["fetched"] > self.TypesTTL() ]
+        if (stale.__len__() > 0):
+            results = run_parallel([ (self.GetTypes, (args, region)) for region in stale ], 
+                                   self.MaxParallelRegions())
+            for idx in range(0, stale.__len__()):
+                rc, types = results[idx]
+                if (rc == 0):
+                    catalog[stale[idx]] = { "fetched": now, "types": types }
+                elif (stale[idx] in catalog):
+                    error("Could not get %s instance types, using ones from %s" % 
+                          (stale[idx], time.strftime("%Y-%m-%d %H:%M", time.localtime(catalog[stale[idx]]["fetched"]))))
+            tmpname = "%s.%d" % (self.m_types_fname, os.getpid())
+            with open(tmpname, "w") as f:
+                json.dump(catalog, f)
+            os.rename(tmpname, self.m_types_fname)  # whole or not at all
+        
+        return dict([ (region, catalog[region]["types"]) for region in regions if region in catalog ])
+    
+    def MatchTypes(self, types, query):
+        ''' instance types that have what query asks for, most gpus/vcpus/memory last '''
+        
+        gpu = "".join([ c for c in (query.gpu or "").lower() if c.isalnum() ])
+        matches = []
+        for itype in types:
+            if (query.gpus != None and itype["gpus"] != query.gpus):
+                continue
+            if (gpu != "" and gpu not in "".join([ c for c in itype["gpu"].lower() if c.isalnum() ])):
+                continue                            # "V100" is in "NVIDIA V100", "nvidia-tesla-v100"
+            if (itype["vcpus"] < query.vcpus or itype["memory"] < query.memory or 
+                itype["network"] < query.network):
+                continue
+            matches.append(itype)
+        matches.sort(key=lambda itype: (itype["gpus"], itype["vcpus"], itype["memory"], itype["type"]))
+        return matches
+        
+    def ShowTypes(self, args, query):
+        ''' prints the instance types that have what query asks for, in a region or all of them '''
+        
+        if (query.all_regions):
+            regions = self.GetRegionsCached()
+        else:
+            regions = [ self.RegionOf(args.region) ]
+        catalog = self.GetTypesCached(args, regions, query.refresh)
+        if (catalog.__len__() == 0):
+            error("Could not get %s instance types" % self.m_class_name)
+            return 1
+        
+            # same type in many regions is one line, with the regions it's in
+            
+        types     = {}
+        available = {}
+        for region in regions:
+            for itype in self.MatchTypes(catalog.get(region, []), query):
+                types.setdefault(itype["type"], itype)
+                available.setdefault(itype["type"], []).append(region)
+        matches = self.MatchTypes(types.values(), query)
+        
+        print ("# %s: %d instance types in %d regions" % (self.m_class_name, matches.__len__(), catalog.__len__()))
+        if (matches.__len__() == 0):
+            return 1
+        print ("# %-24s %5s %8s %4s %-16s %7s  %s" % ("type", "vcpus", "memory", "gpus", "gpu", "network", "regions"))
+        for itype in matches:
+            print ("  %-24s %5d %8.1f %4d %-16s %7s  %s" % 
+                   (itype["type"], itype["vcpus"], itype["memory"], itype["gpus"], itype["gpu"] or "-",
+                    ("%.1f" % itype["network"]) if itype["network"] > 0 else "-",
+                    ",".join(available[itype["type"]])))
+        return 0
+        
+    def CheckInstanceType(self, args):
+        ''' False if cached instance types of the region don't have args.instance_type '''
+        
+            # only checks what's cached, the CSP will say so if it's wrong
+            
+        try:
+            with open(self.m_types_fname, "r") as f:
+                catalog = json.load(f)
+            types = [ itype["type"] for itype in catalog[self.RegionOf(args.region)]["types"] ]
+        except:
+            return True
+        if (args.instance_type not in types):
+            error("--instance_type \"%s\" is not in %s, see: ncsp %s types" % 
+                  (args.instance_type, args.region, self.m_class_name))
+            return False
+        return True
+    
     def ShowIP(self, args):
         ''' shows the public IP address for the VM '''
         if (self.CheckID(args) == False):
@@ -678,11 +2539,22 @@ class CSPBaseClass:
             error("Network Security Group name is \"\" - aborting")
             sys.exit(1)
             
+            # recorded by an earlier command, maybe for another VM? Then it's
+            # used without asking the CSP. If it has been deleted since, the
+            # VM create fails, and NSGGone() finds or creates it again
+            
+        nsg_id = self.m_state.NSGGet(args.region, args.nsg_name)
+        if (nsg_id != None):
+            args.nsg_id = nsg_id
+            trace(2, "Security group \"%s\" recorded: %s" % (args.nsg_name, args.nsg_id))
+            return 0
+        
             # Does it exist by name? Don't need to create it if so
            
         self.Inform("ExistingNSG")                            
         if (self.ExistingSecurityGroup(args) == 0):
             trace(2, "Security group \"%s\" found: %s" % (args.nsg_name, args.nsg_id))
+            self.m_state.NSGPut(args.region, args.nsg_name, args.nsg_id)
             return 0
         
             # Create a new security group
@@ -693,7 +2565,25 @@ class CSPBaseClass:
         if (rc != 0):
             return rc
         trace(2, "Created Security Group \"%s\": %s" % (args.nsg_name, args.nsg_id))
+        self.m_state.NSGPut(args.region, args.nsg_name, args.nsg_id)
         return 0
+    
+    def NSGGone(self, args):
+        ''' after a VM create failed, True if its recorded NSG was gone, and args.nsg_id is a new one '''
+        
+        nsg_id = args.nsg_id
+        if (nsg_id != self.m_state.NSGGet(args.region, args.nsg_name)):
+            return False                # not a recorded id, create failed for some other reason
+        
+            # forget it, and look for the NSG by name like there was no record.
+            # Same id back means it's still there
+            
+        self.m_state.NSGPut(args.region, args.nsg_name, None)
+        args.nsg_id = None
+        if (self.CreateNSG(args) != 0 or args.nsg_id == nsg_id):
+            return False
+        trace(2, "Security group \"%s\" recorded as %s was gone, now %s" % (args.nsg_name, nsg_id, args.nsg_id))
+        return True
         
     def DeleteNSG(self, args):
         ''' deletes security group if it currently exists '''
@@ -708,4 +2598,8 @@ class CSPBaseClass:
             if (self.ExistingSecurityGroup(args) == 0):     # Does it exist by that name?
                 rc = self.DeleteSecurityGroup(args)         # above call set args.nsg_id
         
+            # deleteVM doesn't write back args, so the record has to go here
+            
+        if (rc == 0 and args.nsg_name != "" and args.nsg_name != None and args.nsg_name != "None"):
+            self.m_state.NSGPut(args.region, args.nsg_name, None)
         return rc
@@ -0,0 +1,158 @@
+# cspplugins.py                                              10/16/2026
+#
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# CSP plugin registry -- which <csp>_funcs.py files there are, and what's
+# in them, without importing them
+#
+# Each <csp>_funcs.py in the module directory is a CSP plugin. What ncsp
+# needs to know about them for help, the csps list and tab completion is
+# kept in a manifest:
+#
+#    name            "aws" from aws_funcs.py
+#    helptext        the quoted string on the "# HELPTEXT:" line at its top
+#    capabilities    CSPClass functions it has, like "GetRunning"
+#
+# The manifest is cached in ~/ncsp/plugins.json. A file is only read again
+# when its modification time or size changes, and a plugin is only imported
+# when it's the CSP a command is for (see Load)
+#
+
+import os
+import re
+import json
+
+plugin_suffix   = "_funcs.py"
+default_manifest= "~/ncsp/plugins.json"
+
+helptext_lines  = 12                        # "# HELPTEXT:" is in the first lines
+class_pattern   = re.compile(r"^class (\w+)")
+method_pattern  = re.compile(r"^    def ([A-Za-z]\w*)\(self")
+scan_version    = 2                         # bump when scan_plugin changes, rescans
+
+def scan_plugin(fname):
+    ''' reads the helptext and capabilities from the plugin file '''
+
+    helptext     = ""
+    capabilities = []
+    in_cspclass  = False
+    with open(fname, "r") as f:
+        for idx, line in enumerate(f):
+
+                # pull quoted string after HELPTEXT: from the file
+
+            if (idx < helptext_lines and helptext == ""):
+                pos = line.find("HELPTEXT:")
+                if (pos >= 0):
+                    start = line.find("\"", pos+9)
+                    end   = line.find("\"", start+1)
+                    if (start > pos and end > start):
+                        helptext = line[start+1:end]
+
+                # CSPClass functions, the ones it has for itself -- only
+                # those in its body, not other classes in the file (sim's
+                # SimWorld), which ends at the next unindented line
+
+            if (line[0:1] not in ("", " ", "\t", "\n", "#")):
+                match = class_pattern.match(line)
+                in_cspclass = (match != None and match.group(1) == "CSPClass")
+                continue
+            if (in_cspclass == False):
+                continue
+            match = method_pattern.match(line)
+            if (match != None and match.group(1) not in capabilities):
+                capabilities.append(match.group(1))
+
+    return { "helptext": helptext, "capabilities": sorted(capabilities) }
+
+class PluginRegistry:
+    ''' the <csp>_funcs.py plugins in a directory, from a cached manifest '''
+
+    def __init__(self, module_path, manifest=default_manifest):
+        self.m_dir      = os.path.abspath(module_path or ".")
+        self.m_fname    = os.path.expanduser(manifest)
+        self.m_plugins  = None              # name: entry, read on first use
+
+    def Refresh(self):
+        ''' brings manifest up to date with the files, reading only changed ones '''
+
+        if (self.m_plugins != None):
+            return self.m_plugins
+
+        try:
+            with open(self.m_fname, "r") as f:
+                manifest = json.load(f)
+        except:
+            manifest = {}                   # none yet, or unreadable
+        cached = manifest.get(self.m_dir, {})
+
+        plugins = {}
+        for fname in sorted(os.listdir(self.m_dir)):
+            if (fname.endswith(plugin_suffix) == False):
+                continue
+            name = fname[0:-len(plugin_suffix)]
+            path = os.path.join(self.m_dir, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue                    # dangling link
+            entry = cached.get(name)
+            if (entry == None or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size or
+                entry.get("scan") != scan_version):
+                try:
+                    entry = scan_plugin(path)
+                except IOError:
+                    continue
+                entry.update({ "file": fname, "mtime": st.st_mtime, "size": st.st_size,
+                               "scan": scan_version })
+            plugins[name] = entry
+
+            # write back only if something changed, another ncsp may be
+            # doing the same -- so write a temp file, and rename it
+
+        if (plugins != cached):
+            manifest[self.m_dir] = plugins
+            try:
+                if (os.path.isdir(os.path.dirname(self.m_fname)) == False):
+                    os.makedirs(os.path.dirname(self.m_fname))
+                tmpname = "%s.%d" % (self.m_fname, os.getpid())
+                with open(tmpname, "w") as f:
+                    json.dump(manifest, f, indent=1, sort_keys=True)
+                os.rename(tmpname, self.m_fname)
+            except (IOError, OSError):
+                pass                        # no cache this time, still works
+
+        self.m_plugins = plugins
+        return plugins
+
+    def Names(self):
+        ''' names of all the plugins '''
+
+        return sorted(self.Refresh().keys())
+
+    def Exists(self, name):
+        ''' True if there's a plugin by that name '''
+
+        return name in self.Refresh()
+
+    def HelpText(self, name):
+        ''' help text of plugin, "" if it doesn't have any '''
+
+        return self.Refresh()[name]["helptext"]
+
+    def Capabilities(self, name):
+        ''' list of CSPClass functions the plugin has '''
+
+        return self.Refresh()[name]["capabilities"]
+
+    def Load(self, name):
+        ''' imports the plugin, returns its module '''
+
+        import imp
+
+        module_name = name + plugin_suffix[0:-3]
+        f = open(os.path.join(self.m_dir, self.Refresh()[name]["file"]), "r")
+        try:
+            return imp.load_module(module_name, f, f.name, (".py", "r", imp.PY_SOURCE))
+        finally:
+            f.close()
@@ -10,11 +10,11 @@
 #
 
 import json
-import time
 import sys
 from cspbaseclass import CSPBaseClass
 from cspbaseclass import Which
 from cspbaseclass import error, trace, trace_do, debug, debug_stop
+from cspbaseclass import clock_get
 import os
 
 ##############################################################################
@@ -41,17 +41,16 @@ default_service_account = "my-service-account"
 # default_image_name:    Name of OS template that instance will be created with
 # default_instance_type: The default name that defines the memory and cpu sizes
 #                        and the gpu types for the instance. Changes
-# default_choices:       Avaliable instance types that user can select with
-#                        This will probably be different per region, and will
-#                        continue to change over time. Used as a pre-check in  
-#                        command parser to verify choice before sending to csp
+#
+# Which machine types there are changes per region, and over time. They're 
+# queried and cached, see 'ncsp gcp types'. createVM checks --instance_type 
+# against the cached ones for the region
 ##############################################################################
 
 
 default_image_project           = "nvidia-ngc-public" 
 default_image_name              = "nvidia-gpu-cloud-image"
 default_instance_type           = "n1-standard-1"
-default_instance_type_choices   = ['n1-standard-1', 'n1-standard-8', 'n1-standard-16', 'n1-standard-32', 'n1-standard-64'] 
 default_maintenance_policy      = "TERMINATE"
 default_scopes                  = ["https://www.googleapis.com/auth/devstorage.read_only","https://www.googleapis.com/auth/logging.write","https://www.googleapis.com/auth/monitoring.write","https://www.googleapis.com/auth/servicecontrol","https://www.googleapis.com/auth/service.management.readonly","https://www.googleapis.com/auth/trace.append"]
 default_boot_disk_size          = 32
@@ -67,6 +66,20 @@ default_accelerator_count_choices=[0,1,2,4]  # up to 4x P100s
 
 TIMEOUT_1 = (60 * 2) # create, start, terminate
 TIMEOUT_2 = (60 * 1) # stop, ping
+
+##############################################################################
+# How long (in seconds) the output of the read-only gcloud query commands 
+# can be reused before asking again. See CSPBaseClass.CacheTTL()
+##############################################################################
+
+default_cache_ttl = { "regions.list":                  (60 * 60 * 24) }
+
+##############################################################################
+# Most VMs that fleet commands work on at the same time. Each gcloud command
+# is its own python process, and compute API calls are rate limited
+##############################################################################
+
+default_max_parallel_vms = 16
     
 ##############################################################################
 # CSPClass
@@ -112,10 +125,8 @@ class CSPClass(CSPBaseClass):
     #
     def ArgOptions(self, parser):  
         ''' gcp specific option parser '''
-        region_list = self.GetRegionsCached()        
         parser.add_argument('--region', dest='region',
                             default=default_region, required=False,
-                            choices=region_list,                            # regions change, this is queried output
                             help='region in which to create the VM')
         parser.add_argument('--project', dest='project',
                             default=default_project, required=False,
@@ -156,7 +167,6 @@ class CSPClass(CSPBaseClass):
                             help='Number of GPU accelerators to attach to instance')
         parser.add_argument('--instance_type', dest='instance_type',    # 'size' on azure, use 'instance-type' as common name
                             default=default_instance_type, required=False,
-                            choices=default_instance_type_choices,
                             help='VM instance (type) to create')
  
         parser.add_argument('--vpcid', dest='vpcid', 
@@ -536,6 +546,7 @@ class CSPClass(CSPBaseClass):
             
         args.vm_id = decoded_output[0]['id']           # may not actually need the ID, all vm_name based
         args.vm_ip = decoded_output[0]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+        self.Accepted(args, "create")
         
             # save vm ID and other fields setup here so don't use them if error later
             # actually don't care if it's fully running, (that would be nice) but
@@ -580,7 +591,7 @@ class CSPClass(CSPBaseClass):
             
         delay = 10 + (accelerator_count * 10)
         debug (0, "WORKAROUND: external network connect - sleep for %d seconds before ping" % (delay))
-        time.sleep(delay)       # wait a few seconds before ANY command to vm
+        clock_get().Sleep(delay)    # wait a few seconds before ANY command to vm
             
             # Another sanity check -- gcp will return from create only once the
             # vm is up and running. This code here (which comes from aws implementation)
@@ -651,6 +662,7 @@ class CSPClass(CSPBaseClass):
         
         decoded_output = json.loads(output)          # convert json format to python structure        
         trace(3, json.dumps(decoded_output, indent=4, sort_keys=True))
+        self.Accepted(args, "start")
         
             # CSP specific - verify that the VM is fully up and running, and that
             # we have it's IP address and can ssh into it.
@@ -786,6 +798,7 @@ class CSPClass(CSPBaseClass):
         
         decoded_output = json.loads(output)          # convert json format to python structure        
         trace(3, json.dumps(decoded_output, indent=4, sort_keys=True))
+        self.Accepted(args, "reboot")
 
             # this code is CSP specific.
             #
@@ -803,7 +816,7 @@ class CSPClass(CSPBaseClass):
                 rc = self.WaitForPing(args, False, TIMEOUT_2)
                 print "Saw Pingable rc=%d" % rc
             else:
-                time.sleep(5)       # let VM go down enough so SSH stops (we hope)
+                clock_get().Sleep(5)    # let VM go down enough so SSH stops (we hope)
                 rc = 0              # fake success, since ping isn't supported
                 
             if (rc != 0):
@@ -858,7 +871,7 @@ class CSPClass(CSPBaseClass):
             #
         if (rc == 0):                   # successful so far?
             self.Clean(args)            # remove file with the persistent id, ip address, ..
-            self.m_args_fname = ""      # clear name, so won't write back args when done
+            args.vm_deleted = True      # so won't write back args when done
             
         return rc                       # 0: succcess, 1: failure
     
@@ -866,7 +879,12 @@ class CSPClass(CSPBaseClass):
 # CSP specific utility functions
 #
 #    ShowRunning             Shows all the account's running VM's
+#    GetRunning              Running VM's in a region
 #    GetRegions              Returns proper list of regions
+#    RegionOf                Region a --region zone is in
+#    GetTypes                Machine types in a region, and what they have
+#    CmdFamily               Type of gcloud command, for caching
+#    MaxParallelVMs          Most VMs to work on at the same time
 ##############################################################################
       
     ##############################################################################
@@ -881,30 +899,55 @@ class CSPClass(CSPBaseClass):
     def ShowRunning(self, args):
         ''' Shows list of running instances within region of account '''
         
-        # CSP_SpecificShowRunning(args.region)
-        rc = 0
+        lines_printed = 0
         
-        mylist = []
+        rc, instances = self.GetRunning(args, None)        # all the zones, as before
+        if ( rc == 0 ):
+            for instance in instances:
+                if (lines_printed == 0):
+                    print("# %s:" % self.m_class_name )
+                print(" %-20s %-16s %-32s %10s \"%s\"" % (instance["id"], instance["zone"], instance["type"], 
+                                                          instance["launched"][0:10], instance["name"]))
+                lines_printed += 1
+
+            if (lines_printed == 0):
+                print("%s: No running instances found" % self.m_class_name )
+        
+        return 0
+    
+    ##############################################################################
+    # GetRunning
+    #
+    # Gets the running instances in a region, see CSPBaseClass.ShowRunningAllRegions
+    #
+    # Returns:    (retcode, list of { "region", "id", "type", "launched", "name" })
+    #
+    # region of None gets the running instances in every zone
+    #
+    def GetRunning(self, args, region):
+        ''' returns (retcode, list of running instances in region) '''
+        
+        running = []
         cmd =  "gcloud --format=\"json\" beta compute instances list"
+        cmd += " --filter=\"status=RUNNING"
+        if (region != None):
+            cmd += " AND zone ~ /zones/%s-" % region       # zones in region are us-east1-b, us-east1-c ..
+        cmd += "\""
         rc, output, errval = self.DoCmd(cmd)
         if ( rc == 0 ):
             decoded_output = json.loads(output)
             items = len(decoded_output)                                           # number of instances
-            lines_printed = 0
             for idx in range(0, items):
                 status = decoded_output[idx]["status"]                            # UP or ??
                 if (status == "RUNNING"):
                     name              = decoded_output[idx]["name"]               # "gpu-stress-test"
                     id                = decoded_output[idx]["id"]                 # "6069200451247196266"
                     machineType       = decoded_output[idx]["machineType"]        # "https://www.googleapis.com/compute/beta/projects/my-project/zones/us-central1-a/machineTypes/n1-standard-32-p100x4"
-                    cpuPlatform       = decoded_output[idx]["cpuPlatform"]        # "Unknown CPU Platform"
                     creationTimestamp = decoded_output[idx]["creationTimestamp"]  # "2017-08-18T16:21:42.196-07:00"
                     zone              = decoded_output[idx]["zone"]               # "https://www.googleapis.com/compute/beta/projects/my-project/zones/us-east1-d"
 
                         # pull interesting data out of longer fields that were gathered above
                     
-                    launch_time = creationTimestamp[0:10]
-                    
                         # VM machine type running on
                         
                     i = machineType.rfind('/')
@@ -920,16 +963,18 @@ class CSPClass(CSPBaseClass):
                         tzone = zone[i+1:]                              # from last '/'
                     else:
                         tzone = zone                                    # unexpected format, take it all
-                        
-                    if (lines_printed == 0):
-                        print("# %s:" % self.m_class_name )
-                    print(" %-20s %-16s %-32s %10s \"%s\"" %(id, tzone, type, launch_time, name))
-                    lines_printed += 1
-
-            if (lines_printed == 0):
-                print("%s: No running instances found" % self.m_class_name )
+                    
+                    if (region != None and not tzone.startswith(region + "-")):
+                        continue                                        # filter matched another region
+                    
+                    running.append({ "region":   tzone[0:tzone.rfind('-')],
+                                     "zone":     tzone,
+                                     "id":       id,
+                                     "type":     type,
+                                     "launched": creationTimestamp,
+                                     "name":     name })
         
-        return 0
+        return rc, running
     
     ##############################################################################
     # GetRegions
@@ -940,8 +985,8 @@ class CSPClass(CSPBaseClass):
     # may offer different resoures. Don't care about that here. Just need the
     # name.
     #
-    # Used in a choice-list in the arg parser when user gives a non-default
-    # region name to catch invalid names before any real processing is done
+    # Used to check --region, by the commands that use it, to catch invalid
+    # names before any real processing is done. See CSPBaseClass.CheckRegion
     #
     # Returns:    list of names
     def GetRegions(self):
@@ -949,7 +994,7 @@ class CSPClass(CSPBaseClass):
                 
         mylist = []
         cmd =  "gcloud --format=\"json\" beta compute regions list"
-        rc, output, errval = self.DoCmd(cmd)
+        rc, output, errval = self.DoCmdCached(cmd)
         if ( rc == 0 ):
             decoded_output = json.loads(output)
             items = len(decoded_output)       # number of regions
@@ -959,5 +1004,81 @@ class CSPClass(CSPBaseClass):
                 if (status == "UP"):
                     mylist.append(str(name))             # only include running farms
         return mylist                                    # list is empty if no regions
- 
 
+    ##############################################################################
+    # RegionOf
+    #
+    # gcp's --region is a zone, "us-west1-b", in the region "us-west1" that
+    # GetRegions lists. See CSPBaseClass.CheckRegion
+    #
+    def RegionOf(self, region):
+        ''' returns the region a zone is in '''
+        
+        if (region.count("-") >= 2):
+            return region[0:region.rfind("-")]          # "us-west1-b" -> "us-west1"
+        return region
+        
+    ##############################################################################
+    # GetTypes
+    #
+    # Gets the machine types in a region's zones, see CSPBaseClass.ShowTypes.
+    # Only the types with GPUs built in (like a2-highgpu-8g) have gpus, GPUs 
+    # attached to n1 types with --accelerator_type aren't listed. gcp doesn't
+    # give a network bandwidth for types, so it's 0
+    #
+    # Returns:    (retcode, list of { "type", "vcpus", "memory", "gpus", "gpu", "network" })
+    #
+    def GetTypes(self, args, region):
+        ''' returns (retcode, list of machine types in region) '''
+        
+        cmd =  "gcloud --format=\"json\" beta compute machine-types list"
+        cmd += " --filter=\"zone ~ ^%s-\"" % region            # zones in region are us-east1-b, us-east1-c ..
+        rc, output, errval = self.DoCmd(cmd)
+        types = {}
+        if (rc == 0):
+            for item in json.loads(output):
+                accelerators = item.get("accelerators", [])     # [{"guestAcceleratorCount": 8, "guestAcceleratorType": "nvidia-tesla-a100"}]
+                types[item["name"]] = { "type":    item["name"],     # same type in each zone
+                                        "vcpus":   item["guestCpus"],
+                                        "memory":  item["memoryMb"] / 1024.0,
+                                        "gpus":    sum([ acc["guestAcceleratorCount"] for acc in accelerators ]),
+                                        "gpu":     ",".join([ acc["guestAcceleratorType"] for acc in accelerators ]),
+                                        "network": 0.0 }
+        return rc, types.values()
+
+    ##############################################################################
+    # CmdFamily
+    #
+    # gcloud commands have the form "gcloud [opts] beta compute [opts] instances 
+    # create ...", with options in between the command group names. Skip the 
+    # "beta compute" part, leaving "instances.create" or "regions.list"
+    #
+    # Returns:    command type label string
+    #
+    def CmdFamily(self, cmd):
+        ''' returns command type label, like 'instances.describe' '''
+        
+        tokens = cmd.split()
+        if (tokens.__len__() == 0 or tokens[0] != "gcloud"):
+            return CSPBaseClass.CmdFamily(self, cmd)        # ssh, ping, ...
+        words = []
+        for token in tokens[1:]:
+            if (token[0:1] == '-' or token[0:1] == '"'):
+                continue                                    # option, or option's value
+            if (token in ["alpha", "beta", "compute"]):
+                continue
+            words.append(token)
+        return '.'.join(words[0:2])
+    
+    ##############################################################################
+    # MaxParallelVMs
+    #
+    # Most VMs that a fleet command (--count/--parallel) will create, start, 
+    # stop or delete at the same time. Keeps bursts under the gcp API limits
+    #
+    # Returns:    number of VMs
+    #
+    def MaxParallelVMs(self):
+        ''' most VMs to create/start/stop/delete at the same time '''
+        
+        return default_max_parallel_vms
@@ -35,11 +35,28 @@
 #
 # csp <csp> --trace [0..3] turns on some minimal command/return tracing
 #
+
+    # when ncspd is running, it runs the command and all ncsp does is pass
+    # it on -- so do that before taking the time to load everything else
+    
+import ncspd
+if (__name__ == "__main__"):
+    ncspd.forward()                         # exits, if ncspd ran the command
+
 import argparse
 import time
 import sys
 import os
-from cspbaseclass import error, trace, trace_do, trace_setlevel, debug_stop
+import json
+import math
+import glob
+import shlex
+import threading
+from cspplugins import PluginRegistry
+from cspbaseclass import error, trace, trace_do, trace_setlevel, debug, debug_stop
+from cspbaseclass import run_parallel, transport_modes
+from cspbaseclass import clock_get, clock_set, Clock, VirtualClock, monotonic_time
+from cspbaseclass import default_ssh_persist
 
 ###############################################################################
 # simple timing class
@@ -48,12 +65,17 @@ from cspbaseclass import error, trace, trace_do, trace_setlevel, debug_stop
 class TimeClass:
     ''' simple timing class '''
     
-    def __init__(self, outer_loop_value):
+    def __init__(self, outer_loop_value, my_class, args):
         self.m_test_start = self.Now();
         self.m_log_data=[] 
         self.m_log_idx=0
+        self.m_rc=0                                 # first failed step's rc, for "overall"
         self.m_instanceTypeName="no name set yet"
         self.m_outer_loop_value=outer_loop_value    # which outer-loop is this create/delete cycle
+        self.m_my_class=my_class
+        self.m_args=args
+        self.m_results_fname=my_class.m_log_path + "results.jsonl"   # every sample, see Record
+        self.m_run_id=time.strftime("%Y%m%d-%H%M%S", time.localtime(clock_get().Epoch(self.m_test_start)))
         
     def SetInstanceTypeName(self, instanceTypeName):
         self.m_instanceTypeName = instanceTypeName   # we loose this before it's printed
@@ -62,7 +84,7 @@ class TimeClass:
         return(self.m_instanceTypeName)
     
     def Now(self):                      # current time, as a floating point number
-        ts = time.time()        
+        ts = clock_get().Now()              # monotonic, or virtual -- see Clock
         return(ts)
     
     def Diff(self, te, ts):             # te is end, ts is start -- what's the difference?
@@ -73,7 +95,7 @@ class TimeClass:
         ts = self.Now()
         return ts
     
-    def End(self, taskname, loop, ts):  # called at end, given start time and name
+    def End(self, taskname, loop, ts, rc=0):  # called at end, given start time and name
         te = self.Now()
         diff = self.Diff(te, ts)
         name = taskname
@@ -85,6 +107,32 @@ class TimeClass:
             
         self.m_log_data.append((name, diff))
         self.m_log_idx += 1
+        if (rc != 0 and self.m_rc == 0):
+            self.m_rc = rc                  # stop/start/restart failures don't end the test
+        self.Record(taskname, loop, ts, te, rc)
+        self.m_my_class.m_timeline.Span(name, "test", ts, te, { "rc": rc })
+        
+    def Record(self, phase, loop, ts, te, rc):
+        ''' appends one timing sample, and what it was run on, to the results file '''
+        
+            # one json object per line, so a partly run test still leaves 
+            # good results behind. See show_report()
+            
+        args   = self.m_args
+        sample = { "run":           self.m_run_id,          # all samples from same test
+                   "csp":           self.m_my_class.m_class_name,
+                   "region":        args.region,
+                   "instance_type": args.instance_type,
+                   "image":         args.image_name,
+                   "phase":         phase,
+                   "outer":         self.m_outer_loop_value,
+                   "inner":         loop,
+                   "start":         clock_get().Epoch(ts),
+                   "end":           clock_get().Epoch(te),
+                   "secs":          te - ts,
+                   "rc":            rc }
+        with open(self.m_results_fname, "a") as f:
+            f.write(json.dumps(sample, sort_keys=True) + "\n")
     
     ###############################################################################
     # reporting functions 
@@ -94,6 +142,7 @@ class TimeClass:
         ''' Summary initialization - conclusions/sums '''
         self.m_test_end = self.Now();
         self.m_test_diff = self.Diff(self.m_test_end, self.m_test_start)     # overall test time
+        self.Record("overall", 0, self.m_test_start, self.m_test_end, self.m_rc)
         
     def SummaryReport(self, my_class, args):
         ''' Summary report to display at end of job'''
@@ -136,19 +185,19 @@ class TimeClass:
 def time_test(my_class, outer_loop_value, args):
     ''' generic CSP vm create/stop/start/reset/delete timing test '''
     
-    my_time = TimeClass(outer_loop_value)
+    my_time = TimeClass(outer_loop_value, my_class, args)
 
         # create/get id for Network Security Group
         
     ts = my_time.Start()
     rc = my_class.CreateNSG(args)
-    my_time.End("createNSG", 0, ts)
+    my_time.End("createNSG", 0, ts, rc)
     if (rc != 0):
         return rc
     
     ts = my_time.Start()
     rc = my_class.CreateVM(args)        # args is from parser.parse_args(argv)
-    my_time.End("createVM", 0, ts)
+    my_time.End("createVM", 0, ts, rc)
     if (rc != 0):
         error ("createVM returned %d, stopping test" % rc)
         return rc
@@ -162,36 +211,36 @@ def time_test(my_class, outer_loop_value, args):
     loop = 0                     # initialize value if loop isn't run (loop_cnt = 0)
     for loop in range(0, args.inner_loop_cnt):
         ts  = my_time.Start()
-        my_class.StopVM(args)
-        my_time.End("stopVM", loop, ts)
+        rc  = my_class.StopVM(args)
+        my_time.End("stopVM", loop, ts, rc)
         
-        time.sleep(5)
+        clock_get().Sleep(5)
               
         ts  = my_time.Start()
-        my_class.StartVM(args)
-        my_time.End("startVM", loop, ts)
+        rc  = my_class.StartVM(args)
+        my_time.End("startVM", loop, ts, rc)
  
-        time.sleep(5)
+        clock_get().Sleep(5)
        
         ts  = my_time.Start()
-        my_class.RestartVM(args)
-        my_time.End("restartVM", loop, ts)
+        rc  = my_class.RestartVM(args)
+        my_time.End("restartVM", loop, ts, rc)
     
-        time.sleep(5)
+        clock_get().Sleep(5)
         
         # delete vm
     
     ts = my_time.Start()   
-    my_class.DeleteVM(args)
-    my_time.End("deleteVM", loop, ts)
+    rc = my_class.DeleteVM(args)
+    my_time.End("deleteVM", loop, ts, rc)
     
         # delete Security Group
         
-    time.sleep(5)           # for alibaba, need a delay before trying to delete NSG
+    clock_get().Sleep(5)    # for alibaba, need a delay before trying to delete NSG
                             # immediatly after deleting the VM -- the deleteNSG fails 
     ts = my_time.Start()   
-    my_class.DeleteNSG(args) 
-    my_time.End("deleteNSG", loop, ts)
+    rc = my_class.DeleteNSG(args) 
+    my_time.End("deleteNSG", loop, ts, rc)
     
         # delete the persistent information - VM/NSG id, name..  
         
@@ -208,6 +257,96 @@ def time_test(my_class, outer_loop_value, args):
         
     return 0
 
+##############################################################################
+# benchmark report
+#
+# Reads the timing samples that 'test' appended to the ~/ncsp/<csp>/logs/
+# results.jsonl files, and shows the spread of times for each phase of the
+# test (createVM, stopVM, ...), across all the outer and inner loops that 
+# were run. Side by side per CSP and instance type, so they can be compared. 
+# Only samples that succeeded (rc 0) are counted in the times. 
+
+def percentile(values, pct):
+    ''' pct percentile of sorted list of values, interpolating between nearest two '''
+    
+    pos = (values.__len__() - 1) * pct / 100.0
+    lo  = int(math.floor(pos))
+    hi  = int(math.ceil(pos))
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def stddev(values):
+    ''' sample standard deviation, 0 if less than 2 values '''
+    
+    cnt = values.__len__()
+    if (cnt < 2):
+        return 0.0
+    mean = sum(values) / cnt
+    return math.sqrt(sum([ (value - mean) ** 2 for value in values ]) / (cnt - 1))
+
+def results_files(csp_list):
+    ''' results file names for given csp's, or for all of them if list is empty '''
+    
+    homedir = os.path.expanduser("~")
+    if (csp_list.__len__() == 0):
+        return sorted(glob.glob("%s/ncsp/*/logs/results.jsonl" % homedir))
+    return [ "%s/ncsp/%s/logs/results.jsonl" % (homedir, csp) for csp in csp_list ]
+
+def show_report(filelist):
+    ''' min/p50/p95/p99/max/stddev of each test phase, per csp and instance type '''
+    
+    groups = {}
+    phases = []                         # in order first seen, createNSG, createVM, ...
+    for fname in filelist:
+        if (not os.path.exists(fname)):
+            continue
+        with open(fname, "r") as f:
+            for line in f:
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    continue            # partly written line, if test was killed
+                if (sample["phase"] not in phases):
+                    phases.append(sample["phase"])
+                key = (sample["phase"], sample["csp"], sample["instance_type"])
+                groups.setdefault(key, { "secs": [], "fail": 0 })
+                if (sample["rc"] == 0):
+                    groups[key]["secs"].append(sample["secs"])
+                else:
+                    groups[key]["fail"] += 1
+    
+    if (groups.__len__() == 0):
+        print ("# no test results found")
+        return 1
+    
+    print ("# %-10s %-8s %-20s %4s %4s %8s %8s %8s %8s %8s %8s" % 
+           ("phase", "csp", "instance_type", "n", "fail", "min", "p50", "p95", "p99", "max", "stddev"))
+    for key in sorted(groups.keys(), key=lambda key: (phases.index(key[0]), key[1], key[2])):
+        secs = sorted(groups[key]["secs"])
+        if (secs.__len__() == 0):
+            print ("  %-10s %-8s %-20s %4d %4d" % (key[0], key[1], key[2], 0, groups[key]["fail"]))
+            continue
+        print ("  %-10s %-8s %-20s %4d %4d %8.2f %8.2f %8.2f %8.2f %8.2f %8.2f" % 
+               (key[0], key[1], key[2], secs.__len__(), groups[key]["fail"], secs[0], 
+                percentile(secs, 50), percentile(secs, 95), percentile(secs, 99), secs[-1], stddev(secs)))
+    return 0
+    
+# get_plugins
+#
+# The registry of csp plugins (the <csp>_funcs.py files) in module_path. 
+# What's in them comes from a cached manifest, so listing them doesn't 
+# import them -- a plugin is only imported when a command is for it
+#
+# internal function
+def get_plugins():
+    ''' returns the PluginRegistry for module_path '''
+    
+    global plugins
+    if (plugins == None or plugins.m_dir != os.path.abspath(module_path or ".")):
+        plugins = PluginRegistry(module_path)
+    return plugins
+
+plugins = None                      # see get_plugins
+
 # get_csp_list
 #
 # Returns the list of all the csp's that we support (I.E all the files that
@@ -215,16 +354,11 @@ def time_test(my_class, outer_loop_value, args):
 #
 # internal function
 def get_csp_list():
-    ''' returns a list of supported csps -- not including 'template' '''
+    ''' returns a list of supported csps -- not including 'template' or 'sim' '''
     
     csp_list=[]
-    import glob
-    filelist = glob.glob(module_path + "*_funcs.py")    # ['test1/ali_funcs.py', 'test1/azure_funcs.py', ...
-    for name in filelist:
-        pos0 = name.rfind("/")
-        pos1 = name.rfind("_funcs.py")
-        csp_name = name[pos0+1:pos1]       # remove the _funcs.py" from it
-        if (csp_name != 'template'):
+    for csp_name in get_plugins().Names():
+        if (csp_name != 'template' and csp_name != 'sim'):
             csp_list.append(csp_name)
     
     return(csp_list)
@@ -240,7 +374,7 @@ def get_csp_list():
 #     for csp_name in $(./ncsp csps); do ./ncsp $csp_name running; done
 #
 def show_csps():
-    ''' returns a list of supported csps -- not including 'template' '''
+    ''' returns a list of supported csps -- not including 'template' or 'sim' '''
     
     csp_list = get_csp_list()
     for csp_name in csp_list:
@@ -249,6 +383,85 @@ def show_csps():
     return 0
 
 
+# complete_cmd
+#
+# bash tab completion for ncsp, without importing any csp plugin so that 
+# it's instant. To turn it on:
+#
+#     complete -C './ncsp complete' ncsp
+#
+# bash runs it with the command name, the word being completed and the word
+# before it, and the line so far in COMP_LINE. It prints the words that 
+# could go there, one per line:
+#
+#     ncsp <TAB>                    top level commands, ALL and the csp names
+#     ncsp aws <TAB>                csp commands
+#     ncsp aws --region <TAB>       regions, if 'ncsp aws regions' has cached them
+#     ncsp aws running --<TAB>      options of the command
+#
+# Commands and options the csp's plugin doesn't have the functions for 
+# (its capabilities, see cspplugins.py) aren't offered
+#
+def complete_cmd(argv):
+    ''' prints possible completions of the word being typed, for bash complete -C '''
+    
+    cur  = ""
+    prev = ""
+    if (argv.__len__() >= 3):
+        cur  = argv[1]
+        prev = argv[2]
+    line  = os.environ.get("COMP_LINE", "")
+    point = int(os.environ.get("COMP_POINT", line.__len__()))
+    words = line[0:point].split()
+    if (cur == "" or line[0:point].endswith(" ")):
+        words.append("")                # starting a new word
+    
+        # what the csp's plugin can do, None when it's not one (like ALL)
+        
+    capabilities = None
+    if (words.__len__() > 2 and get_plugins().Exists(words[1])):
+        capabilities = get_plugins().Capabilities(words[1])
+    def can(need):
+        return (need == None or capabilities == None or need in capabilities)
+    command = [ word for word in words[2:-1] if word in csp_commands ]
+    
+        # which word is being completed picks what it can be
+        
+    candidates = []
+    if (words.__len__() <= 2):
+        candidates = top_commands + [ "ALL" ] + get_plugins().Names()
+    elif (prev == "--region"):
+        regions_fname = os.path.expanduser("~/ncsp/%s/data/regions" % words[1])
+        try:
+            with open(regions_fname, "r") as f:
+                candidates = json.load(f)
+        except:
+            candidates = []             # not cached yet, don't query from here
+    elif (command == []):
+        candidates = [ cmd for cmd in csp_commands if can(command_needs.get(cmd)) ]
+    elif (cur.startswith("-")):
+        candidates = [ opt for opt, need in command_options.get(command[0], []) if can(need) ]
+        
+    for word in candidates:
+        if (word.startswith(cur)):
+            print (word)
+    return 0
+
+# top level commands, and the commands a csp has (same as usage below)
+
+top_commands = [ "help", "csps", "report", "complete" ]
+csp_commands = [ "createVM", "stopVM", "startVM", "restartVM", "deleteVM", "test", 
+                 "report", "ping", "ssh", "sshall", "batch", "status", "show", 
+                 "createNSG", "deleteNSG", "showNSGs", "regions", "types", "running", 
+                 "validCSP", "ip", "args", "cache", "fleet", "clean", "help" ]
+
+# CSPClass function the csp's plugin has to have for a command or its option
+
+command_needs   = { "regions": "GetRegions", "types": "GetTypes", "running": "ShowRunning" }
+command_options = { "running": [ ("--all-regions", "GetRunning") ],
+                    "types":   [ ("--gpus", None), ("--gpu", None), ("--vcpus", None), ("--memory", None), 
+                                 ("--network", None), ("--all-regions", None) ] }
+
 # prints command line usage
 def usage(module_path):
     ''' program usage help text '''
@@ -263,59 +476,40 @@ def usage(module_path):
     cmd:                    top level csp-independent commands
         help                overall application help
         csps                lists supported csps 
+        complete            bash tab completion: complete -C './ncsp complete' ncsp
+        report [csp..]      test timing statistics, compares csps
     ''')
     
         # show the <csp>_func.py files that have in directory
         
-    import glob
-    filelist = glob.glob(module_path + "*_funcs.py")    # ['test1/ali_funcs.py', 'test1/azure_funcs.py', ...
+    registry = get_plugins()
     print("    csp:                    name of the supported Cloud Service Provider (csp)")
     
         # special case for 'all'. 
         
-    print("        %-23s %s" % ("ALL", "Runs command on all CSP's one after each other"))
+    print("        %-23s %s" % ("ALL", "Runs command on all CSP's at the same time"))
     
         # now the rest of the files. 
         
-    for filename in filelist:
-        pos0 = filename.rfind("/")
-        pos1 = filename.rfind("_funcs.py")
-        csp_name = filename[pos0+1:pos1]
-        
-            # pull quoted string after HELPTEXT= from the file
-            # 
-        helptext=""
-        
-        try:
-            with open(filename, "r") as f:
-                for i, line in enumerate(f):
-                    if (i > 10): 
-                        break;
-                    idx = line.find("HELPTEXT:");
-                    if (idx >= 0):
-                        start = line.find("\"", idx+9);
-                        end   = line.find("\"", start+1)
-                        if (start > idx and end > start):
-                            helptext=line[start+1:end-1]
-                            break
-        except:
-            helptext=""     # could not open file, don't report error
-
-        print("        %-23s %s" % (csp_name, helptext))
+    for csp_name in registry.Names():
+        print("        %-23s %s" % (csp_name, registry.HelpText(csp_name)))
 
         # rest of the menu
         
     print('''     
     csp_cmd:  
-        CSP specific commands:
+        CSP specific commands:   (on fleet VMs with: --vm NAME[,NAME..] | --all | --tag TAG)
             createVM[opts]       create instance, use -h to see csp specific options
             stopVM               stop current instance
             startVM              start current instance
             restartVM            restart current instance
             deleteVM             delete (stop first) and destroy instance
             test                 create/stop/start/restart/delete timing test
+            report               timing statistics from this csp's tests
             ping                 simple ping VM if possible - check connection
             ssh [cmd]            ssh into current VM instance, run command if given
+            sshall cmd           run command on all fleet VMs (or --vm/--tag ones) at once
+            batch [file]         run the ncsp commands in file (or stdin), in one process
             status               status of current instance
             show                 verbose info about instance           
         Network Security Group commands:
@@ -324,17 +518,39 @@ def usage(module_path):
             showNSGs             shows all network security groups           
         CSP Query commands:
             regions              displays list of region names supported by csp
+                                 refresh: query them again, they're cached for a week
+            types [opts]         instance types with --gpus N --gpu MODEL --vcpus N
+                                 --memory GiB --network Gbps [--all-regions] [refresh]
             running              display list of running instances in a region
+                                 --all-regions: in every region, at the same time
         General commands  
             validCSP             returns 0 if csp name is supported, 1 elsewise
             ip                   prints the ip value of the VM
             args                 display persistent args file
+            cache                display cached csp query commands
+            fleet                display VMs in fleet registry
             clean                clean cached files, restore args to defaults
         help
             --help               csp specific argument help
     ''')
     sys.exit(1)
 
+def add_early_options(parser):
+    ''' options needed before anything else is run: transport (see Cassette) and clock '''
+    
+    parser.add_argument('--transport', dest='transport', choices=transport_modes,
+                        default="live", required=False,
+                        help='live: run cli commands, record: run and save them, replay: serve saved results')
+    parser.add_argument('--cassette', dest='cassette',
+                        default=None, required=False,
+                        help='file cli commands are recorded to/replayed from, default logs/cassette.jsonl')
+    parser.add_argument('--replay_scale', dest='replay_scale', type=float,
+                        default=0.0, required=False,
+                        help='replay: take recorded time multiplied by this, 0 is no waiting')
+    parser.add_argument('--clock', dest='clock', choices=["real", "virtual"],
+                        default="real", required=False,
+                        help='virtual: waits take no real time, for template, sim or replay')
+    
 def add_common_options(my_class, parser):
     ''' common arguments used in outer control and CSP sepecific features '''
     
@@ -351,6 +567,13 @@ def add_common_options(my_class, parser):
     parser.add_argument('--summary_report', dest='summary_report', type=int, choices=xrange(0, 2),
                         default=1, required=False,
                         help='show summary report at end of test')
+    parser.add_argument('--timeline', dest='timeline', type=int, choices=xrange(0, 2),
+                        default=0, required=False,
+                        help='write Chrome trace json timeline of each command to logs directory')
+    parser.add_argument('--stats', dest='stats', type=int, choices=xrange(0, 2),
+                        default=0, required=False,
+                        help='show calls and latencies of each type of cli command at end')
+    add_early_options(parser)
     
         # some computed defaults used for VM
             
@@ -387,6 +610,15 @@ def add_common_options(my_class, parser):
     parser.add_argument('--key_file', dest='key_file',      # computed in CSP specific code
                         default=None, required=False,
                         help='full path to ssh key file')
+    parser.add_argument('--ssh_persist', dest='ssh_persist', type=int,
+                        default=default_ssh_persist, required=False,
+                        help='secs idle shared ssh connection to VM is kept, 0 for none')
+    parser.add_argument('--stream', dest='stream', type=int, choices=xrange(0,2),
+                        default=1, required=False,
+                        help='ssh cmd: 1 shows output as it comes, 0 when cmd is done')
+    parser.add_argument('--tee', dest='tee',
+                        default=None, required=False,
+                        help='ssh cmd: also append its output to this file')
     parser.add_argument('--image_name', dest='image_name',  # overridden in CSP specific code
                         default=None, required=False,
                         help='name of the VM image to run')
@@ -402,7 +634,33 @@ def add_common_options(my_class, parser):
     parser.add_argument('--ip', dest='vm_ip',               # set in CSP specific dode
                         default="", required=False,
                         help='VM IP address')   
+    
+        # fleet selectors -- pick which registered VMs a command is run on
+        # given before the command, as everything after it is for the command
         
+    parser.add_argument('--vm', dest='vm_select',           # see FleetRegistry
+                        action='append', default=None, required=False,
+                        help='fleet VM name(s) to run command on: NAME[,NAME..]')
+    parser.add_argument('--all', dest='all_vms',
+                        action='store_true', default=False, required=False,
+                        help='run command on all the VMs in the fleet')
+    parser.add_argument('--tag', dest='tags',
+                        action='append', default=None, required=False,
+                        help='run command on fleet VMs with tag, createVM tags the VM')
+    parser.add_argument('--count', dest='vm_count', type=int,
+                        default=0, required=False,
+                        help='fleet VMs NAME-1..NAME-count, for each --vm NAME (or vm_name)')
+    parser.add_argument('--parallel', dest='parallel', type=int,
+                        default=1, required=False,
+                        help='fleet VMs to work on at the same time, limited per CSP')
+    parser.add_argument('--all-regions', dest='all_regions',
+                        action='store_true', default=False, required=False,
+                        help='running: query every region at the same time')
+        
+# csps whose VMs aren't real, so that their waits can take no real time
+
+virtual_clock_csps = [ "template", "sim" ]
+
 # process_cmd
 #
 # command line processor     - a big case statement
@@ -423,13 +681,38 @@ def add_common_options(my_class, parser):
 # 
 def process_cmd(my_class, argv):
 
+    my_class.NewCommand()           # batch runs many commands on one my_class
+    
+        # transport goes first, everything after here may run cli commands
+        # that are to be recorded or replayed
+        
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    add_early_options(pre_parser)
+    pre_args, unused = pre_parser.parse_known_args(argv)
+    rc = my_class.SetTransport(pre_args.transport, pre_args.cassette, pre_args.replay_scale)
+    if (rc != 0):
+        return rc
+    if (pre_args.clock == "virtual" and pre_args.transport != "replay" and 
+        my_class.ClassName() not in virtual_clock_csps):
+        error("--clock virtual is only for the %s csps, or --transport replay. A real CSP's waits would poll it without pause" %
+              " and ".join(virtual_clock_csps))
+        return 1
+    if (pre_args.clock == "virtual" and clock_get().Virtual() == False):
+        clock_set(VirtualClock())
+    elif (pre_args.clock != "virtual" and clock_get().Virtual()):
+        clock_set(Clock())          # kept otherwise, time goes on between batch commands
+        
         # first thing, verify that the connection to the CSP is up and 
         # running correctly (cli app downloaded, user logged in, etc...)
-         
-    rc = my_class.CSPSetupOK()      # csp name dependent function
-    if (rc != 0):
-        error("CSP \"%s\" access is not configured correctly, set it up first" % my_class.ClassName())
-        return rc                   # unhappy
+        # no need to when replaying, there's no CSP to talk to, or if it was
+        # already checked by an earlier command (in ncspd)
+        
+    if (my_class.Replaying() == False and my_class.m_setup_ok == False):
+        rc = my_class.CSPSetupOK()  # csp name dependent function
+        if (rc != 0):
+            error("CSP \"%s\" access is not configured correctly, set it up first" % my_class.ClassName())
+            return rc               # unhappy
+        my_class.m_setup_ok = True
     
         # create the main command line argument parser class
     
@@ -472,6 +755,7 @@ def process_cmd(my_class, argv):
         # set global value used for trace level, as 'args' isn't passed around everywhere
     
     trace_setlevel(args.trace)         
+    my_class.m_timeline.Enable(args.timeline != 0)
     
         # CSP class specific arg checks, 
         # bail here if something isn't set correctly
@@ -484,11 +768,14 @@ def process_cmd(my_class, argv):
         # this is the command that is to be run, pull from the args
         
     cmd = args.command
+    if (my_class.m_cassette != None):
+        my_class.m_cassette.SetCommand(cmd)
     
         # commands to handle the persistent arg list -- 
         
     if cmd == "clean":
         my_class.Clean(args)        # cleans out args an other cached files
+        my_class.m_cache.Clear()    # and any cached query command output
         return 0
     elif cmd == "args":
         my_class.ArgShowFile()
@@ -496,6 +783,18 @@ def process_cmd(my_class, argv):
     elif cmd == "help":
         usage(my_class.m_module_path)
         return 1
+    elif cmd == "batch":
+        return batch_cmd(my_class, argv[0:argv.index(cmd)], args.arguments)
+    
+        # --region is checked here, not by the parser, so the regions are 
+        # only looked up by the commands that use them (see region_cmds). 
+        # Others check one given on the command line if they're cached
+        
+    if (cmd in region_cmds or args.region != parser.get_default("region")):
+        if (my_class.CheckRegion(args, cmd in region_cmds) == False):
+            return 1
+    if ((cmd == "createVM" or cmd == "test") and my_class.CheckInstanceType(args) == False):
+        return 1                    # not in the cached instance types, see 'types'
 
         
             # print args if higher trace level 
@@ -505,6 +804,51 @@ def process_cmd(my_class, argv):
         print "============"
         print "cmd=%s" % cmd
     
+        # VM commands with a fleet selector, run on each of the selected VMs
+        # else just on the one VM from the args file 
+        
+    if (cmd == "sshall"):
+        rc = sshall_cmd(my_class, parser, argv, args)
+    elif (my_class.FleetMode(args) and cmd in fleet_cmds):
+        rc = fleet_cmd(my_class, parser, argv, args)
+    else:
+        rc = run_cmd(my_class, args)
+        
+            # save all the persistent args values to file after the above commands have
+            # run and modified them -- like the VM or SecurityGroup IDs
+        
+        if (cmd != "DeleteVM"):
+            my_class.ArgSaveToFile(args)
+    
+        # timeline of where the time went, if enabled with --timeline 1
+        
+    if (my_class.m_timeline.Enabled()):
+        fname  = my_class.m_log_path + "timeline-%s-%s.json" % (time.strftime("%Y%m%d-%H%M%S", time.localtime()), cmd)
+        if (my_class.m_timeline.Write(fname, "ncsp %s %s" % (my_class.ClassName(), cmd)) > 0):
+            print ("# timeline: %s" % fname)
+        else:
+            os.remove(fname)                # nothing timed, don't leave empty files around
+    
+    debug(1, "cache hits:%d misses:%d" % (my_class.m_cache.m_hits, my_class.m_cache.m_misses))
+    if (args.stats != 0):
+        my_class.ShowCmdStats()
+    
+    if rc == None:      # handle "None" return case -- should be an error? 
+        error("No return code for cmd \"%s\"" % cmd)
+        rc = 2
+
+    return rc    # exit code
+
+# run_cmd
+#
+# Runs the one command in args on the VM that args describes -- the VM 
+# from the args file, or one picked from the fleet (see fleet_cmd)
+#
+def run_cmd(my_class, args):
+    ''' runs args.command, returns its exit code '''
+    
+    cmd = args.command
+    ts  = clock_get().Now()
     rc = 0                              # return value if forget to set below
     
         # parse the commands
@@ -528,7 +872,7 @@ def process_cmd(my_class, argv):
     elif cmd == "deleteVM":
         rc = my_class.DeleteVM(args)
     elif cmd == "ssh":
-        rc, stdoutstr, stderrstr = my_class.Ssh(args, True, argv[1:])  # args is historical and incl
+        rc, stdoutstr, stderrstr = my_class.Ssh(args, True, args.arguments)  # args is historical and incl
     elif cmd == "ping":
         rc = my_class.Ping(args)
     elif cmd == "status":
@@ -540,9 +884,17 @@ def process_cmd(my_class, argv):
         if (rc == 0):
             print ("kernel:%s user:%s total:%s" % (kernel, user, total))
     elif cmd == "running":
-        rc = my_class.ShowRunning(args)
+        rc = running_cmd(my_class, args)
     elif cmd == "regions":
         rc = my_class.ShowRegions(args)
+    elif cmd == "types":
+        rc = types_cmd(my_class, args)
+    elif cmd == "cache":
+        rc = my_class.ShowCache(args)
+    elif cmd == "fleet":
+        rc = my_class.ShowFleet(args)
+    elif cmd == "report":
+        rc = show_report([my_class.m_log_path + "results.jsonl"])
     elif cmd == "ip":
         rc = my_class.ShowIP(args)
     elif cmd == "test":     # default is 1 outer create/delete loop
@@ -553,26 +905,422 @@ def process_cmd(my_class, argv):
                 rc = time_test(my_class, loop, args)
                 if (rc != 0):
                     break
-                time.sleep(30)   # time between loops
+                clock_get().Sleep(30)   # time between loops
             if (rc != 0):
                 error("Test returned %d" % rc)  
     else:
         error("Undefined command", cmd)
         usage(my_class.m_module_path)
         rc = 1
+    
+    my_class.m_timeline.Span(cmd, "ncsp", ts, clock_get().Now(), { "vm": args.vm_name, "rc": rc })
+    return rc
+
+# commands that act on a VM, and are run on each VM picked by the fleet
+# selectors --vm, --all, --tag
+
+fleet_cmds = [ "createVM", "startVM", "stopVM", "restartVM", "deleteVM", 
+               "ssh", "ping", "status", "show", "boottime", "ip" ]
+
+# running_cmd
+#
+# Running instances in --region, or every region at the same time. The 
+# option can come before or after 'running':
+#
+#     ncsp aws running --all-regions
+#     ncsp aws --all-regions running
+#
+def running_cmd(my_class, args):
+    ''' shows running instances, in every region if --all-regions is in args.arguments '''
+    
+    parser = argparse.ArgumentParser(prog="ncsp %s running" % my_class.ClassName())
+    parser.add_argument('--all-regions', dest='all_regions', action='store_true', 
+                        help='in every region, at the same time')
+    query = parser.parse_args(args.arguments)
+    if (query.all_regions or args.all_regions):
+        return my_class.ShowRunningAllRegions(args)
+    return my_class.ShowRunning(args)
+
+# types_cmd
+#
+# Instance types that have what's asked for, from the csp's instance type 
+# catalog (see CSPBaseClass.ShowTypes). The options come after 'types':
+#
+#     ncsp aws types --gpus 8 --gpu V100         # 8 V100's in --region
+#     ncsp aws types --memory 256 --all-regions  # 256GiB or more, every region
+#     ncsp aws types refresh                     # query catalog again
+#
+def types_cmd(my_class, args):
+    ''' shows instance types picked by the options in args.arguments '''
+    
+    parser = argparse.ArgumentParser(prog="ncsp %s types" % my_class.ClassName())
+    parser.add_argument('--gpus', dest='gpus', type=int, default=None, 
+                        help='exactly this many GPUs')
+    parser.add_argument('--gpu', dest='gpu', default=None, 
+                        help='GPU model, like V100')
+    parser.add_argument('--vcpus', dest='vcpus', type=int, default=0, 
+                        help='at least this many vcpus')
+    parser.add_argument('--memory', dest='memory', type=float, default=0, 
+                        help='at least this much memory, GiB')
+    parser.add_argument('--network', dest='network', type=float, default=0, 
+                        help='at least this much network bandwidth, Gbps')
+    parser.add_argument('--all-regions', dest='all_regions', action='store_true', 
+                        help='in every region, and which ones have it')
+    parser.add_argument('refresh', nargs='?', choices=['refresh'], 
+                        help='query the catalog again, rather than use cached one')
+    query = parser.parse_args(args.arguments)
+    query.all_regions = query.all_regions or args.all_regions
+    query.refresh     = (query.refresh == "refresh")
+    return my_class.ShowTypes(args, query)
+
+# commands that use the region, and so query the regions list if it's not
+# cached yet to check --region
+
+region_cmds = [ "createVM", "startVM", "stopVM", "restartVM", "deleteVM", "status", 
+                "show", "test", "createNSG", "deleteNSG", "showNSGs", "running", "types" ]
+
+# fleet_cmd
+#
+# Runs the command on each of the selected fleet VMs. The args for each VM
+# are built the same way as for the single VM, but with the VM's saved args 
+# from the fleet registry in place of the args file:
+#
+#   1) hardcoded defaults, and values from the args file
+#   2) overridden by the VM's saved args in the fleet registry 
+#   3) overridden by any values specified on command line
+#
+# createVM creates the --vm named VMs that aren't in the registry yet, and 
+# --count N names N VMs NAME-1 .. NAME-N for each NAME. 
+#
+# With --parallel K, up to K VMs are worked on at the same time (but no more
+# than the CSP's MaxParallelVMs). The exit code is 0 only if the command 
+# worked on every one of the VMs
+#
+def fleet_cmd(my_class, parser, argv, args):
+    ''' runs the command on each of the VMs picked with --vm, --all, --tag or --count '''
+    
+    cmd   = args.command
+    names = fleet_names(args)
         
-        # save all the persistent args values to file after the above commands have
-        # run and modified them -- like the VM or SecurityGroup IDs
+    if (cmd == "createVM"):
+        if (args.all_vms or not names):
+            error("createVM needs the names of the VMs to create, use --vm NAME[,NAME..] or --count N")
+            return 1
+        selected = my_class.m_fleet.Select(names, False, None)
+    else:
+        selected = my_class.m_fleet.Select(names, args.all_vms, args.tags)
+    if (selected.__len__() == 0):
+        error("No VMs in fleet match the selection")
+        return 1
+    
+        # build each VM's args up front, the parser isn't shared between threads 
         
-    if (cmd != "DeleteVM"):
-        my_class.ArgSaveToFile(args)
+    base    = dict(vars(args))
+    results = {}
+    tasks   = []
+    for region, name, entry in selected:
+        defaults = dict(base)
+        if (entry != None):
+            defaults.update(entry["args"])
+        elif (cmd == "createVM"):
+            defaults.update({ "vm_name": name, "vm_id": None, "vm_ip": "" })
+        else:
+            error("VM \"%s\" is not in the fleet" % name)
+            results[(region, name)] = (1, 0.0)
+            continue
+        parser.set_defaults(**defaults)
+        tasks.append((fleet_run_one, (my_class, region, name, parser.parse_args(argv))))
+        
+    workers = max(1, min(args.parallel, my_class.MaxParallelVMs()))
+    if (args.parallel > workers):
+        debug(1, "%s limits fleet commands to %d VMs at a time" % (my_class.ClassName(), workers))
     
-    if rc == None:      # handle "None" return case -- should be an error? 
-        error("No return code for cmd \"%s\"" % cmd)
+        # all VMs share one security group. Create it before the VMs, or
+        # every one of them would try to create it at the same time
+        
+    if (cmd == "createVM" and workers > 1 and tasks.__len__() > 1):
+        rc = my_class.CreateNSG(args)
+        if (rc != 0):
+            return rc
+        for func, (my_class, region, name, vm_args) in tasks:
+            vm_args.nsg_id = args.nsg_id
+            
+    for region, name, rc, secs in run_parallel(tasks, workers):
+        results[(region, name)] = (rc, secs)  # same name may be in more than one region
+    
+        # one line per VM, and the overall result
+        
+    failed = [ name for region, name, entry in selected if results[(region, name)][0] != 0 ]
+    if (selected.__len__() > 1):
+        print ("# %-16s %-32s %4s %8s" % ("region", "vm", "rc", "secs"))
+        for region, name, entry in selected:
+            print ("  %-16s %-32s %4d %8.2f" % (region or args.region, name, 
+                                               results[(region, name)][0], results[(region, name)][1]))
+    if (failed.__len__() > 0):
+        error("\"%s\" failed on %d of %d VMs: %s" % (cmd, failed.__len__(), selected.__len__(), " ".join(failed)))
+        return 1
+    return 0
+
+def fleet_run_one(my_class, region, name, vm_args):
+    ''' runs command on a single fleet VM, returns (region, name, rc, secs) '''
+    
+    ts = clock_get().Now()
+    print ("# %s %s" % (vm_args.region, name))
+    rc = run_cmd(my_class, vm_args)
+    if (rc == None):
         rc = 2
+    
+        # save any changes (id, ip..) to its fleet registry entry, unless 
+        # it was deleted -- in which case it's already been taken out
+        
+    if (not (vm_args.command == "deleteVM" and rc == 0)):
+        my_class.FleetSave(vm_args)
+    return region, name, rc, clock_get().Now() - ts
 
-    return rc    # exit code
+def fleet_names(args):
+    ''' VM names from --vm, with --count N expanding each NAME to NAME-1..NAME-N '''
+    
+    names = args.vm_select
+    if (args.vm_count > 0):
+        prefixes = []
+        for item in (names or [args.vm_name]):
+            prefixes += [ name for name in item.split(",") if name != "" ]
+        names = [ "%s-%d" % (prefix, idx) for prefix in prefixes for idx in range(1, args.vm_count+1) ]
+    return names
+
+# sshall
+#
+# Runs the same ssh command on every one of the selected fleet VMs, all of
+# them if none are picked with --vm, --tag or --count. Up to --parallel K of
+# them at once (no more than the CSP's MaxParallelSsh). Each line of output
+# is printed as soon as it comes, starting with the VM's name:
+#
+#   ncsp aws --all --parallel 32 sshall nvidia-smi -L
+#   p3-1  | GPU 0: Tesla V100-SXM2-16GB (UUID: GPU-...)
+#   p3-2  | GPU 0: Tesla V100-SXM2-16GB (UUID: GPU-...)
+#
+# then a table of each VM's exit code, time and lines of output, how many 
+# VMs gave each exit code, and the VMs that took over slow_factor times as 
+# long as the median. The exit code is 0 only if it worked on every VM
+#
+slow_factor = 2.0
+
+def sshall_cmd(my_class, parser, argv, args):
+    ''' runs ssh command on the selected fleet VMs at the same time, output prefixed by VM name '''
+    
+    if (args.arguments.__len__() == 0):
+        error("sshall needs a command to run, like: sshall uptime")
+        return 1
+    names    = fleet_names(args)
+    selected = my_class.m_fleet.Select(names, args.all_vms or not (names or args.tags), args.tags)
+    missing  = [ name for region, name, entry in selected if entry == None ]
+    for name in missing:
+        error("VM \"%s\" is not in the fleet" % name)
+    if (missing.__len__() > 0):
+        return 1
+    if (selected.__len__() == 0):
+        error("No VMs in fleet match the selection")
+        return 1
+    
+        # build each VM's args up front, the parser isn't shared between threads 
+        
+    base  = dict(vars(args))
+    tasks = []
+    width = max([ name.__len__() for region, name, entry in selected ])
+    lock  = threading.Lock()
+    for region, name, entry in selected:
+        defaults = dict(base)
+        defaults.update(entry["args"])
+        parser.set_defaults(**defaults)
+        tasks.append((sshall_run_one, (my_class, name, parser.parse_args(argv), width, lock)))
+        
+    workers = max(1, min(args.parallel, my_class.MaxParallelSsh()))
+    start   = clock_get().Now()
+    results = run_parallel(tasks, workers)
+    secs    = clock_get().Now() - start
+    
+        # one line per VM, then the exit codes and slow VMs of them all
+        
+    print ("# %-32s %4s %8s %6s" % ("vm", "rc", "secs", "lines"))
+    for name, rc, took, lines in results:
+        print ("  %-32s %4d %8.2f %6d" % (name, rc, took, lines))
+        
+    codes = {}
+    for name, rc, took, lines in results:
+        codes.setdefault(rc, []).append(name)
+    times  = sorted([ took for name, rc, took, lines in results ])
+    median = percentile(times, 50)
+    slow   = [ name for name, rc, took, lines in results if took > median * slow_factor ]
+    print ("# \"%s\" on %d VMs in %.2f secs, %d at a time" % (" ".join(args.arguments), results.__len__(), secs, workers))
+    print ("# exit codes: %s" % ", ".join([ "%d: %d VMs" % (rc, codes[rc].__len__()) for rc in sorted(codes) ]))
+    print ("# secs min:%.2f p50:%.2f p95:%.2f max:%.2f" % (times[0], median, percentile(times, 95), times[-1]))
+    if (slow.__len__() > 0):
+        print ("# slow, over %gx p50: %s" % (slow_factor, " ".join(slow)))
+    
+    failed = [ name for name, rc, took, lines in results if rc != 0 ]
+    if (failed.__len__() > 0):
+        error("\"sshall\" failed on %d of %d VMs: %s" % (failed.__len__(), results.__len__(), " ".join(failed)))
+        return 1
+    return 0
+
+def sshall_run_one(my_class, name, vm_args, width, lock):
+    ''' runs ssh command on one VM, prints its output lines, returns (name, rc, secs, lines) '''
+    
+    count = [ 0 ]
+    
+    def online(line):
+        with lock:                          # whole lines, not mixed with other VMs
+            sys.stdout.write("%-*s | %s\n" % (width, name, line))
+            sys.stdout.flush()
+        count[0] += 1
+        
+    ts = clock_get().Now()
+    rc = my_class.SshStream(vm_args, vm_args.arguments, online)
+    return name, rc, clock_get().Now() - ts, count[0]
+    
+# batch
+#
+# Runs the ncsp commands in a file (or stdin), one after another, in this
+# one process. The CSP's class, with its cli setup check, query cache and
+# shared ssh connections, is loaded once for all of them. Each line is what 
+# would follow 'ncsp <csp>', and any options given before 'batch' apply to
+# every one of them:
+#
+#    # stest, in one ncsp
+#    createVM
+#    repeat 10
+#        ssh uptime
+#        stopVM
+#        sleep 10
+#        startVM
+#    end
+#    on-error continue
+#    deleteVM
+#
+# with these lines that aren't commands
+#
+#    on-error stop        stop at first command that fails (the default)
+#    on-error continue    keep going, exit code is the worst of them
+#    on-error retry N     run a failed command up to N more times, then stop
+#    repeat N .. end      runs the lines in between N times, can be nested
+#    sleep SECS           waits
+#    echo TEXT            prints TEXT
+#
+# At the end, a table of each line's runs, failures and times
+#
+def batch_cmd(my_class, options, arguments):
+    ''' runs each ncsp command in file arguments[0] (or stdin), returns worst exit code '''
+    
+    if (arguments.__len__() == 0 or arguments[0] == "-"):
+        fname = "<stdin>"
+        lines = sys.stdin.readlines()
+    else:
+        fname = arguments[0]
+        try:
+            with open(os.path.expanduser(fname), "r") as f:
+                lines = f.readlines()
+        except IOError, err:
+            error("Can't read batch file \"%s\": %s" % (fname, err))
+            return 1
+    
+        # parse into nested lists of steps, checking it all before running any
+        
+    steps = []
+    stack = [ steps ]
+    for lineno in range(0, lines.__len__()):
+        try:
+            tokens = shlex.split(lines[lineno], True)      # and drop '#' comments
+        except ValueError, err:
+            error("%s:%d: %s" % (fname, lineno+1, err))
+            return 1
+        if (tokens.__len__() == 0):
+            continue
+        word = tokens[0]
+        line = " ".join(tokens)
+        if (word == "repeat" and tokens.__len__() == 2 and tokens[1].isdigit()):
+            loop = []
+            stack[-1].append(("repeat", lineno, int(tokens[1]), loop))
+            stack.append(loop)
+        elif (word == "end" and tokens.__len__() == 1 and stack.__len__() > 1):
+            stack.pop()
+        elif (word == "on-error" and tokens[1:] in (["stop"], ["continue"]) or 
+              word == "on-error" and tokens.__len__() == 3 and tokens[1] == "retry" and tokens[2].isdigit()):
+            stack[-1].append(("on-error", lineno, tokens[1:], None))
+        elif (word == "sleep" and tokens.__len__() == 2):
+            try:
+                stack[-1].append(("sleep", lineno, float(tokens[1]), None))
+            except ValueError:
+                error("%s:%d: sleep needs a number of seconds" % (fname, lineno+1))
+                return 1
+        elif (word == "echo"):
+            stack[-1].append(("echo", lineno, " ".join(tokens[1:]), None))
+        elif (word in [ "repeat", "end", "on-error", "batch" ]):
+            error("%s:%d: can't use \"%s\"" % (fname, lineno+1, line))
+            return 1
+        else:
+            stack[-1].append(("cmd", lineno, tokens, line))
+    if (stack.__len__() > 1):
+        error("%s: 'repeat' without an 'end'" % fname)
+        return 1
+    
+    state = { "policy": ["stop"], "rc": 0, "times": {} }
+    start = clock_get().Now()
+    batch_run(my_class, options, steps, state)
+    secs  = clock_get().Now() - start
+    
+        # each command line, in file order
+        
+    print ("# %-40s %5s %5s %9s %8s %8s %8s" % ("step", "runs", "fail", "total", "min", "p50", "max"))
+    runs  = 0
+    fails = 0
+    for lineno in sorted(state["times"]):
+        line, results = state["times"][lineno]
+        times = sorted([ took for rc, took in results ])
+        nfail = [ rc for rc, took in results if rc != 0 ].__len__()
+        print ("  %-40s %5d %5d %9.2f %8.2f %8.2f %8.2f" % 
+               (line[0:40], results.__len__(), nfail, sum(times), times[0], percentile(times, 50), times[-1]))
+        runs  += results.__len__()
+        fails += nfail
+    print ("# %s: %d commands in %.2f secs, %d failed" % (fname, runs, secs, fails))
+    return state["rc"]
 
+def batch_run(my_class, options, steps, state):
+    ''' runs the list of batch steps, False if batch is to stop '''
+    
+    for kind, lineno, value, extra in steps:
+        if (kind == "on-error"):
+            state["policy"] = value
+        elif (kind == "echo"):
+            print (value)
+        elif (kind == "sleep"):
+            clock_get().Sleep(value)
+        elif (kind == "repeat"):
+            for loop in range(0, value):
+                if (batch_run(my_class, options, extra, state) == False):
+                    return False
+        else:
+            policy  = state["policy"]
+            retries = 0
+            if (policy[0] == "retry"):
+                retries = int(policy[1])
+            while True:
+                print ("# %s" % extra)
+                ts = clock_get().Now()
+                try:
+                    rc = process_cmd(my_class, options + value)
+                except SystemExit, err:                 # usage, or bad option
+                    rc = err.code if isinstance(err.code, int) else 1
+                state["times"].setdefault(lineno, (extra, []))[1].append((rc, clock_get().Now() - ts))
+                if (rc == 0 or retries == 0):
+                    break
+                retries -= 1
+            if (rc != 0):
+                state["rc"] = max(state["rc"], rc)
+                if (policy[0] != "continue"):
+                    error("\"%s\" failed, rc:%d -- stopping" % (extra, rc))
+                    return False
+    return True
+    
 ###############################################################################
 # do_csp_cmd
 #
@@ -586,7 +1334,10 @@ def process_cmd(my_class, argv):
 # "csp".py name with interfaces that are same as the other examples
 # and drop it into the directory with the other csp-specific files 
 #
-# NOTE: find_module() does not handle dotted package names, 
+# The file is found from the plugin registry (see get_plugins), and only
+# this one csp's file is imported
+#
+# NOTE: load_module() does not handle dotted package names, 
 #       so keep the file structure simple
 #
 # See: https://pymotw.com/2/imp/    (1/2018)
@@ -594,76 +1345,141 @@ def process_cmd(my_class, argv):
 def do_csp_cmd(csp, argv): 
     ''' import csp dependent class based on name, and run command on it '''
     
-    import imp
-    module_name      = "%s_funcs" % csp
-    try:
-        f, filename, description = imp.find_module(module_name)
-        package = imp.load_module(module_name, f, filename, description)
-        my_class = package.CSPClass(csp, module_path)
-    except ImportError, err:
-        print "Error: CSP \"%s\" not supprted: %s" %(csp, err)
-        sys.exit(1)             # unhappy return
+    my_class = load_csp(csp)
     
         # process the command line arguments on class (does all the work)
         
-    rc = process_cmd(my_class, sys.argv[2:])
+    rc = process_cmd(my_class, argv)
     return rc
 
+def load_csp(csp):
+    ''' CSPClass of the csp, its module imported and class created on first use '''
+    
+    if (csp not in csp_classes):        # ncspd loads them before its children fork
+        if (get_plugins().Exists(csp) == False):
+            print "Error: CSP \"%s\" not supprted: no %s_funcs.py in %s" %(csp, csp, get_plugins().m_dir)
+            sys.exit(1)             # unhappy return
+        try:
+            package = get_plugins().Load(csp)
+            csp_classes[csp] = package.CSPClass(csp, module_path)
+            csp_classes[csp].m_setup_ok = csp in setup_checked
+        except ImportError, err:
+            print "Error: CSP \"%s\" not supprted: %s" %(csp, err)
+            sys.exit(1)             # unhappy return
+    return csp_classes[csp]
+
+csp_classes = {}                    # CSPClass of each csp name, see load_csp
+setup_checked = set()               # csp's an earlier command set up ok, kept by ncspd
+
+###############################################################################
+# do_all_cmd
+#
+# The 'ALL' pseudo-csp. Runs the command on every csp at the same time, each 
+# in its own ncsp process so that nothing (trace level, loaded modules, exits) 
+# is shared between them. Each one's output is collected, then printed out 
+# in csp order once they have all finished, followed by a summary of how 
+# each one did. 
+#
+# Takes as long as the slowest csp, rather than the sum of all of them. 
+#
+def do_all_cmd(argv):
+    ''' runs command on all csps concurrently, returns the worst exit code '''
+    
+    csp_list = get_csp_list()
+    results  = run_parallel([ (all_run_one, (csp, argv)) for csp in csp_list ], csp_list.__len__())
+    
+        # output from each, in order
+        
+    for idx in range(0, csp_list.__len__()):
+        rc, output, secs = results[idx]
+        print ("# %s" % csp_list[idx])
+        sys.stdout.write(output)
+        
+        # and the summary
+        
+    print ("")
+    print ("# %-10s %4s %8s" % ("csp", "rc", "secs"))
+    rc = 0
+    for idx in range(0, csp_list.__len__()):
+        print ("  %-10s %4d %8.2f" % (csp_list[idx], results[idx][0], results[idx][2]))
+        if (results[idx][0] != 0):      # killed by a signal is negative
+            rc = max(rc, abs(results[idx][0]))
+    return rc
+
+def all_run_one(csp, argv):
+    ''' runs "ncsp <csp> argv.." as a child process, returns (rc, output, secs) '''
+    
+    import subprocess
+    ts    = monotonic_time()                                    # child's real run time
+    devnull = open(os.devnull, "r")
+    try:
+        child = subprocess.Popen([sys.executable, sys.argv[0], csp] + argv, 
+                                 stdin=devnull,                 # no interactive prompts
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, errval = child.communicate()                    # stderr is in output
+    finally:
+        devnull.close()
+    return child.returncode, output, monotonic_time() - ts
+
 ###############################################################################
 # main body of nsp application. Code starts here. 
 # 
-# Loads the csp specific csp module and does the work
+# Loads the csp specific csp module and does the work. If ncspd is running
+# the command was sent to it instead (see top), and it calls run()
 #
+def run(argv):
+    ''' runs the ncsp command line argv, returns exit code '''
+    
+    global module_path
     
-    # argv[0] is the full path to the prog name -- from it we can get 
-    # the path where our modules will be, used for search later
+        # argv[0] is the full path to the prog name -- from it we can get 
+        # the path where our modules will be, used for search later
 
-try:
-    pos = sys.argv[0].rfind("/")
-    module_path = sys.argv[0][0:pos+1]
-except:
-    module_path = sys.argv[0]  
+    try:
+        pos = argv[0].rfind("/")
+        module_path = argv[0][0:pos+1]
+    except:
+        module_path = argv[0]  
 
-if (sys.argv.__len__() == 1):               # no arguments, print usage
-    usage(module_path)      
+    if (argv.__len__() == 1):                   # no arguments, print usage
+        usage(module_path)      
     
-    # if we have one arg, it's probably the csp name, but there are
-    # few special options like 'help' or 'csps' that are also allowed
+        # if we have one arg, it's probably the csp name, but there are
+        # few special options like 'help' or 'csps' that are also allowed
     
-arg1=sys.argv[1]                            # our csp name, like "aws",
+    arg1=argv[1]                                # our csp name, like "aws",
                                     
 
-if (arg1 == "help" or arg1[0:1] == '-'):    # be nice if user is confused
-    usage(module_path)                      # usage exits, does not return  
-elif (arg1 == "csps"):                      # list all known CSP classes
-    rc = show_csps()
-    sys.exit(rc)
+    if (arg1 == "help" or arg1[0:1] == '-'):    # be nice if user is confused
+        usage(module_path)                      # usage exits, does not return  
+    elif (arg1 == "csps"):                      # list all known CSP classes
+        return show_csps()
+    elif (arg1 == "complete"):                  # bash tab completion, see complete_cmd
+        return complete_cmd(argv[2:])
+    elif (arg1 == "report"):                    # test results, for given or all csps
+        return show_report(results_files(argv[2:]))
 
-    # from here on out, we are doing a CSP depenent function -- so
-    # need at least one more argument beyond the CSP name
+        # from here on out, we are doing a CSP depenent function -- so
+        # need at least one more argument beyond the CSP name
     
-csp = arg1                                  # name of the csp are we talking about
-if (sys.argv.__len__() <= 2):
-    usage(module_path)                      # not enough args, exit with usage
-
-    # from here on, the argument list starts with the 2nd value 
-    
-argv=sys.argv[2:]
-
-    # if csp is 'all', then run the given command on all of csp's that are 
-    # active (don't complain about those CSP's that fail the CSPSetupOK test)
-    # Also don't run 'template' class -- we want the good stuff here
+    csp = arg1                                  # name of the csp are we talking about
+    if (argv.__len__() <= 2):
+        usage(module_path)                      # not enough args, exit with usage
 
+        # if csp is 'all', then run the given command on all of csp's that are 
+        # active, all at the same time (see do_all_cmd). 
+        # Also don't run 'template' or 'sim' classes -- we want the good stuff here
 
-if (csp == "ALL"):
-    csp_list = get_csp_list()
-    for csp in csp_list:
-        rc = do_csp_cmd(csp, argv)
-else:
-    # single csp is given -- run it. 
-    # parse the rest of the command line and run it on the given CSP
+    if (csp == "ALL"):
+        rc = do_all_cmd(argv[2:])
+    else:
+        # single csp is given -- run it. 
+        # parse the rest of the command line and run it on the given CSP
     
-    rc = do_csp_cmd(csp, argv)
-sys.exit(rc)
+        rc = do_csp_cmd(csp, argv[2:])
+    return rc
 
+module_path = ""
 
+if __name__ == "__main__":
+    sys.exit(run(sys.argv))
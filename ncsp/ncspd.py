@@ -0,0 +1,497 @@
+#!/usr/bin/python
+# ncspd.py                                                   10/16/2026
+#
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Optional ncsp daemon -- keeps ncsp loaded between commands
+#
+# Every './ncsp <csp> cmd' starts python, imports the <csp>_funcs module,
+# checks the CSP's cli is set up (which runs the cli), builds the arg parser
+# and reads the args. Scripts like ctest and stest do this dozens of times.
+# ncspd loads ncsp and every CSP's module, and creates their CSPClass's,
+# once. It remembers which CSP's cli setup check passed, so a command only
+# has to parse its args and do its own work
+#
+#    ./ncspd start            # starts it in the background
+#    ./ncspd status           # pid, uptime, commands run, csps loaded
+#    ./ncspd stop             # stops it
+#    ./ncspd run              # runs it in the foreground, for debugging
+#
+# While it's running, ./ncsp sends its command line over a unix socket in
+# ~/ncsp/ and prints what comes back -- stdout, stderr and the exit code --
+# instead of running the command itself. Nothing else changes, scripts
+# don't have to know it's there. If it's not running, ncsp runs the command
+# itself as always. NCSPD=0 in the environment also does that
+#
+# The command is run in ncsp's environment, not the daemon's, so AWS_PROFILE
+# and the like are what they are in the shell ncsp was run from. One with a
+# different HOME (so a different ~/ncsp/) is sent back to ncsp to run
+#
+# Each command is run in a forked child of the daemon, which starts with all
+# of that already loaded. Commands from different shells run at the same
+# time, and a command whose ncsp goes away (^C on an 'ssh .. tail -f') is
+# killed, along with the cli's and ssh's it started. When default_max_running are already going, the command is
+# sent back to ncsp to run. An interactive 'ssh' (one without a command to
+# run), and a 'batch' reading stdin, are always run by ncsp itself. Output
+# of the cli's and other commands the daemon runs is passed back too, see
+# DoCmdNoError
+#
+
+import os
+import sys
+import json
+import socket
+import select
+import signal
+import errno
+
+default_socket = "~/ncsp/ncspd.sock"       # per user, like the rest of ~/ncsp/
+default_log    = "~/ncsp/ncspd.log"        # daemon's own output when in background
+default_max_running = 8                    # commands at once, more are run by ncsp itself
+
+def socket_name():
+    ''' full path to the daemon's unix socket '''
+
+    return os.path.expanduser(default_socket)
+
+def send_line(conn, msg):
+    ''' sends one json message, a line of its own '''
+
+    conn.sendall(json.dumps(msg) + "\n")
+
+def read_lines(conn):
+    ''' yields each json message line from the connection, till it's closed '''
+
+    pending = ""
+    while True:
+        data = conn.recv(65536)
+        if (data == ""):
+            return
+        pending += data
+        while ("\n" in pending):
+            line, pending = pending.split("\n", 1)
+            yield json.loads(line)
+
+def connect(timeout=None):
+    ''' connection to daemon, None if it's not running '''
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(socket_name())
+    except socket.error:
+        conn.close()
+        return None                         # no socket file, or no one listening
+    conn.settimeout(None)
+    return conn
+
+##############################################################################
+# client
+#
+# Sends ncsp's command line to the daemon, passing on its output as it comes
+#
+# Returns:    exit code of the command, None if the daemon isn't running
+#             (or is not wanted) and ncsp should run the command itself
+#
+def client(argv):
+    ''' runs ncsp command line in the daemon, if there is one '''
+
+    if (os.environ.get("NCSPD", "1") == "0"):
+        return None
+    if (argv[-1] == "ssh"):
+        return None                         # interactive, needs our terminal and stdin
+    if (argv[-1] == "batch" or argv[-2:] == ["batch", "-"]):
+        return None                         # reads our stdin
+
+    conn = connect()
+    if (conn == None):
+        return None
+
+    rc = 1
+    try:
+        send_line(conn, { "argv": argv, "cwd": os.getcwd(), "env": dict(os.environ) })
+        for msg in read_lines(conn):
+            if ("local" in msg):
+                return None                 # daemon won't, run it ourselves
+            if ("o" in msg):
+                sys.stdout.write(msg["o"].encode("utf-8"))
+                sys.stdout.flush()
+            elif ("e" in msg):
+                sys.stderr.write(msg["e"].encode("utf-8"))
+                sys.stderr.flush()
+            elif ("rc" in msg):
+                rc = msg["rc"]
+    finally:
+        conn.close()
+    return rc
+
+def forward():
+    ''' has the daemon run this ncsp's command, and exits with its exit code if it did '''
+
+    rc = client(sys.argv)
+    if (rc != None):
+        sys.exit(rc)
+
+##############################################################################
+# daemon side
+#
+# Output written by the command goes back to the client in messages, a line
+# (or a flush) at a time. Threads of the command (fleet commands, sshall)
+# share it, so each message is sent whole
+#
+class ClientWriter:
+    ''' file like object, sending what's written to the client as "o" or "e" messages '''
+
+    def __init__(self, conn, key, lock):
+        self.m_conn    = conn
+        self.m_key     = key                # "o" stdout, "e" stderr
+        self.m_lock    = lock               # shared by stdout and stderr
+        self.m_pending = ""
+        self.m_gone    = False              # client went away, drop output
+
+    def write(self, data):
+        if (isinstance(data, unicode) == False):
+            data = data.decode("utf-8", "replace")
+        with self.m_lock:
+            self.m_pending += data
+            if ("\n" in data):
+                self.Send()
+
+    def flush(self):
+        with self.m_lock:
+            self.Send()
+
+    def Send(self):
+        if (self.m_pending == ""):
+            return
+        if (self.m_gone == False):
+            try:
+                send_line(self.m_conn, { self.m_key: self.m_pending })
+            except socket.error:
+                self.m_gone = True          # command keeps going without it
+        self.m_pending = ""
+
+    def isatty(self):
+        return False
+
+class Daemon:
+    ''' serves ncsp commands on the unix socket, each in a child process '''
+
+    def __init__(self):
+        import time
+        import threading
+        import ncsp
+
+        self.m_ncsp      = ncsp             # ncsp.py, loaded once
+        self.m_started   = time.time()
+        self.m_commands  = 0
+        self.m_lock      = threading.Lock()
+        self.m_listen    = None
+        self.m_running   = {}               # pid: { "conn", "done" } of each child
+
+    def Preload(self):
+        ''' imports every csp's module and creates its CSPClass, for the children to inherit '''
+
+            # only what doesn't touch the network or the state store, so
+            # nothing is shared with children that shouldn't be. The cli
+            # setup check is still done by the first command of each csp
+
+        self.m_ncsp.module_path = os.path.dirname(os.path.abspath(__file__)) + "/"
+        for csp in self.m_ncsp.get_plugins().Names():
+            try:
+                self.m_ncsp.load_csp(csp)
+            except SystemExit:
+                pass                        # load_csp said why, ncsp will again
+
+    def Listen(self):
+        ''' binds the socket, 1 if another daemon already has it '''
+
+        fname = socket_name()
+        if (connect(1) != None):
+            print ("ncspd already running on %s" % fname)
+            return 1
+        if (os.path.exists(fname)):
+            os.remove(fname)                # left by one that didn't stop cleanly
+        if (os.path.isdir(os.path.dirname(fname)) == False):
+            os.makedirs(os.path.dirname(fname))
+        self.m_listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)              # only this user's ncsp's, from the start
+        try:
+            self.m_listen.bind(fname)
+        finally:
+            os.umask(umask)
+        os.chmod(fname, 0600)
+        self.m_listen.listen(16)
+        return 0
+
+    def Serve(self):
+        ''' answers requests till told to stop '''
+
+        print ("ncspd %d listening on %s" % (os.getpid(), socket_name()))
+        sys.stdout.flush()
+
+        running = True
+        while (running):
+
+                # new requests, clients that went away, and children that
+                # are done -- whichever comes first
+
+            watched = [ self.m_listen ]
+            for job in self.m_running.values():
+                watched += [ fd for fd in (job["conn"], job["done"]) if fd != None ]
+            try:
+                ready = select.select(watched, [], [], 1.0)[0]
+            except select.error, err:
+                if (err[0] == errno.EINTR):
+                    continue
+                raise
+            for pid, job in self.m_running.items():
+                if (job["done"] != None and job["done"] in ready):
+                    self.Finished(job)
+                if (job["conn"] != None and job["conn"] in ready):
+                    self.Cancel(pid, job)
+            self.Reap()
+            if (self.m_listen in ready):
+                running = self.Accept()
+
+        self.m_listen.close()
+        os.remove(socket_name())
+        return 0
+
+    def Accept(self):
+        ''' takes the next connection and its request, False when it's time to stop '''
+
+        try:
+            conn, addr = self.m_listen.accept()
+        except socket.error, err:
+            if (err.errno == errno.EINTR):
+                return True
+            raise
+        running = True
+        try:
+            conn.settimeout(10)             # for the request, the rest can take a while
+            for msg in read_lines(conn):
+                conn.settimeout(None)
+                running = self.Request(conn, msg)
+                break                       # one request per connection
+        except socket.error:
+            pass                            # client went away, or never said anything
+        conn.close()                        # child has its own, see Start
+        return running
+
+    def Request(self, conn, msg):
+        ''' does what's asked, False when it's time to stop '''
+
+        import time
+
+        if ("stop" in msg):
+            send_line(conn, { "o": "ncspd %d stopped\n" % os.getpid() })
+            send_line(conn, { "rc": 0 })
+            return False
+        if ("status" in msg):
+            send_line(conn, { "o": "ncspd %d up %.0f secs, %d commands, %d running, csps: %s\n" %
+                              (os.getpid(), time.time() - self.m_started, self.m_commands,
+                               self.m_running.__len__(), " ".join(sorted(self.m_ncsp.setup_checked))) })
+            send_line(conn, { "rc": 0 })
+            return True
+
+        if (msg["env"].get("HOME") != os.environ.get("HOME")):
+            send_line(conn, { "local": True })      # its ~/ncsp/ isn't ours
+            return True
+
+        self.Start(conn, msg)
+        return True
+
+    def Start(self, conn, msg):
+        ''' forks a child to run the command, or has ncsp run it when too many are '''
+
+        if (self.m_running.__len__() >= default_max_running):
+            send_line(conn, { "local": True })
+            return
+
+        done_r, done_w = os.pipe()          # child says it's done, before its exit code
+        pid = os.fork()
+        if (pid == 0):
+            os.close(done_r)
+            self.Child(conn, msg, done_w)   # does not return
+        os.close(done_w)
+        try:
+            os.setpgid(pid, pid)            # either one of us can be first
+        except OSError:
+            pass
+        self.m_commands += 1
+        self.m_running[pid] = { "conn": conn.dup(), "done": done_r }
+
+    def Child(self, conn, msg, done):
+        ''' runs the command in the forked child, never returns '''
+
+        try:
+            os.setpgid(0, 0)                # so Cancel gets its cli's and ssh's too
+            self.m_listen.close()
+            for job in self.m_running.values():
+                for fd in (job["conn"], job["done"]):
+                    if (isinstance(fd, int)):
+                        os.close(fd)
+                    elif (fd != None):
+                        fd.close()
+
+            rc = self.Run(conn, msg["argv"], msg["cwd"], msg["env"])
+
+                # csp's whose setup check passed, for the next ones to skip 
+
+            checked = [ csp for csp, my_class in self.m_ncsp.csp_classes.items() if my_class.m_setup_ok ]
+            os.write(done, json.dumps(checked))
+            os.close(done)
+            send_line(conn, { "rc": rc })
+        finally:
+            os._exit(0)                     # the daemon's code is the parent's to run
+
+    def Finished(self, job):
+        ''' child is done with its command, or has died '''
+
+        data = os.read(job["done"], 65536)
+        if (data != ""):
+            self.m_ncsp.setup_checked.update(json.loads(data))
+        os.close(job["done"])
+        job["done"] = None
+        if (job["conn"] != None):
+            job["conn"].close()             # nothing to cancel now
+            job["conn"] = None
+
+    def Cancel(self, pid, job):
+        ''' client of a running command went away, kills the command '''
+
+        try:
+            data = job["conn"].recv(4096)
+        except socket.error:
+            data = ""
+        if (data != ""):
+            return                          # clients don't say more, but ignore it
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass                            # already gone
+        job["conn"].close()
+        job["conn"] = None
+
+    def Reap(self):
+        ''' forgets children that have exited '''
+
+        while (self.m_running.__len__() > 0):
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if (pid == 0):
+                return
+            job = self.m_running.pop(pid, None)
+            if (job != None and job["done"] != None):
+                self.Finished(job)
+
+    def Run(self, conn, argv, cwd, env):
+        ''' runs the ncsp command line, its output going to the client, returns exit code '''
+
+        import traceback
+
+        sys.stdout = ClientWriter(conn, "o", self.m_lock)
+        sys.stderr = ClientWriter(conn, "e", self.m_lock)
+
+            # the command is run just as if ncsp had been started with it,
+            # including sys.argv, which the ALL csp uses to start the others
+
+        sys.argv = argv
+        os.environ.clear()                  # cli's and ssh get it from here too
+        os.environ.update(env)
+        os.environ["NCSPD"] = "0"           # ncsp's it starts (the ALL csp's) run themselves
+        try:
+            os.chdir(cwd)
+            rc = self.m_ncsp.run(argv)
+        except SystemExit, err:             # usage(), argparse errors
+            if (err.code == None):
+                rc = 0
+            elif (isinstance(err.code, int)):
+                rc = err.code
+            else:
+                sys.stderr.write("%s\n" % err.code)
+                rc = 1
+        except:
+            traceback.print_exc()           # goes to the client
+            rc = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return rc
+
+def request(msg):
+    ''' sends a stop or status request to the daemon, prints the answer '''
+
+    conn = connect(5)
+    if (conn == None):
+        print ("ncspd not running")
+        return 1
+    rc = 1
+    send_line(conn, msg)
+    for reply in read_lines(conn):
+        if ("o" in reply):
+            sys.stdout.write(reply["o"])
+        elif ("rc" in reply):
+            rc = reply["rc"]
+    conn.close()
+    return rc
+
+def start():
+    ''' starts the daemon in the background, waits till it's answering '''
+
+    import time
+    import subprocess
+
+    if (connect(1) != None):
+        print ("ncspd already running on %s" % socket_name())
+        return 0
+
+    fname = os.path.expanduser(default_log)
+    if (os.path.isdir(os.path.dirname(fname)) == False):
+        os.makedirs(os.path.dirname(fname))     # first thing run, before any ncsp
+    log = open(fname, "a")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "run"],
+                             stdin=open(os.devnull, "r"), stdout=log, stderr=log,
+                             close_fds=True, preexec_fn=os.setsid)   # not killed with our terminal
+    for i in range(0, 100):
+        if (child.poll() != None):
+            print ("ncspd failed to start, see %s" % default_log)
+            return 1
+        conn = connect(1)
+        if (conn != None):
+            conn.close()
+            print ("ncspd %d started" % child.pid)
+            return 0
+        time.sleep(0.1)
+    print ("ncspd not answering, see %s" % default_log)
+    return 1
+
+def main(argv):
+    ''' ncspd start|stop|status|run '''
+
+    cmd = "help"
+    if (argv.__len__() > 1):
+        cmd = argv[1]
+
+    if (cmd == "start"):
+        return start()
+    elif (cmd == "stop"):
+        return request({ "stop": True })
+    elif (cmd == "status"):
+        return request({ "status": True })
+    elif (cmd == "run"):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        daemon = Daemon()
+        rc = daemon.Listen()
+        if (rc != 0):
+            return rc
+        daemon.Preload()
+        return daemon.Serve()
+
+    print ("usage: ncspd start|stop|status|run")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
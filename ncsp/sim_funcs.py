@@ -0,0 +1,1028 @@
+# sim_funcs.py                                               10/16/2026
+#
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Simulated CSP -- no cloud account, no cli, no real VMs
+#
+# The following line is use with the help text to provide info for this
+# class without the expense of actually importing the python class.
+#
+# HELPTEXT: "Simulated CSP, fake VMs with sampled latencies and errors, for offline load tests"
+#
+# Keeps VM and Network Security Group state machines in memory, shared with
+# any other ncsp's running at the same time through a json file in the data
+# directory. Everything the real CSPs make ncsp wait on is sampled from
+# configurable distributions:
+#
+#    api         each api call (describe, create, stop...)
+#    create      'pending' till 'running'
+#    boot        'running' till the VM answers pings, fast or slow (bimodal)
+#    sshd        answering pings till the ssh server is up
+#    stop        'stopping' till 'stopped'
+#    start       'pending' till 'running' again
+#    reboot      still 'running', but not answering for this long
+#    terminate   'shutting-down' till 'terminated'
+#
+# Api calls fail at --sim_error_rate and get throttled at --sim_throttle_rate,
+# and are retried with backoff, as a real CSP's would need to be. Each VM's
+# ssh server is a loopback tcp listener that gives a ssh banner once the VM
+# is up, so the real ssh probe code in the baseclass is what waits on it.
+#
+# --sim_speed scales all the times (and polling), 0.01 runs 100 times faster
+# so fleet commands on hundreds of VMs can be run in seconds:
+#
+#    ./ncsp sim --sim_speed 0.01 --count 200 --parallel 200 createVM
+#
+# or, with --clock virtual, no real time goes by at all. The latest virtual
+# time is kept with the VMs, and the next --clock virtual command starts
+# from it, so VMs a command waited on are still ready for the next one.
+# Don't mix virtual and real clock commands on the same VMs, their times
+# won't agree
+#
+
+import json
+import time
+import os
+import math
+import uuid
+import random
+import socket
+import select
+import fcntl
+import threading
+import contextlib
+import atexit
+from cspbaseclass import CSPBaseClass
+from cspbaseclass import error, trace, debug
+from cspbaseclass import clock_get
+
+##############################################################################
+# some sim defaults values
+##############################################################################
+
+default_key_name            = "sim-key"
+default_region              = "sim-east"
+default_user                = "sim"
+
+default_image_name      = "Simulated Ubuntu 16.04"
+default_instance_type   = "sim.small"
+
+    # simulated instance types: vcpus, memory GiB, gpus, gpu, network Gbps,
+    # and the regions that have them (None is all of them). See 'types'
+
+default_sim_types = { "sim.small":  (2,   4.0,   0, "",          1.0,  None),
+                      "sim.large":  (16,  64.0,  0, "",          10.0, None),
+                      "sim.gpu1":   (8,   61.0,  1, "Sim V100",  10.0, None),
+                      "sim.gpu4":   (32,  244.0, 4, "Sim V100",  10.0, ["sim-east", "sim-west"]),
+                      "sim.gpu8":   (64,  488.0, 8, "Sim V100",  25.0, ["sim-east"]) }
+
+TIMEOUT_1 = (60 * 4) # create, start, terminate -- scaled by --sim_speed
+TIMEOUT_2 = (60 * 4) # stop, ping
+
+##############################################################################
+# Simulated latencies, seconds before --sim_speed scaling. Each is one of
+#
+#    ("fixed",     secs)
+#    ("uniform",   low, high)
+#    ("lognormal", median, sigma)            long tailed, like most latencies
+#    ("bimodal",   p, dist1, dist2)          dist1 with probability p, else dist2
+#
+# A --sim_config json file can replace any of them: {"boot": ["fixed", 30]}
+##############################################################################
+
+default_sim_latencies = { "api":       ("lognormal", 0.3, 0.4),
+                          "create":    ("lognormal", 15.0, 0.3),
+                          "boot":      ("bimodal", 0.8, ("lognormal", 20.0, 0.2),
+                                                        ("lognormal", 60.0, 0.3)),
+                          "sshd":      ("uniform", 1.0, 5.0),
+                          "stop":      ("lognormal", 10.0, 0.3),
+                          "start":     ("lognormal", 8.0, 0.3),
+                          "reboot":    ("uniform", 3.0, 8.0),
+                          "terminate": ("lognormal", 20.0, 0.3),
+                          "ssh":       ("lognormal", 0.4, 0.3),
+                          "ping":      ("fixed", 0.05) }
+
+default_sim_error_rate      = 0.02          # api calls that fail, but can be retried
+default_sim_throttle_rate   = 0.05          # api calls that are throttled
+default_sim_retries         = 5             # tries of a failed api call before giving up
+default_max_parallel_vms    = 256
+
+    # backoff for retrying failed api calls, see PollSettings
+
+default_poll_policies = { "api.retry":  (0.5, 2.0, 8.0, 0.5) }
+
+def sim_sample(spec, rng):
+    ''' returns seconds sampled from a latency distribution spec '''
+
+    kind = spec[0]
+    if (kind == "fixed"):
+        return float(spec[1])
+    elif (kind == "uniform"):
+        return rng.uniform(spec[1], spec[2])
+    elif (kind == "lognormal"):
+        return rng.lognormvariate(math.log(spec[1]), spec[2])
+    elif (kind == "bimodal"):
+        if (rng.random() < spec[1]):
+            return sim_sample(spec[2], rng)
+        return sim_sample(spec[3], rng)
+    raise ValueError("unknown latency distribution \"%s\"" % kind)
+
+##############################################################################
+# SimWorld
+#
+# The simulated CSP's VMs and NSGs. A VM's state changes on its own once
+# a time is reached ('pending' becomes 'running' at "until"), so nothing
+# needs to run in the background -- the state is simply brought up to date
+# when looked at, see Advance(). Other processes see the changes through the
+# json file, which is read each time the world is locked, and written back
+# if it changed
+##############################################################################
+
+class SimWorld:
+    ''' VMs and NSGs of the simulated CSP '''
+
+    def __init__(self, fname):
+        self.m_fname    = fname
+        self.m_lock     = threading.RLock()
+        self.m_vms      = {}                # vm_id -> vm dict
+        self.m_nsgs     = {}                # nsg_id -> nsg dict
+        self.m_clock    = 0                 # latest virtual time of any command
+
+    @contextlib.contextmanager
+    def Locked(self, write=False):
+        ''' world, up to date, and all to ourselves. Written back after if 'write' '''
+
+            # a virtual clock that's moved on is written back too, even by a
+            # query, a wait's polls are queries
+
+        with self.m_lock:
+            with open(self.m_fname + ".lock", "a") as lockf:
+                fcntl.flock(lockf, fcntl.LOCK_EX)               # other processes
+                self.Load()
+                yield self
+                if (write or (clock_get().Virtual() and clock_get().Time() > self.m_clock)):
+                    self.Save()
+
+    def Load(self):
+        try:
+            with open(self.m_fname, "r") as f:
+                data = json.load(f)
+            self.m_vms  = data["vms"]
+            self.m_nsgs = data["nsgs"]
+            self.m_clock= data.get("clock", 0)
+        except (IOError, ValueError, KeyError):
+            self.m_vms  = {}
+            self.m_nsgs = {}
+            self.m_clock= 0
+
+            # a virtual clock catches up to where the last command's got to,
+            # it'd start at the time of day otherwise
+
+        if (clock_get().Virtual()):
+            clock_get().Joined(self.m_clock)
+
+    def Save(self):
+        now = clock_get().Time()
+        if (clock_get().Virtual()):
+            self.m_clock = max(self.m_clock, now)
+        for vm_id in self.m_vms.keys():                         # forget long gone VMs
+            vm = self.Advance(self.m_vms[vm_id], now)
+            if (vm["state"] == "terminated" and vm["since"] < now - 600):
+                del self.m_vms[vm_id]
+        tmpname = "%s.%d" % (self.m_fname, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump({ "vms": self.m_vms, "nsgs": self.m_nsgs, "clock": self.m_clock }, f)
+        os.rename(tmpname, self.m_fname)
+
+    def Advance(self, vm, now):
+        ''' moves VM on to its next state if it's time has come '''
+
+        if (vm["next"] != None and now >= vm["until"]):
+            vm["state"] = vm["next"]
+            vm["since"] = vm["until"]
+            vm["next"]  = None
+        return vm
+
+    def VM(self, vm_id):
+        ''' returns the up to date VM, or None if there is no such VM '''
+
+        if (vm_id not in self.m_vms):
+            return None
+        return self.Advance(self.m_vms[vm_id], clock_get().Time())
+
+    def Reachable(self, vm_id, what):
+        ''' True if the VM answers "ping" or "ssh" right now '''
+
+        vm = self.VM(vm_id)
+        if (vm == None or vm["state"] != "running"):
+            return False
+        return clock_get().Time() >= vm[what + "_at"]
+
+##############################################################################
+# SimSSHStub
+#
+# Stands in for the VMs' ssh servers. Each VM gets a loopback tcp port, and
+# when something connects the VM's "SSH-2.0-..." banner is sent if its ssh
+# server is up, or the connection is just closed if it isn't. One thread
+# handles the ports of all the VMs
+##############################################################################
+
+class SimSSHStub(threading.Thread):
+    ''' loopback tcp ports that answer like the ssh servers of the simulated VMs '''
+
+    def __init__(self, reachable):
+        threading.Thread.__init__(self)
+        self.daemon         = True          # don't keep ncsp from exiting
+        self.m_reachable    = reachable     # func(vm_id), True if ssh server is up
+        self.m_ports        = {}            # vm_id -> port
+        self.m_listeners    = {}            # socket -> vm_id
+        self.m_lock         = threading.Lock()
+        self.m_done         = threading.Event()
+        atexit.register(self.Stop)          # before the interpreter tears down under us
+
+    def Port(self, vm_id):
+        ''' returns the VM's port, listening on it if not already '''
+
+        with self.m_lock:
+            if (vm_id not in self.m_ports):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind(("127.0.0.1", 0))
+                sock.listen(64)
+                self.m_ports[vm_id]   = sock.getsockname()[1]
+                self.m_listeners[sock] = vm_id
+            return self.m_ports[vm_id]
+
+    def Stop(self):
+        self.m_done.set()
+        self.join(1)
+
+    def run(self):
+        while (not self.m_done.is_set()):
+            with self.m_lock:
+                socks = self.m_listeners.keys()
+            rlist, wlist, xlist = select.select(socks, [], [], 0.1)
+            for sock in rlist:
+                conn, addr = sock.accept()
+                try:
+                    vm_id = self.m_listeners[sock]
+                    if (self.m_reachable(vm_id)):
+                        conn.sendall("SSH-2.0-ncsp_sim_%s\r\n" % vm_id)
+                except socket.error:
+                    pass                    # prober gave up already
+                finally:
+                    conn.close()
+
+##############################################################################
+# CSPClass
+#
+# Cloud Service Provided primitive access functions
+##############################################################################
+class CSPClass(CSPBaseClass):
+    ''' Cloud Service Provider Class for the simulator '''
+
+    def __init__(self, name, module_path):
+        ''' Class Initialization '''
+
+        CSPBaseClass.__init__(self, name, module_path)
+        self.m_world        = SimWorld(self.m_save_path + "sim.json")
+        self.m_latencies    = dict(default_sim_latencies)
+        self.m_speed        = 1.0                   # all latencies multiplied by this
+        self.m_error_rate   = default_sim_error_rate
+        self.m_throttle_rate= default_sim_throttle_rate
+        self.m_rng          = random.Random()
+        self.m_stub         = None                  # SimSSHStub, started when first needed
+        self.m_stub_lock    = threading.Lock()
+
+    ##############################################################################
+    # CSPSetupOK
+    #
+    # Nothing to set up, no cli or account
+    #
+    def CSPSetupOK(self):
+        ''' simulator is always set up '''
+
+        return 0
+
+    ##############################################################################
+    # ArgOptions
+    #
+    # sim specific argument parser. The --sim_ options set how the simulated
+    # CSP behaves -- latencies, failure rates -- and are saved with the args
+    # like any other option
+    #
+    def ArgOptions(self, parser):
+        ''' sim specific option parser '''
+
+        parser.add_argument('--region', dest='region',
+                            default=default_region, required=False,
+                            help='region in which to create the VM')
+        parser.add_argument('--instance_type', dest='instance_type',
+                            default=default_instance_type, required=False,
+                            help='VM instance (type) to create')
+
+        parser.add_argument('--sim_speed', dest='sim_speed', type=float,
+                            default=1.0, required=False,
+                            help='multiplies all simulated times, 0.01 is 100x faster')
+        parser.add_argument('--sim_error_rate', dest='sim_error_rate', type=float,
+                            default=default_sim_error_rate, required=False,
+                            help='fraction of api calls that fail (and are retried)')
+        parser.add_argument('--sim_throttle_rate', dest='sim_throttle_rate', type=float,
+                            default=default_sim_throttle_rate, required=False,
+                            help='fraction of api calls that are throttled (and are retried)')
+        parser.add_argument('--sim_seed', dest='sim_seed', type=int,
+                            default=0, required=False,
+                            help='random seed for latencies and errors, 0 is different each run')
+        parser.add_argument('--sim_config', dest='sim_config',
+                            default=None, required=False,
+                            help='json file of latency distributions, see sim_funcs.py')
+
+        parser.set_defaults(image_name=default_image_name);
+        parser.set_defaults(key_name=default_key_name)
+        parser.set_defaults(user=default_user);
+        parser.set_defaults(pingable=1)
+
+    ###########################################################################
+    # ArgSanity
+    #
+    # Sets up the simulator from the --sim_ options
+    #
+    # Returns    0    success
+    #            1    something is wrong, stop
+    #
+    def ArgSanity(self, parser, args):
+        ''' sim Parser Argument sanity checking '''
+
+        if (args.sim_speed <= 0):
+            error("--sim_speed must be more than 0")
+            return 1
+        self.m_speed        = args.sim_speed
+        self.m_error_rate   = args.sim_error_rate
+        self.m_throttle_rate= args.sim_throttle_rate
+        if (args.sim_seed != 0):
+            self.m_rng.seed(args.sim_seed)
+
+        if (args.sim_config != None and args.sim_config != "None"):
+            try:
+                with open(os.path.expanduser(args.sim_config), "r") as f:
+                    self.m_latencies.update(json.load(f))
+            except (IOError, ValueError) as e:
+                error("Could not read sim config \"%s\": %s" % (args.sim_config, e))
+                return 1
+
+            # try out each distribution now, rather than fail half way through
+
+        for name in sorted(self.m_latencies.keys()):
+            try:
+                sim_sample(self.m_latencies[name], self.m_rng)
+            except (ValueError, IndexError, TypeError) as e:
+                error("Bad \"%s\" latency %s: %s" % (name, self.m_latencies[name], e))
+                return 1
+
+            # a virtual clock picks up where the last command left it, before
+            # anything is timed (see SimWorld.Load)
+
+        if (clock_get().Virtual()):
+            with self.m_world.Locked():
+                pass
+        return 0
+
+    ###########################################################################
+    # GetRunStatus
+    #
+    # Returns:    string describing state, "unknown" if couldn't get it
+    #
+    def GetRunStatus(self, args):
+        ''' Returns running-state of instance '''
+
+        if (self.CheckID(args) == False):
+            return 1
+
+        retcode, output = self.SimAPI("sim instances describe --instance-id %s" % args.vm_id,
+                                      self.SimDescribe, args.vm_id)
+        if (retcode != 0):
+            run_state = "unknown"
+        else:
+            run_state = output["state"]
+
+        self.Inform(run_state)
+        return(run_state);
+
+    ###########################################################################
+    # GetImageId
+    #
+    # Returns:    0    success
+    #             1    Name is unknown, no ID foud
+    #
+    def GetImageId(self, args):
+
+        args.image_id = "simi-%08x" % (hash(args.image_name) & 0xffffffff)
+        return(0)
+
+    ###########################################################################
+    # GetIPSetupCorrectly
+    #
+    # All the simulated VMs are on loopback, each with its own ssh port
+    #
+    # Returns:    0 success
+    #             1 fails, invalid IP or can't get it
+    #
+    def GetIPSetupCorrectly(self, args):
+        ''' called after 'running' status to get IP '''
+
+        retcode, output = self.SimAPI("sim instances describe --instance-id %s" % args.vm_id,
+                                      self.SimDescribe, args.vm_id)
+        if (retcode != 0):
+            return 1
+        args.vm_ip = output["ip"]
+        debug(1, "ip: %s keyname: \"%s\"" % (args.vm_ip, args.key_name))
+        return 0
+
+##############################################################################
+# CSP specific Network Security Group Functions
+#
+#    ShowSecurityGroups       Displays NSG (network security groups) in region
+#    ExistingSecurityGroup    Does NSG exist?
+#    CreateSecurityGroup      Creates a NSG from a name, and adds rules
+#    DeleteSecurityGroup      Deletes a NSG
+##############################################################################
+
+    def ShowSecurityGroups(self, args):
+        ''' Displays all current security groups '''
+
+        retcode, output = self.SimAPI("sim security-groups describe --region %s" % args.region,
+                                      self.SimNSGs, args.region)
+        if (retcode != 0):
+            return retcode
+
+        items = len(output)
+        for idx in range(0, items):
+            print "%2d %-12s \"%s\" rules:%d" % (idx,
+                                                 output[idx]["id"],
+                                                 output[idx]["name"],
+                                                 output[idx]["rules"])
+        if (items == 0):
+            return 1                # no NSG's found
+        else:
+            return 0                # 1 or more NSG's found
+
+    def ExistingSecurityGroup(self, args):
+        ''' Does the security group name currently exist ? get it if it does'''
+
+        trace(2, "\"%s\"" % (args.nsg_name))
+
+        if (args.nsg_name == "" or args.nsg_name == None or args.nsg_name == "None"):
+            error("NetworkSecurityGroup name is \"%s\"" % args.nsg_name)
+            return 1
+
+        retcode, output = self.SimAPI("sim security-groups describe --region %s" % args.region,
+                                      self.SimNSGs, args.region)
+        if (retcode == 0):
+            for nsg in output:
+                if (nsg["name"] == args.nsg_name):
+                    args.nsg_id = nsg["id"]
+                    return 0
+
+        args.nsg_id=None
+        trace(2, "Did not find security group: \"%s\"" % args.nsg_name)
+        return 1
+
+    def CreateSecurityGroup(self, args):
+        ''' creates security group. saves it in args.nsg_id '''
+
+        trace(2, "\"%s\" %s" % (args.nsg_name, args.nsg_id))
+
+        retcode, output = self.SimAPI("sim security-groups create --group-name %s" % args.nsg_name,
+                                      self.SimCreateNSG, args.region, args.nsg_name)
+        if (retcode != 0):
+            error ("Problems creating NSG \"%s\"" % args.nsg_name)
+            return retcode
+        args.nsg_id = output
+        debug(1, "args.nsg_id <--- %s" % args.nsg_id)
+
+            # a call per rule, like the real CSPs
+
+        for rule in [ "ssh", "https", "icmp" ]:
+            self.Inform("CreateNSG rule %s.%s" % (args.nsg_name, rule))
+            retcode, output = self.SimAPI("sim security-groups authorize-ingress --group-id %s --rule %s" % (args.nsg_id, rule),
+                                          self.SimAddRule, args.nsg_id)
+            if (retcode != 0):
+                return retcode
+        self.Inform("              ")
+        return 0
+
+    def DeleteSecurityGroup(self, args):
+        ''' deletes the security group '''
+
+        trace(2, "\"%s\" %s" % (args.nsg_name, args.nsg_id))
+
+        if (args.nsg_id == None):
+            error("NSG %s already deleted", args.nsg_name)
+            return(1)
+
+        retcode, output = self.SimAPI("sim security-groups delete --group-id %s" % args.nsg_id,
+                                      self.SimDeleteNSG, args.nsg_id)
+        if (retcode != 0):
+            error(output)
+            return retcode
+        args.nsg_id = None                                  # remove id from args
+        return 0
+
+##############################################################################
+# CSP specific VM functions
+#
+#    CreateVM                Creates a complete fully running VM
+#    StartVM                 Starts a VM if it was stopped, returns running
+#    StopVM                  Stops the VM if it is currently running
+#    RestartVM               Resets VM, may not quite be same as Stop/Start
+#    DeleteVM                Removes from the CSP a running or stopped VM
+##############################################################################
+
+    def CreateVM(self, args):
+        ''' Creates a new VM. 'args' holds parameters '''
+
+        if (args.vm_id != "None" and args.vm_id != None):
+            error("Instance \"%s\" already exists, run 'deleteVM' first, or 'clean' if stale arg list" % args.vm_id)
+            return 1
+
+        args.vm_ip = ""                                             # make sure IP address is clear
+
+        self.Inform("CreateNSG")
+        if (self.CreateNSG(args) != 0):         # sets args.nsg_id
+            return 1
+        trace(2, "nsg_id: \"%s\" %s" % (args.nsg_name, args.nsg_id))
+
+        self.Inform("GetImageId")
+        if (self.GetImageId(args) != 0):
+            return 1
+        trace(2, "image_id: \"%s\" %s" % (args.image_name, args.image_id))
+
+        self.Inform("CreateVM")
+        cmd  = "sim instances create"
+        cmd += " --name %s" % args.vm_name
+        cmd += " --instance-type %s" % args.instance_type
+        cmd += " --image-id %s" % args.image_id
+        retcode, output = self.SimAPI(cmd + " --security-group-id %s" % args.nsg_id, self.SimCreateVM, args)
+        if (retcode != 0 and self.NSGGone(args)):       # recorded security group was deleted
+            retcode, output = self.SimAPI(cmd + " --security-group-id %s" % args.nsg_id, self.SimCreateVM, args)
+        if (retcode != 0):
+            error(output)
+            return retcode
+        args.vm_id = output
+        args.vm_ip = ""                             # don't have IP until we see VM running
+        self.Accepted(args, "create")
+
+        retcode = self.WaitTillRunning(args, "running", self.Timeout(TIMEOUT_1))
+
+            # save vm ID and other fields setup here so don't use them if error later
+
+        self.ArgSaveToFile(args)
+        debug(2, "createVM returning %d" % retcode)
+        return retcode                              # 0: succcess, 1: failure
+
+    def StartVM(self, args):
+        ''' Starts the VM '''
+
+        if (self.CheckID(args) == False):
+            return 1
+
+        status = self.GetRunStatus(args)
+        if (status == "running"):
+            return 0                                    # already running, simply return
+        elif (status != "stopped"):
+            error("id %s is in \"%s\" state, can't start running now" % (args.vm_id, status))
+            return 1
+
+        self.Inform("StartVM")
+        retcode, output = self.SimAPI("sim instances start --instance-id %s" % args.vm_id,
+                                      self.SimChange, args.vm_id, "start")
+        if (retcode != 0):
+            error(output)
+        else:
+            self.Accepted(args, "start")
+            retcode = self.WaitTillRunning(args, "running", self.Timeout(TIMEOUT_1))
+        return retcode                                  # 0: succcess, 1: failure
+
+    def StopVM(self, args):
+        ''' Stop the VM '''
+
+        if (self.CheckID(args) == False):
+            return 1
+
+        retcode = self.CheckRunStatus(args, "running")
+        if (retcode != 0):
+            error ("Not running")
+            return retcode
+
+        self.Inform("StopVM")
+        retcode, output = self.SimAPI("sim instances stop --instance-id %s" % args.vm_id,
+                                      self.SimChange, args.vm_id, "stop")
+        if (retcode == 0):
+            status = self.GetRunStatus(args)
+            if (status != "stopping" and status != "stopped"):
+                error("Asked VM to stop, but status = \"%s\"" % (status))
+                retcode = 1
+            else:
+                retcode = self.WaitForRunStatus(args, "stopped", self.Timeout(TIMEOUT_2))
+        else:
+            error(output)
+        return retcode                                  # 0: succcess, 1: failure
+
+    def RestartVM(self, args):
+        ''' Restarts the VM '''
+
+        if (self.CheckID(args) == False):
+            return 1
+
+        retcode = self.CheckRunStatus(args, "running")
+        if (retcode != 0):
+            error ("Not running")
+            return retcode
+
+        self.Inform("RestartVM")
+        retcode, output = self.SimAPI("sim instances reboot --instance-id %s" % args.vm_id,
+                                      self.SimChange, args.vm_id, "reboot")
+
+            # like aws, status stays "running" all through the reboot, so
+            # wait for it to stop answering pings, then for it to come back
+
+        if (retcode == 0):
+            self.Accepted(args, "reboot")
+            retcode = self.WaitForPing(args, False, self.Timeout(TIMEOUT_2))
+            if (retcode != 0):
+                error("never went un-pingable. Did VM restart?")
+            else:
+                retcode = self.WaitTillRunning(args, "running", self.Timeout(TIMEOUT_1))
+        else:
+            error(output)
+        return retcode                                  # 0: succcess, 1: failure
+
+    def DeleteVM(self, args):
+        ''' delete the vm and all the pieces '''
+
+        if (self.CheckID(args) == False):
+            return 1
+
+        self.Inform("DeleteVM")
+        retcode, output = self.SimAPI("sim instances terminate --instance-id %s" % args.vm_id,
+                                      self.SimChange, args.vm_id, "terminate")
+        if (retcode == 0):
+            retcode = self.WaitForRunStatus(args, "terminated", self.Timeout(TIMEOUT_1))
+        else:
+            error(output)
+
+        if (retcode == 0):              # successful so far?
+            self.Clean(args)            # remove file with the persistent id, ip address, ..
+            args.vm_deleted = True      # so won't write back args when done
+        return retcode                  # 0: succcess, 1: failure
+
+##############################################################################
+# CSP specific utility functions
+#
+#    ShowRunning             Shows all the account's running VM's
+#    GetRunning              Running VM's in a region
+#    GetRegions              Returns proper list of regions
+#    GetTypes                Simulated instance types in a region
+#    PollSettings            Polling backoff values, scaled by --sim_speed
+#    MaxParallelVMs          Most VMs to work on at the same time
+##############################################################################
+
+    def ShowRunning(self, args):
+        ''' Shows list of running instances within region of account '''
+
+        retcode, output = self.SimAPI("sim instances describe --region %s" % args.region,
+                                      self.SimVMs, args.region)
+        if (retcode != 0):
+            return retcode
+
+        lines_printed = 0
+        for vm in output:
+            if (vm["state"] == "terminated"):
+                continue
+            print(" %-36s %-16s %-10s %10s \"%s\"" %
+                  (vm["id"], vm["type"], vm["state"],
+                   time.strftime("%Y-%m-%d", time.localtime(vm["launched"])), vm["name"]))
+            lines_printed += 1
+
+        if (lines_printed == 0):
+            print("No running instances found in %s" % args.region)
+            return 1
+        return 0
+
+    def GetRunning(self, args, region):
+        ''' returns (retcode, list of running instances in region) '''
+
+        retcode, output = self.SimAPI("sim instances describe --region %s --state running" % region,
+                                      self.SimVMs, region)
+        running = []
+        if (retcode == 0):
+            for vm in output:
+                if (vm["state"] != "running"):
+                    continue
+                running.append({ "region":   region,
+                                 "id":       vm["id"],
+                                 "type":     vm["type"],
+                                 "launched": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(vm["launched"])),
+                                 "name":     vm["name"] })
+        return retcode, running
+
+    def GetRegions(self):
+        ''' Returns a list of region names for the CSP '''
+
+        return ["sim-east", "sim-west", "sim-north", "sim-south"]
+
+    def GetTypes(self, args, region):
+        ''' returns (retcode, list of instance types in region) '''
+
+        return self.SimAPI("sim instance-types describe --region %s" % region, self.SimTypes, region)
+
+    def PollSettings(self, kind):
+        ''' returns (initial, factor, cap, jitter) polling values for the kind of wait '''
+
+        initial, factor, cap, jitter = CSPBaseClass.PollSettings(self, kind)
+        return (initial * self.m_speed, factor, cap * self.m_speed, jitter)
+
+    def MaxParallelVMs(self):
+        ''' most VMs that a fleet command works on at the same time '''
+
+        return default_max_parallel_vms
+
+##############################################################################
+# CSP specific baseclass override functions
+#
+# The simulated VMs aren't real, so these talk to the simulator instead of
+# running ping and ssh. The real Wait.. functions in the baseclass run on
+# top of them
+#
+#    Ping                    Pings the VM
+#    Ssh                     SSH's into VM, knows a few commands
+#    SshStream               Ssh for sshall, output given when done
+#    PingOnce                One ping, for WaitForPing
+#    SshCheck                One ssh, for WaitTillCanSSH
+#    ProbeSSH                Asks simulator directly, with a virtual clock
+#    SSHPort                 VM's loopback ssh port, for ProbeSSH
+#    DeleteIPFromSSHKnownHostsFile   Nothing to delete
+##############################################################################
+
+    def Ping(self, args):
+        ''' pings the vm '''
+
+        if (self.CheckID(args) == False):
+            return 1
+        retcode, output, errval = self.PingOnce(args)
+        if (retcode == 0):
+            print "ping to %s was successful" % args.vm_ip
+        else:
+            error("ping to %s failed" % args.vm_ip)
+        return retcode
+
+    def Ssh(self, args, doprint, argv):
+        ''' SSH into instance, maybe running a command then returning '''
+
+        if (self.CheckID(args) == False):
+            return 1, "", ""
+
+        cmd = " ".join(argv).replace("\"", "")
+        retcode, output = self.SimLocal("ssh %s@%s %s" % (args.user, args.vm_ip, cmd), "ssh",
+                                        self.SimSsh, args.vm_id, cmd)
+        if (retcode != 0):
+            return retcode, "", output
+        if doprint:
+            print output
+        return retcode, output, ""
+
+    def SshStream(self, args, argv, online):
+        ''' runs command on VM, calling online(line) for each output line '''
+
+        return self.SshBuffered(args, argv, online)
+
+    def PingOnce(self, args):
+        ''' one ping of the VM, returns (retcode, stdout, stderr) of it '''
+
+        retcode, output = self.SimLocal("ping -c 1 -W 1 %s" % args.vm_ip, "ping",
+                                        self.SimPing, args.vm_id)
+        return retcode, output, ""
+
+    def SshCheck(self, args, cmd):
+        ''' runs the ssh command that says the VM can be ssh'ed into, returns (retcode, stdout, stderr) '''
+
+        return self.Ssh(args, False, ["uname -a"])
+
+    def ProbeSSH(self, args, timeout):
+        ''' returns VM's ssh server banner if it's answering, None if not '''
+
+            # with a virtual clock no real time goes by, so the ssh stub
+            # (in another thread, on real time) can't say if the VM is up
+            # yet. Ask the simulator directly instead
+
+        if (clock_get().Virtual()):
+            if (self.SimSSHUp(args.vm_id)):
+                return "SSH-2.0-ncsp_sim_%s" % args.vm_id
+            return None
+        return CSPBaseClass.ProbeSSH(self, args, timeout)
+
+    def SSHPort(self, args):
+        ''' port the VM's ssh server is on '''
+
+        with self.m_stub_lock:
+            if (self.m_stub == None):
+                self.m_stub = SimSSHStub(self.SimSSHUp)
+                self.m_stub.start()
+        return self.m_stub.Port(args.vm_id)
+
+    def DeleteIPFromSSHKnownHostsFile(self, args):
+        ''' simulated VMs aren't in the known hosts file '''
+
+        return 0
+
+##############################################################################
+# Simulator
+#
+#    Timeout                 Scales a timeout by --sim_speed
+#    Sample                  Latency sampled from a distribution
+#    SimAPI                  One api call -- latency, errors, retries
+#    SimLocal                One ssh or ping -- latency only
+#    Sim...                  What the api calls do to the world
+##############################################################################
+
+    def Timeout(self, timeout):
+        ''' timeout scaled by --sim_speed '''
+
+        return timeout * self.m_speed
+
+    def Sample(self, name):
+        ''' seconds sampled from the named latency distribution, scaled by --sim_speed '''
+
+        return sim_sample(self.m_latencies[name], self.m_rng) * self.m_speed
+
+    def SimAPI(self, cmd, func, *fargs):
+        ''' simulated api call 'cmd', returns (retcode, output) of func(world, *fargs) '''
+
+            # each try shows up in the cmds log, --stats and the timeline
+            # just like a real cli command. Throttled or failed tries are
+            # retried after a backoff, like the real CSP cli's do
+
+        family = self.CmdFamily(cmd)
+        policy = None
+        for attempt in range(0, default_sim_retries):
+            start = clock_get().Now()
+            clock_get().Sleep(self.Sample("api"))
+            roll = self.m_rng.random()
+            if (roll < self.m_throttle_rate):
+                retcode, output, retry = 1, "Throttling: Rate exceeded", True
+            elif (roll < self.m_throttle_rate + self.m_error_rate):
+                retcode, output, retry = 1, "InternalError: An internal error has occurred", True
+            else:
+                retcode, output = func(*fargs)
+                retry = False
+            self.m_timeline.Span(family, "cmd", start, clock_get().Now(), { "cmd": cmd, "rc": retcode })
+            self.CmdStat(cmd, family, start, retcode, json.dumps(output), False)
+            if (retry == False):
+                return retcode, output
+
+            debug(1, "%s: %s, try %d" % (cmd, output, attempt + 1))
+            if (policy == None):
+                policy = self.GetPollPolicy("api.retry")
+            policy.Sleep(self.Timeout(TIMEOUT_2))
+
+        error("%s: giving up after %d tries" % (cmd, default_sim_retries))
+        return retcode, output
+
+    def SimLocal(self, cmd, latency, func, *fargs):
+        ''' simulated ssh/ping 'cmd', returns (retcode, output) of func(*fargs) '''
+
+        start = clock_get().Now()
+        clock_get().Sleep(self.Sample(latency))
+        retcode, output = func(*fargs)
+        family = self.CmdFamily(cmd)
+        self.m_timeline.Span(family, "cmd", start, clock_get().Now(), { "cmd": cmd, "rc": retcode })
+        self.CmdStat(cmd, family, start, retcode, output, False)
+        return retcode, output
+
+    def SimBoot(self, vm, up_from):
+        ''' sets when a VM, that is running from 'up_from', answers ping and ssh '''
+
+        boot = self.Sample("boot")
+        vm["kernel"]    = boot * self.m_rng.uniform(0.2, 0.4)
+        vm["userspace"] = boot - vm["kernel"]
+        vm["booted"]    = up_from
+        vm["ping_at"]   = up_from + boot
+        vm["ssh_at"]    = vm["ping_at"] + self.Sample("sshd")
+
+    def SimCreateVM(self, args):
+        with self.m_world.Locked(write=True) as world:
+            if (args.nsg_id not in world.m_nsgs):
+                return 1, "InvalidGroup.NotFound: %s" % args.nsg_id
+            now   = clock_get().Time()
+            vm_id = "sim-%s" % uuid.uuid4().hex[0:17]
+            vm    = { "id": vm_id, "name": args.vm_name, "type": args.instance_type,
+                      "region": args.region, "nsg": args.nsg_id, "ip": "127.0.0.1", "launched": now,
+                      "state": "pending", "since": now, "next": "running", "until": now + self.Sample("create") }
+            self.SimBoot(vm, vm["until"])
+            world.m_vms[vm_id] = vm
+        return 0, vm_id
+
+    def SimChange(self, vm_id, change):
+        ''' start, stop, reboot or terminate a VM '''
+
+        allowed = { "start":     [ "stopped" ],
+                    "stop":      [ "pending", "running" ],
+                    "reboot":    [ "running" ],
+                    "terminate": [ "pending", "running", "stopping", "stopped" ] }
+        with self.m_world.Locked(write=True) as world:
+            vm = world.VM(vm_id)
+            if (vm == None):
+                return 1, "InvalidInstanceID.NotFound: %s" % vm_id
+            if (vm["state"] not in allowed[change]):
+                return 1, "IncorrectInstanceState: %s is %s" % (vm_id, vm["state"])
+            now = clock_get().Time()
+            if (change == "reboot"):
+                self.SimBoot(vm, now + self.Sample("reboot"))
+                return 0, vm["state"]
+            vm["state"], vm["next"] = { "start":     ("pending", "running"),
+                                        "stop":      ("stopping", "stopped"),
+                                        "terminate": ("shutting-down", "terminated") }[change]
+            vm["since"] = now
+            vm["until"] = now + self.Sample(change)
+            if (change == "start"):
+                self.SimBoot(vm, vm["until"])
+            return 0, vm["state"]
+
+    def SimDescribe(self, vm_id):
+        with self.m_world.Locked() as world:
+            vm = world.VM(vm_id)
+            if (vm == None):
+                return 1, "InvalidInstanceID.NotFound: %s" % vm_id
+            return 0, dict(vm)
+
+    def SimVMs(self, region):
+        with self.m_world.Locked() as world:
+            vms = [ world.VM(vm_id) for vm_id in world.m_vms.keys() ]
+        return 0, sorted([ vm for vm in vms if vm["region"] == region ], key=lambda vm: vm["launched"])
+
+    def SimTypes(self, region):
+        types = []
+        for name in sorted(default_sim_types.keys()):
+            vcpus, memory, gpus, gpu, network, regions = default_sim_types[name]
+            if (regions == None or region in regions):
+                types.append({ "type": name, "vcpus": vcpus, "memory": memory,
+                               "gpus": gpus, "gpu": gpu, "network": network })
+        return 0, types
+
+    def SimNSGs(self, region):
+        with self.m_world.Locked() as world:
+            nsgs = [ dict(nsg) for nsg in world.m_nsgs.values() if nsg["region"] == region ]
+        return 0, sorted(nsgs, key=lambda nsg: nsg["name"])
+
+    def SimCreateNSG(self, region, name):
+        with self.m_world.Locked(write=True) as world:
+            for nsg in world.m_nsgs.values():
+                if (nsg["region"] == region and nsg["name"] == name):
+                    return 1, "InvalidGroup.Duplicate: %s already exists" % name
+            nsg_id = "sg-%s" % uuid.uuid4().hex[0:17]
+            world.m_nsgs[nsg_id] = { "id": nsg_id, "name": name, "region": region, "rules": 0 }
+        return 0, nsg_id
+
+    def SimAddRule(self, nsg_id):
+        with self.m_world.Locked(write=True) as world:
+            if (nsg_id not in world.m_nsgs):
+                return 1, "InvalidGroup.NotFound: %s" % nsg_id
+            world.m_nsgs[nsg_id]["rules"] += 1
+        return 0, nsg_id
+
+    def SimDeleteNSG(self, nsg_id):
+        with self.m_world.Locked(write=True) as world:
+            if (nsg_id not in world.m_nsgs):
+                return 1, "InvalidGroup.NotFound: %s" % nsg_id
+            for vm_id in world.m_vms.keys():
+                vm = world.VM(vm_id)
+                if (vm["nsg"] == nsg_id and vm["state"] != "terminated"):
+                    return 1, "DependencyViolation: %s is in use by %s" % (nsg_id, vm_id)
+            del world.m_nsgs[nsg_id]
+        return 0, nsg_id
+
+    def SimPing(self, vm_id):
+        with self.m_world.Locked() as world:
+            if (world.Reachable(vm_id, "ping")):
+                return 0, "64 bytes from %s: icmp_seq=1 ttl=64 time=0.05 ms" % vm_id
+        return 1, ""
+
+    def SimSSHUp(self, vm_id):
+        with self.m_world.Locked() as world:
+            return world.Reachable(vm_id, "ssh")
+
+    def SimSsh(self, vm_id, cmd):
+        ''' runs a (pretend) command on the VM, knows a few that ncsp uses '''
+
+        with self.m_world.Locked() as world:
+            if (world.Reachable(vm_id, "ssh") == False):
+                return 255, "ssh: connect to host port 22: Connection refused"
+            vm = dict(world.VM(vm_id))
+        if (cmd.startswith("systemd-analyze")):
+            return 0, "Startup finished in %.3fs (kernel) + %.3fs (userspace) = %.3fs" % (
+                      vm["kernel"], vm["userspace"], vm["kernel"] + vm["userspace"])
+        elif (cmd.startswith("cat /proc/uptime")):
+            uptime = clock_get().Time() - vm["booted"]
+            return 0, "%.2f %.2f" % (uptime, uptime)
+        elif (cmd.startswith("uname")):
+            return 0, "Linux %s 4.4.0-sim #1 SMP x86_64 GNU/Linux" % vm["name"]
+        return 0, ""
@@ -42,11 +42,11 @@
 #
 
 import json
-import time
 import sys
 from cspbaseclass import CSPBaseClass
 from cspbaseclass import Which
 from cspbaseclass import error, trace, trace_do, debug, debug_stop
+from cspbaseclass import clock_get
 
 ##############################################################################
 # some <CSP> defaults values that will vary based on users 
@@ -60,7 +60,7 @@ from cspbaseclass import error, trace, trace_do, debug, debug_stop
 ##############################################################################
 
 default_key_name            = "my-security_key-name"     # "my-security_key-name"
-default_region              = "my-region-name"           # "my-region-name"
+default_region              = "west"                     # "my-region-name", one of GetRegions()
 default_user                = "my-user-name"             # "my-user-name"
 
 ##############################################################################
@@ -69,16 +69,15 @@ default_user                = "my-user-name"             # "my-user-name"
 # default_image_name:    Name of OS template that instance will be created with
 # default_instance_type: The default name that defines the memory and cpu sizes
 #                        and the gpu types for the instance. Changes
-# default_choices:       Avaliable instance types that user can select with
-#                        This will probably be different per region, and will
-#                        continue to change over time. Used as a pre-check in  
-#                        command parser to verify choice before sending to csp
+#
+# Which instance types there are changes per region, and over time. They're 
+# queried and cached, see GetTypes and 'ncsp template types'. createVM checks 
+# --instance_type against the cached ones for the region
 ##############################################################################
 
 
 default_image_name      = "Generic <CSP> starter AMI*"
 default_instance_type   = "type1.small"   # 1gpu, 4gpu and 8gpu instances
-default_choices         = ['type1.small', 'type1.med', 'type1.large'] 
 
 TIMEOUT_1 = (60 * 4) # create, start, terminate
 TIMEOUT_2 = (60 * 4) # stop, ping
@@ -130,14 +129,11 @@ class CSPClass(CSPBaseClass):
     def ArgOptions(self, parser):  
         ''' <CSP> specific option parser '''
         
-        region_list = self.GetRegionsCached()
         parser.add_argument('--region', dest='region',
                             default=default_region, required=False,
-                            choices=region_list,                        # regions change, queried outpu
                             help='region in which to create the VM')
         parser.add_argument('--instance_type', dest='instance_type',    # 'size' on azure, use 'instance-type' as common name
                             default=default_instance_type, required=False,
-                            choices=default_choices,
                             help='VM instance (type) to create')
  
         parser.add_argument('--vpcid', dest='vpcid', 
@@ -367,7 +363,7 @@ class CSPClass(CSPBaseClass):
 
         # CSP_Specific_CreateNSG(args.nsg_name, ...)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
         if (rc != 0):                                  # check for return code
             error ("Problems creating VM \"%s\"" % args.vm_name)
             return rc 
@@ -399,7 +395,7 @@ class CSPClass(CSPBaseClass):
         outer_retcode = 0
         for idx in range(0, len(rule)):
             self.Inform("CreateNSG rule %s.%s" %(args.nsg_name, rule[idx]["Name"]) ) 
-            time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+            clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
         self.Inform("              ")     
         return outer_retcode
 
@@ -422,7 +418,7 @@ class CSPClass(CSPBaseClass):
            
         # CSP_Specific_DeleteNSG(args.nsg_id)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
 
         args.nsg_id = None                                  # remove id from args
         
@@ -496,7 +492,7 @@ class CSPClass(CSPBaseClass):
         self.Inform("CreateVM")   
         # CSP_specific_CreateVM(args.vm_name, ...)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
         if (rc != 0):
             return rc           # unable to create the VM
 
@@ -505,13 +501,14 @@ class CSPClass(CSPBaseClass):
                 
         args.vm_id = "vm_dummyID"
         args.vm_ip = ""                             # don't have IP until we see VM running
+        self.Accepted(args, "create")               # for --timeline, see CSPBaseClass.Accepted
                        
             # CSP Specific - Name your instance if not done from above CreateVM
             
         self.Inform("create-tags")
         # CSP_specific_tagVM(args.vm_id, args.vm_name)
         rc = 0      # success
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
 
             # This code will be CSP specific, since some CSP's will not return
             # from their 'createVM' function untill the VM is fully running.
@@ -521,7 +518,7 @@ class CSPClass(CSPBaseClass):
             # Note that this function major responsiblity is to set args.vm_ip 
             
         if (rc == 0):
-            time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+            clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
             rc = self.WaitTillRunning(args, "unknown", TIMEOUT_1) 
                         
             # save vm ID and other fields setup here so don't use them if error later
@@ -581,7 +578,9 @@ class CSPClass(CSPBaseClass):
         self.Inform("StartVM") 
         # CSP_Specific_StartVM(args.vm_id, args.region, ...)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        if (rc == 0):
+            self.Accepted(args, "start")
         
             # CSP specific - verify that the VM is fully up and running, and that
             # we have it's IP address and can ssh into it.
@@ -631,7 +630,7 @@ class CSPClass(CSPBaseClass):
         self.Inform("StopVM")  
         # CSP_Specific_StopVM(args.vm_id, args.region)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
         
             # The CSP may return from the above command once the request
             # for stopping has been received. However we don't want to 
@@ -688,7 +687,7 @@ class CSPClass(CSPBaseClass):
         self.Inform("RestartVM")
         # CSP_SepecificRestartVM(args.vm_id, args.region)
         rc = 0;
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
 
             # this code is CSP specific.
             #
@@ -707,7 +706,7 @@ class CSPClass(CSPBaseClass):
             if (args.pingable == 1):
                 rc = self.WaitForPing(args, False, TIMEOUT_2)
             else:
-                time.sleep(5)       # let VM go down enough so SSH stops (we hope)
+                clock_get().Sleep(5)    # let VM go down enough so SSH stops (we hope)
                 rc = 0              # fake success, since ping isn't supported
                 
             if (rc != 0):
@@ -741,7 +740,7 @@ class CSPClass(CSPBaseClass):
         self.Inform("DeleteVM")
         # CSP_SpecificDeleteVM(args.vm_id, args.region)
         rc = 0
-        time.sleep(1)           # TEMPLATE DEVELOPMENT CODE - remove this sleep!
+        clock_get().Sleep(1)    # TEMPLATE DEVELOPMENT CODE - remove this sleep!
         
             # CSP specific..
             #
@@ -772,7 +771,7 @@ class CSPClass(CSPBaseClass):
             #
         if (rc == 0):                   # successful so far?
             self.Clean(args)            # remove file with the persistent id, ip address, ..
-            self.m_args_fname = ""      # clear name, so won't write back args when done
+            args.vm_deleted = True      # so won't write back args when done
             
         return rc                       # 0: succcess, 1: failure
     
@@ -780,7 +779,9 @@ class CSPClass(CSPBaseClass):
 # CSP specific utility functions
 #
 #    ShowRunning             Shows all the account's running VM's
+#    GetRunning              Running VM's in a region
 #    GetRegions              Returns proper list of regions
+#    GetTypes                Instance types in a region, and what they have
 ##############################################################################
       
     ##############################################################################
@@ -796,21 +797,17 @@ class CSPClass(CSPBaseClass):
         ''' Shows list of running instances within region of account '''
         
         # CSP_SpecificShowRunning(args.region)
-        rc = 0
+        rc, output = self.GetRunning(args, args.region)
         
         if (rc == 0):
-            output = []    
-            output.append({ "InstanceId":"i-1234123412341234", "InstanceType":"invented.micro",  "LaunchTime":"2018-02-29", "Description":"Fake image 1234" })
-            output.append({ "InstanceId":"i-5678567856785678", "InstanceType":"invented.biggee", "LaunchTime":"2018-02-30", "Description":"Fake image 5678" })
-
             items = len(output)
             lines_printed = 0
             for idx in range(0, items):
                     print(" %-36s %-16s %10s \"%s\"" % 
-                          (output[idx]["InstanceId"],
-                           output[idx]["InstanceType"],
-                           output[idx]["LaunchTime"],
-                           output[idx]["Description"]))
+                          (output[idx]["id"],
+                           output[idx]["type"],
+                           output[idx]["launched"],
+                           output[idx]["name"]))
                     lines_printed += 1
                     
             if (lines_printed == 0):
@@ -819,6 +816,26 @@ class CSPClass(CSPBaseClass):
         
         return 0
     
+    ##############################################################################
+    # GetRunning
+    #
+    # Gets the running instances in a region, see CSPBaseClass.ShowRunningAllRegions
+    #
+    # Returns:    (retcode, list of { "region", "id", "type", "launched", "name" })
+    #
+    def GetRunning(self, args, region):
+        ''' returns (retcode, list of running instances in region) '''
+        
+        # CSP_SpecificGetRunning(region)
+        rc = 0
+        
+        output = []    
+        if (rc == 0):
+            output.append({ "region":region, "id":"i-1234123412341234", "type":"invented.micro",  "launched":"2018-02-29", "name":"Fake image 1234" })
+            output.append({ "region":region, "id":"i-5678567856785678", "type":"invented.biggee", "launched":"2018-02-30", "name":"Fake image 5678" })
+        
+        return rc, output
+    
     ##############################################################################
     # GetRegions
     #
@@ -828,8 +845,8 @@ class CSPClass(CSPBaseClass):
     # may offer different resoures. Don't care about that here. Just need the
     # name.
     #
-    # Used in a choice-list in the arg parser when user gives a non-default
-    # region name to catch invalid names before any real processing is done
+    # Used to check --region, by the commands that use it, to catch invalid
+    # names before any real processing is done. See CSPBaseClass.CheckRegion
     #
     # Returns:    list of names
     def GetRegions(self):
@@ -838,6 +855,25 @@ class CSPClass(CSPBaseClass):
         mylist = ["north", "south", "east", "west"]
 
         return mylist 
+
+    ##############################################################################
+    # GetTypes
+    #
+    # Returns the instance types that can be created in a region, and what each
+    # has -- see CSPBaseClass.ShowTypes. Query the CSP for them, and fill in 
+    # what it says about each one. 0 or "" for what it doesn't say
+    #
+    # Returns:    (retcode, list of { "type", "vcpus", "memory", "gpus", "gpu", "network" })
+    #
+    def GetTypes(self, args, region):
+        ''' returns (retcode, list of instance types in region) '''
+        
+        # CSP_SpecificGetTypes(region)
+        types = [ { "type": "type1.small", "vcpus": 4,  "memory": 16.0,  "gpus": 1, "gpu": "V100", "network": 10.0 },
+                  { "type": "type1.med",   "vcpus": 16, "memory": 64.0,  "gpus": 4, "gpu": "V100", "network": 10.0 },
+                  { "type": "type1.large", "vcpus": 32, "memory": 128.0, "gpus": 8, "gpu": "V100", "network": 25.0 } ]
+        
+        return 0, types
  
 ##############################################################################
 # CSP specific baseclass override functions
@@ -848,6 +884,7 @@ class CSPClass(CSPBaseClass):
 #
 #    Ping                    Pings the fake ip address
 #    Ssh                     SSH's into VM,
+#    SshStream               fake Ssh for sshall
 #    WaitForPing             Pings ip address, waits for ping to stop or start
 #    WaitTillCanSSH          
 #
@@ -857,7 +894,7 @@ class CSPClass(CSPBaseClass):
     def Ping(self, args):
         ''' fake ping into vm '''
        
-        time.sleep(1)
+        clock_get().Sleep(1)
  
         print("66 bytes from %s: icmp_seq=0 ttl=999 time=0.0 ms" % args.vm_ip)
         print("66 bytes from %s: icmp_seq=1 ttl=999 time=0.0 ms" % args.vm_ip)
@@ -872,7 +909,7 @@ class CSPClass(CSPBaseClass):
         stdoutstr = "fake output"
         stderrstr = ""
         
-        time.sleep(1)
+        clock_get().Sleep(1)
                 # requested to print it?  (do this for add-hoc cmds from user)
                 
         if doprint:
@@ -882,13 +919,18 @@ class CSPClass(CSPBaseClass):
             
         return rc, stdoutstr, stderrstr   
  
-    def WaitForPing(self, args, state, timeout):
+    def SshStream(self, args, argv, online):
+        ''' fake SSH into instance for sshall, online(line) called for each output line '''
+        
+        return self.SshBuffered(args, argv, online)
+    
+    def WaitForPing(self, args, state, timeout, cancel=None):
         ''' fake Attempts to Ping, or not to Ping VM, waits till get a response '''
-        time.sleep(1)
+        clock_get().Sleep(1)
         return (0)
     
-    def WaitTillCanSSH(self, args, sshcmd, timeout): 
+    def WaitTillCanSSH(self, args, sshcmd, timeout, cancel=None): 
         ''' fake Spins till gets a ssh response from the VM '''
-        time.sleep(1)
+        clock_get().Sleep(1)
         return(0)
 